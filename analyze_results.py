@@ -0,0 +1,521 @@
+# Batch analysis of the results of many sessions. Run "python analyze_results.py results/" to compute the search slopes of every subject and the group.
+
+import os
+import glob
+import json
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Tuple, Any, Iterable
+
+import numpy as np
+import pandas as pd
+
+
+chunk_rows = 10000                                # Rows of a results file read at once, which bounds the memory used per worker
+correct_only = True                               # If True, only correctly answered trials enter the reaction time regressions
+resample_batch_size = 1000                        # Resamples computed at once by a worker in the bootstrap and permutation tests, which bounds their memory
+
+analysis_columns = ["sub_id", "target_state", "set_size", "reaction_time", "accuracy"]
+statistic_columns = ["trials", "correct", "n", "sum_x", "sum_y", "sum_xx", "sum_xy"]
+
+
+
+def find_results(paths: Iterable[str]) -> List[str]:
+    """
+    Expands the given paths into a sorted list of results, searching directories for the csv files written by save_experiment_data
+    and the directories written by ColumnarResults.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Results files, columnar results directories or directories containing either.
+
+    Returns
+    -------
+    list of str
+        The paths of all results found.
+    """
+
+    found = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.exists(os.path.join(path, "schema.json")):
+            found += glob.glob(os.path.join(path, "results_subject_*.csv"))
+            found += [os.path.dirname(schema) for schema in glob.glob(os.path.join(path, "results_subject_*", "schema.json"))]
+        else:
+            found.append(path)
+
+    return sorted(set(found))
+
+
+
+def read_chunks(path: str,
+                rows: int) -> Iterable[pd.DataFrame]:
+    """
+    Reads the analysis_columns of a results csv file or columnar results directory in chunks of the given number of rows.
+    """
+
+    if os.path.isdir(path):
+        # Columnar results are memory-mapped, so only the sliced rows are read
+        from differential_attentional_guidance import load_results
+
+        results = load_results(path, columns = analysis_columns)
+        for start in range(0, len(results), rows):
+            yield results.iloc[start:start + rows]
+        return
+
+    yield from pd.read_csv(path,
+                           usecols = analysis_columns,
+                           dtype = {"sub_id": str, "target_state": str},
+                           chunksize = rows)
+
+
+
+def file_statistics(path: str,
+                    rows: Optional[int] = None,
+                    only_correct: Optional[bool] = None) -> pd.DataFrame:
+    """
+    Streams a results file and sums the sufficient statistics of the reaction time regressions on set size
+    and the accuracy per subject and target state. Sums of several files can simply be added up.
+
+    Parameters
+    ----------
+    path : str
+        The path of a results csv file or columnar results directory.
+    rows : int, optional
+        The number of rows read at once. Defaults to chunk_rows.
+    only_correct : bool, optional
+        Whether only correctly answered trials enter the regression. Defaults to correct_only.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The statistic_columns per (sub_id, target_state): the number of "trials" and "correct" trials, and the number "n",
+        the sums of set size ("sum_x"), reaction time ("sum_y"), squared set size ("sum_xx") and their product ("sum_xy")
+        of the trials in the regression.
+    """
+
+    rows = rows or chunk_rows
+    only_correct = correct_only if only_correct is None else only_correct
+
+    sums = []
+    for chunk in read_chunks(path, rows):
+        x = chunk["set_size"].to_numpy(dtype = float)
+        y = chunk["reaction_time"].to_numpy(dtype = float)
+        correct = chunk["accuracy"].to_numpy(dtype = bool)
+
+        used = np.isfinite(y) & (correct if only_correct else True)
+
+        statistics = pd.DataFrame({"sub_id": chunk["sub_id"].astype(str).to_numpy(),
+                                   "target_state": chunk["target_state"].astype(str).to_numpy(),
+                                   "trials": 1,
+                                   "correct": correct.astype(int),
+                                   "n": used.astype(int),
+                                   "sum_x": np.where(used, x, 0),
+                                   "sum_y": np.where(used, y, 0),
+                                   "sum_xx": np.where(used, x * x, 0),
+                                   "sum_xy": np.where(used, x * y, 0)})
+
+        sums.append(statistics.groupby(["sub_id", "target_state"]).sum())
+
+    if not sums:
+        return pd.DataFrame(columns = statistic_columns)
+
+    return pd.concat(sums).groupby(level = [0, 1]).sum()
+
+
+
+def least_squares(sums: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solves simple least squares regressions from their summed statistics, any number at once.
+
+    Parameters
+    ----------
+    sums : numpy.ndarray
+        The (weighted) number of points, sum of x, sum of y, sum of x^2 and sum of xy along the last axis.
+
+    Returns
+    -------
+    slope, intercept : numpy.ndarray
+        The slopes and intercepts, NaN where fewer than two different x were regressed.
+    """
+
+    n, sum_x, sum_y, sum_xx, sum_xy = np.moveaxis(sums, -1, 0)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        denominator = n * sum_xx - sum_x ** 2
+        slope = (n * sum_xy - sum_x * sum_y) / denominator
+        intercept = (sum_y - slope * sum_x) / n
+
+    degenerate = np.isclose(denominator, 0)
+
+    return np.where(degenerate, np.nan, slope), np.where(degenerate, np.nan, intercept)
+
+
+
+def fit_slopes(statistics: pd.DataFrame) -> pd.DataFrame:
+    """
+    Solves the least squares regression of reaction time on set size for every row of summed statistics at once.
+
+    Parameters
+    ----------
+    statistics : pandas.DataFrame
+        Summed statistic_columns, as returned by file_statistics.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The "trials", the "accuracy", the number "n" of regression trials, the "slope" in seconds per item and the "intercept" in seconds per row.
+        Slope and intercept are NaN if fewer than two different set sizes were regressed.
+    """
+
+    slope, intercept = least_squares(statistics[["n", "sum_x", "sum_y", "sum_xx", "sum_xy"]].to_numpy(dtype = float))
+
+    return pd.DataFrame({"trials": statistics["trials"].to_numpy(),
+                         "accuracy": statistics["correct"].to_numpy() / statistics["trials"].to_numpy(),
+                         "n": statistics["n"].to_numpy(),
+                         "slope": slope,
+                         "intercept": intercept},
+                        index = statistics.index)
+
+
+
+def analyze(paths: Iterable[str],
+            workers: Optional[int] = None,
+            rows: Optional[int] = None,
+            only_correct: Optional[bool] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Computes the search slopes, intercepts and accuracy rates of every subject and of the group per target state.
+    The files are streamed in parallel by a process pool, and only their summed statistics are combined,
+    so time grows linearly and memory stays bounded with the number of files.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Results files, columnar results directories or directories containing either, see find_results.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of processors. With 1, the files are read in this process.
+    rows : int, optional
+        The number of rows read at once from every file. Defaults to chunk_rows.
+    only_correct : bool, optional
+        Whether only correctly answered trials enter the regressions. Defaults to correct_only.
+
+    Returns
+    -------
+    dict
+        The "subjects" fits per (sub_id, target_state) and the "group" results per target_state: the fit of the pooled statistics
+        and the mean, standard deviation and standard error of the subjects' slopes, intercepts and accuracies.
+    """
+
+    files = find_results(paths)
+    statistics_of = functools.partial(file_statistics, 
+                                      rows = rows, 
+                                      only_correct = only_correct)
+
+    if workers == 1 or len(files) < 2:
+        file_sums = [statistics_of(path) for path in files]
+    else:
+        # Files are handed out in batches, so scheduling costs stay small against reading thousands of short files
+        batch = max(1, len(files) // (4 * (workers or os.cpu_count() or 1)))
+
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            file_sums = list(executor.map(statistics_of, files, chunksize = batch))
+
+    file_sums = [sums for sums in file_sums if len(sums)]
+    if not file_sums:
+        raise ValueError(f"No trials found in {len(files)} results files.")
+
+    # Sessions of the same subject in several files add up
+    statistics = pd.concat(file_sums).groupby(level = [0, 1]).sum()
+    subjects = fit_slopes(statistics)
+
+    pooled = fit_slopes(statistics.groupby(level = "target_state").sum())
+    per_subject = subjects.groupby(level = "target_state")[["slope", "intercept", "accuracy"]]
+
+    group = pd.concat([pooled.add_prefix("pooled_"),
+                       per_subject.count()["slope"].rename("subjects"),
+                       per_subject.mean().add_suffix("_mean"),
+                       per_subject.std().add_suffix("_sd"),
+                       per_subject.sem().add_suffix("_sem")],
+                      axis = 1)
+
+    return {"subjects": subjects, "group": group}
+
+
+
+def file_trials(path: str,
+                rows: Optional[int] = None,
+                only_correct: Optional[bool] = None) -> pd.DataFrame:
+    """
+    Streams a results file and keeps the subject, target state, set size and reaction time of the trials that enter the regressions.
+
+    Parameters
+    ----------
+    path : str
+        The path of a results csv file or columnar results directory.
+    rows : int, optional
+        The number of rows read at once. Defaults to chunk_rows.
+    only_correct : bool, optional
+        Whether only correctly answered trials are kept. Defaults to correct_only.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The "sub_id", "target_state", "set_size" and "reaction_time" of the kept trials.
+    """
+
+    rows = rows or chunk_rows
+    only_correct = correct_only if only_correct is None else only_correct
+
+    kept = []
+    for chunk in read_chunks(path, rows):
+        used = np.isfinite(chunk["reaction_time"].to_numpy(dtype = float))
+        if only_correct:
+            used &= chunk["accuracy"].to_numpy(dtype = bool)
+
+        kept.append(pd.DataFrame({"sub_id": chunk["sub_id"].astype(str).to_numpy()[used],
+                                  "target_state": chunk["target_state"].astype(str).to_numpy()[used],
+                                  "set_size": chunk["set_size"].to_numpy(dtype = float)[used],
+                                  "reaction_time": chunk["reaction_time"].to_numpy(dtype = float)[used]}))
+
+    return pd.concat(kept, ignore_index = True) if kept else pd.DataFrame(columns = ["sub_id", "target_state", "set_size", "reaction_time"])
+
+
+
+def trial_moments(trials: pd.DataFrame) -> np.ndarray:
+    """Returns the per trial terms 1, x, y, x^2 and xy of the regression of reaction time (y) on set size (x), one row per trial."""
+
+    x = trials["set_size"].to_numpy(dtype = float)
+    y = trials["reaction_time"].to_numpy(dtype = float)
+
+    return np.column_stack([np.ones_like(x), x, y, x * x, x * y])
+
+
+
+# The subjects of the resampling tests, set once per worker process by init_resampling
+resampling_subjects = []
+
+
+
+def init_resampling(subjects: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+    """Hands the subjects to a worker process once, so the resampling tasks only carry their seeds."""
+
+    global resampling_subjects
+    resampling_subjects = subjects
+
+
+
+def resample_differences(kind: str,
+                         seed: np.random.SeedSequence,
+                         size: int) -> np.ndarray:
+    """
+    Computes one batch of resampled differences in slope and intercept between two target states, averaged over subjects.
+    All resamples of a subject are drawn as one weight matrix, whose product with the subject's trial moments gives the summed statistics
+    of every resample at once, which least_squares then solves.
+
+    "bootstrap" resamples the trials of every subject and target state with replacement (as multinomial counts) and then the subjects
+    with replacement. "permutation" shuffles the target state labels among the trials of every subject, which gives the differences
+    expected if the target state had no effect.
+
+    Parameters
+    ----------
+    kind : str
+        Either "bootstrap" or "permutation".
+    seed : numpy.random.SeedSequence
+        The seed of this batch, so every batch gives the same resamples regardless of the worker it runs on.
+    size : int
+        The number of resamples.
+
+    Returns
+    -------
+    numpy.ndarray
+        The mean differences in slope and intercept of every resample, with shape (size, 2).
+    """
+
+    rng = np.random.default_rng(seed)
+    differences = np.empty((size, len(resampling_subjects), 2))
+
+    for i, (first, second) in enumerate(resampling_subjects):
+        if kind == "bootstrap":
+            sums_first = rng.multinomial(len(first), np.full(len(first), 1 / len(first)), size = size) @ first
+            sums_second = rng.multinomial(len(second), np.full(len(second), 1 / len(second)), size = size) @ second
+
+        else:
+            moments = np.concatenate([first, second])
+
+            # The first len(first) trials of a random order of all trials get the first label
+            order = np.argsort(rng.random((size, len(moments))), axis = 1)
+            labels = np.zeros((size, len(moments)))
+            np.put_along_axis(labels, order[:, :len(first)], 1.0, axis = 1)
+
+            sums_first = labels @ moments
+            sums_second = moments.sum(axis = 0) - sums_first
+
+        differences[:, i] = np.column_stack(least_squares(sums_first)) - np.column_stack(least_squares(sums_second))
+
+    if kind == "bootstrap":
+        subjects = rng.integers(len(resampling_subjects), size = (size, len(resampling_subjects)))
+        differences = np.take_along_axis(differences, subjects[:, :, None], axis = 1)
+
+    return np.nanmean(differences, axis = 1)
+
+
+
+def resampling_test(paths: Iterable[str],
+                    states: Tuple[str, str] = ("negative", "positive"),
+                    n_bootstrap: int = 10000,
+                    n_permutations: int = 10000,
+                    seed: int = 0,
+                    level: float = 0.95,
+                    workers: Optional[int] = None,
+                    rows: Optional[int] = None,
+                    only_correct: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    Tests the difference in search slope and intercept between two target states (first minus second, averaged over subjects)
+    with a bootstrap confidence interval over subjects and trials and a within-subject permutation test.
+    The resamples are computed in batches of resample_batch_size by a process pool. Every batch has its own seed spawned from seed,
+    so the results only depend on seed, not on the number of workers.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Results files, columnar results directories or directories containing either, see find_results.
+    states : tuple of str, optional
+        The two target states compared. Defaults to ("negative", "positive").
+    n_bootstrap : int, optional
+        The number of bootstrap resamples. Defaults to 10000.
+    n_permutations : int, optional
+        The number of permutations. Defaults to 10000.
+    seed : int, optional
+        The seed all batch seeds are spawned from. Defaults to 0.
+    level : float, optional
+        The confidence level of the percentile intervals. Defaults to 0.95.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of processors. With 1, everything runs in this process.
+    rows : int, optional
+        The number of rows read at once from every file. Defaults to chunk_rows.
+    only_correct : bool, optional
+        Whether only correctly answered trials enter the regressions. Defaults to correct_only.
+
+    Returns
+    -------
+    dict
+        The number of "subjects" and for "slope" and "intercept" the observed "difference", the bootstrap "ci"
+        and the two-sided permutation "p" value, together with the settings of the test.
+    """
+
+    files = find_results(paths)
+    trials_of = functools.partial(file_trials, 
+                                  rows = rows, 
+                                  only_correct = only_correct)
+
+    if workers == 1 or len(files) < 2:
+        trials = [trials_of(path) for path in files]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            trials = list(executor.map(trials_of, files, chunksize = max(1, len(files) // (4 * (workers or os.cpu_count() or 1)))))
+
+    trials = pd.concat(trials, ignore_index = True)
+
+    # Only subjects with a defined slope for both target states enter the tests
+    subjects = []
+    for _, subject in trials.groupby("sub_id"):
+        moments = [trial_moments(subject[subject["target_state"] == state]) for state in states]
+
+        if all(len(np.unique(m[:, 1])) > 1 for m in moments):
+            subjects.append(tuple(moments))
+
+    if not subjects:
+        raise ValueError(f"No subject has slopes for both {states[0]} and {states[1]} targets.")
+
+    init_resampling(subjects)
+    observed = np.nanmean([np.column_stack(least_squares(first.sum(axis = 0))) - np.column_stack(least_squares(second.sum(axis = 0)))
+                           for first, second in subjects], axis = 0)[0]
+
+    batches = [(kind, size) for kind, total in (("bootstrap", n_bootstrap), ("permutation", n_permutations))
+               for size in [resample_batch_size] * (total // resample_batch_size) + [total % resample_batch_size] if size]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    tasks = [(kind, batch_seed, size) for (kind, size), batch_seed in zip(batches, seeds)]
+
+    if workers == 1:
+        results = [resample_differences(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers = workers,
+                                 initializer = init_resampling,
+                                 initargs = (subjects,)) as executor:
+            results = list(executor.map(resample_differences, *zip(*tasks)))
+
+    resamples = {kind: np.concatenate([result for (task_kind, _, _), result in zip(tasks, results) if task_kind == kind] or [np.empty((0, 2))])
+                 for kind in ("bootstrap", "permutation")}
+
+    test = {"states": list(states),
+            "subjects": len(subjects),
+            "n_bootstrap": n_bootstrap,
+            "n_permutations": n_permutations,
+            "seed": seed,
+            "level": level}
+
+    for column, measure in enumerate(("slope", "intercept")):
+        bootstrap = resamples["bootstrap"][:, column]
+        permutation = resamples["permutation"][:, column]
+
+        test[measure] = {
+            "difference": float(observed[column]),
+            "ci": np.nanpercentile(bootstrap, [50 * (1 - level), 50 * (1 + level)]).tolist() if len(bootstrap) else None,
+            "p": float((1 + np.sum(np.abs(permutation) >= abs(observed[column]))) / (1 + len(permutation))) if len(permutation) else None
+        }
+
+    return test
+
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Analyzes the given results, prints the group results and optionally stores both tables as csv files.
+    With --bootstrap or --permutations, the difference between two target states is tested as well.
+    """
+
+    parser = argparse.ArgumentParser(description = "Search slopes of the differential attentional guidance experiment.")
+    parser.add_argument("paths", nargs = "+", help = "Results files, columnar results directories or directories containing either.")
+    parser.add_argument("--workers", type = int, help = "Number of worker processes. Defaults to the number of processors.")
+    parser.add_argument("--chunk-rows", type = int, default = chunk_rows, help = "Rows read at once from every file.")
+    parser.add_argument("--all-trials", action = "store_true", help = "Include incorrectly answered trials in the reaction time regressions.")
+    parser.add_argument("--output", help = "Directory to store subject_slopes.csv, group_slopes.csv and resampling.json in.")
+    parser.add_argument("--bootstrap", type = int, default = 0, help = "Bootstrap resamples of the difference between two target states.")
+    parser.add_argument("--permutations", type = int, default = 0, help = "Permutations testing the difference between two target states.")
+    parser.add_argument("--states", nargs = 2, default = ["negative", "positive"], help = "The two target states compared, first minus second.")
+    parser.add_argument("--seed", type = int, default = 0, help = "Seed of the bootstrap and permutation tests.")
+    args = parser.parse_args(argv)
+
+    results = analyze(args.paths,
+                      workers = args.workers,
+                      rows = args.chunk_rows,
+                      only_correct = not args.all_trials)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results["group"])
+
+    if args.output:
+        os.makedirs(args.output, exist_ok = True)
+        results["subjects"].to_csv(os.path.join(args.output, "subject_slopes.csv"))
+        results["group"].to_csv(os.path.join(args.output, "group_slopes.csv"))
+
+    if args.bootstrap or args.permutations:
+        test = resampling_test(args.paths,
+                               states = tuple(args.states),
+                               n_bootstrap = args.bootstrap,
+                               n_permutations = args.permutations,
+                               seed = args.seed,
+                               workers = args.workers,
+                               rows = args.chunk_rows,
+                               only_correct = not args.all_trials)
+        print(json.dumps(test, indent = 2))
+
+        if args.output:
+            with open(os.path.join(args.output, "resampling.json"), "w", encoding = "utf-8") as file:
+                json.dump(test, file, indent = 2)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,698 @@
+# Benchmarks for the experiment script. Run "python benchmark.py --output baseline.json" once and "python benchmark.py --baseline baseline.json"
+# after a change, which flags every benchmark that got slower than the baseline by more than the tolerance.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib
+import importlib.util
+import platform
+import statistics
+import subprocess
+from types import ModuleType, SimpleNamespace
+from typing import Optional, List, Dict, Any, Callable, Tuple
+
+
+module_name = "differential_attentional_guidance"
+directory = os.path.dirname(os.path.abspath(__file__))
+
+scaling_grids = [(6, 6), (9, 9), (12, 12), (15, 15)]          # Rows and columns of the grids measured by benchmark_scaling
+scaling_set_sizes = [7, 19, 50, 100, 150]                      # Set sizes measured by benchmark_scaling, as far as they fit into the grid
+scaling_render_modes = ["vector", "batched", "atlas"]
+regression_tolerance = 0.2                                      # Relative slowdown of a median against the baseline, above which a benchmark is flagged
+
+
+
+def time_subprocess(code: str,
+                    repeats: int) -> List[float]:
+    """
+    Runs a piece of code in fresh Python interpreters and measures the wall time of every run,
+    so each run starts with cold module caches like a real session.
+
+    Parameters
+    ----------
+    code : str
+        The code passed to "python -c".
+    repeats : int
+        The number of runs.
+
+    Returns
+    -------
+    list of float
+        The wall time of every run in seconds.
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code],
+                       cwd = directory,
+                       check = True)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    """
+    Summarizes a list of timings in seconds by their minimum, median, mean and maximum.
+    """
+
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "max": max(times),
+        "n": len(times)
+    }
+
+
+
+def time_calls(function: Callable[[], Any],
+               repeats: int) -> List[float]:
+    """
+    Calls a function repeatedly and returns the wall time of every call in seconds.
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+
+class StubStim:
+    """
+    Stands in for every PsychoPy stimulus in the stub backend. It keeps the attributes it is created with or given later and draws nothing,
+    so the benchmarks measure the work of the experiment script without the one of the graphics driver.
+    """
+
+    def __init__(self,
+                 win: Any = None,
+                 **kwargs) -> None:
+
+        self.win = win
+        self.__dict__.update(kwargs)
+
+
+    def draw(self,
+             win: Any = None) -> None:
+        """Does nothing."""
+
+
+
+class StubWindow:
+    """
+    Stands in for the PsychoPy window in the stub backend. Flips return at once, as nothing is drawn.
+
+    Parameters
+    ----------
+    size : tuple of int
+        The size of the window in pixels.
+    frame_rate : float, optional
+        The refresh rate reported as monitorFramePeriod. Defaults to 60.
+    """
+
+    def __init__(self,
+                 size: Tuple[int, int],
+                 frame_rate: float = 60,
+                 **kwargs) -> None:
+
+        self.size = tuple(size)
+        self.units = "cm"
+        self.monitorFramePeriod = 1 / frame_rate
+        self.movieFrames = []
+
+
+    def flip(self,
+             clearBuffer: bool = True) -> float:
+        """Returns the current time as flip time."""
+
+        return time.perf_counter()
+
+
+    def callOnFlip(self,
+                   function: Callable,
+                   *args,
+                   **kwargs) -> None:
+        """Calls the function right away, as the flip is immediate."""
+
+        function(*args, **kwargs)
+
+
+    def clearBuffer(self) -> None:
+        """Does nothing."""
+
+
+    def close(self) -> None:
+        """Does nothing."""
+
+
+
+stub_visual = SimpleNamespace(Window = StubWindow,
+                              Circle = StubStim,
+                              ShapeStim = StubStim,
+                              Line = StubStim,
+                              Rect = StubStim,
+                              ElementArrayStim = StubStim,
+                              ImageStim = StubStim,
+                              TextStim = StubStim)
+
+
+
+def load_experiment(path: str) -> ModuleType:
+    """
+    Imports a copy of the experiment script placed in the given directory, so everything it saves (results, schedules, logs)
+    ends up there instead of next to the script, and the stub backend can be swapped in without affecting other imports.
+    """
+
+    script = os.path.join(path, f"{module_name}.py")
+    shutil.copy(os.path.join(directory, f"{module_name}.py"), script)
+
+    spec = importlib.util.spec_from_file_location(f"benchmarked_{module_name}", script)
+    experiment = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(experiment)
+
+    return experiment
+
+
+
+def open_window(experiment: ModuleType,
+                backend: str = "auto") -> Tuple[Any, str]:
+    """
+    Opens the window the suite draws into: an invisible PsychoPy window for the "psychopy" backend, or a StubWindow for the "stub" backend,
+    which also replaces the experiment's visual module by stubs. "auto" uses PsychoPy if a window can be opened and the stubs otherwise,
+    e.g. on a Linux box without PsychoPy or a display.
+
+    Returns
+    -------
+    tuple
+        The window and the name of the backend used.
+    """
+
+    if backend in ("auto", "psychopy"):
+        try:
+            from psychopy import visual
+
+            win = visual.Window(size = experiment.monitor_size_pix,
+                                units = "cm",
+                                color = "black",
+                                fullscr = False,
+                                monitor = experiment.create_monitor())
+            try:
+                win.winHandle.set_visible(False)
+            except AttributeError:
+                pass
+
+            return win, "psychopy"
+
+        except Exception as e:
+            if backend == "psychopy":
+                raise
+            print(f"Using the stub backend, as no PsychoPy window could be opened: {e}", file = sys.stderr)
+
+    experiment.visual = stub_visual
+    return StubWindow(experiment.monitor_size_pix), "stub"
+
+
+
+def sample_trials(experiment: ModuleType,
+                  rng: random.Random) -> List[Dict[str, Any]]:
+    """
+    Returns the trial data of a full session with the settings of the experiment script, with plausible random values.
+    """
+
+    n_trials = len(experiment.set_sizes) * len(experiment.target_states) * experiment.trials_per_condition
+    trials = []
+
+    for i in range(n_trials):
+        position = (rng.randint(1, experiment.rows), rng.randint(1, experiment.cols))
+        trials.append({"trial_num": i + 1,
+                       "block": i // experiment.trials_per_condition + 1,
+                       "target_state": rng.choice(experiment.target_states),
+                       "set_size": rng.choice(experiment.set_sizes),
+                       "reaction_time": rng.uniform(0.4, 1.5),
+                       "flip_latency": rng.uniform(0, 0.001),
+                       "target_position": position,
+                       "response": position,
+                       "accuracy": rng.random() > 0.05,
+                       "draw_prep_time": rng.uniform(0, 0.002),
+                       "onset_flip_time": 10 + i * 3.0,
+                       "onset_frame_interval": rng.uniform(0.3, 0.6),
+                       "keypress_to_onset": rng.uniform(0, 0.016),
+                       "onset_dropped_frames": 0,
+                       "onset_timing_ok": True,
+                       "grid_prep_time": rng.uniform(0, 0.002),
+                       "row_grid_flip_time": 11 + i * 3.0,
+                       "row_grid_flip_interval": rng.uniform(0.4, 1.5),
+                       "col_grid_flip_time": 12 + i * 3.0,
+                       "col_grid_flip_interval": rng.uniform(0.5, 1.0)})
+
+    return trials
+
+
+
+def benchmark_suite(repeats: int = 10,
+                    backend: str = "auto") -> Dict[str, Any]:
+    """
+    Times the rendering, scoring and I/O hot paths of the experiment script with its current settings: calculate_positions
+    (cold and cached), preload_stimuli and drawing a whole display with draw_stimulus for every set size, display_grid, present_text
+    (new and pooled texts), save_experiment_data per trial and over a full session, scoring a trial with OnlineStatistics,
+    building all stimuli with SetupPipeline and setup_experiment end to end, headless and, on the stub backend, windowed until the pipeline
+    has built all stimuli. Runs on a copy of the script in a temporary directory.
+
+    Parameters
+    ----------
+    repeats : int, optional
+        The number of calls per benchmark. Full sessions are saved max(repeats // 5, 1) times. Defaults to 10.
+    backend : str, optional
+        "psychopy", "stub" or "auto", see open_window. Defaults to "auto".
+
+    Returns
+    -------
+    dict
+        The "backend" used and the summaries of all benchmarks in seconds.
+    """
+
+    path = tempfile.mkdtemp(prefix = "benchmark_")
+    handlers = list(logging.root.handlers)
+    rng = random.Random(0)
+    win = None
+
+    try:
+        experiment = load_experiment(path)
+        win, backend = open_window(experiment, 
+                                   backend)
+
+        rows, cols, set_sizes = experiment.rows, experiment.cols, experiment.set_sizes
+        subject_info = {"age": "0", "sex": "benchmark", "sub_id": "benchmark", "vision": "benchmark", "handedness": "benchmark"}
+        results = {"backend": backend}
+
+
+        def calculate_cold() -> None:
+            experiment.geometries.clear()
+            experiment.calculate_positions(win, rows, cols)
+
+        results["calculate_positions"] = {"cold": summarize(time_calls(calculate_cold, repeats)),
+                                          "cached": summarize(time_calls(lambda: experiment.calculate_positions(win, rows, cols), repeats))}
+        positions = experiment.calculate_positions(win, rows, cols)
+
+        results["preload_stimuli"] = {str(set_size): summarize(time_calls(lambda: experiment.preload_stimuli(win, set_size), repeats))
+                                      for set_size in set_sizes}
+
+        # A whole display per call, the target first
+        stimuli = experiment.preload_stimuli(win, max(set_sizes))
+        results["draw_stimulus"] = {}
+
+        for set_size in set_sizes:
+            displays = iter([rng.sample(range(len(positions)), set_size) for _ in range(repeats)])
+
+            def draw_display() -> None:
+                cells = next(displays)
+                for i, cell in enumerate(cells):
+                    experiment.draw_stimulus(stimuli[i], 
+                                             "positive" if i == 0 else "neutral", 
+                                             positions[cell])
+
+            results["draw_stimulus"][str(set_size)] = summarize(time_calls(draw_display, repeats))
+
+        rectangles = experiment.load_rectangles(win, positions)
+        results["display_grid"] = summarize(time_calls(lambda: experiment.display_grid(win, 
+                                                                                        positions, 
+                                                                                        rectangles, 
+                                                                                        experiment.color2, 
+                                                                                        experiment.color), 
+                                                       repeats))
+
+        texts = iter([f"Block {i + 1} von {repeats}" for i in range(repeats)])
+        results["present_text"] = {"new": summarize(time_calls(lambda: experiment.present_text(win, next(texts), flip = True), repeats)),
+                                   "pooled": summarize(time_calls(lambda: experiment.present_text(win, "Block 1 von 1", flip = True), repeats))}
+
+        trials = sample_trials(experiment, 
+                               rng)
+        trial_times, session_times = [], []
+
+        for session in range(max(repeats // 5, 1)):
+            output_file = os.path.join(path, f"session_{session}.csv")
+            times = time_calls(lambda trial = iter(trials): experiment.save_experiment_data(subject_info, 
+                                                                                           next(trial), 
+                                                                                           output_file, 
+                                                                                           "csv"), 
+                               len(trials))
+            trial_times += times
+            session_times.append(sum(times))
+
+        results["save_experiment_data"] = {"trial": summarize(trial_times),
+                                           "session": summarize(session_times),
+                                           "trials_per_session": len(trials)}
+
+        statistics_ = experiment.OnlineStatistics(subject_info)
+        scored = iter(trials * repeats)
+        results["score_trial"] = summarize(time_calls(lambda: statistics_.update(next(scored)), len(trials)))
+
+
+        def build_stimuli() -> None:
+            experiment.SetupPipeline(win, 
+                                     positions, 
+                                     max(set_sizes), 
+                                     experiment.training_set_size).wait("main")
+
+        results["setup_pipeline"] = summarize(time_calls(build_stimuli, max(repeats // 5, 1)))
+
+
+        def setup_headless() -> None:
+            experiment.setup_experiment(subject_info,
+                                        rows,
+                                        cols,
+                                        set_sizes,
+                                        experiment.target_states,
+                                        experiment.trials_per_condition,
+                                        logging.WARNING,
+                                        participant = experiment.SimulatedParticipant(seed = 0))
+
+        results["setup_experiment"] = {"headless": summarize(time_calls(setup_headless, repeats))}
+
+        # The windowed setup of a session, from the dialog until all stimuli are built, without the dialog and the monitor calibration.
+        # It opens a full-screen window, so it only runs on the stub backend
+        if backend == "stub":
+            experiment.get_participant_info = lambda info: dict(info)
+            experiment.create_monitor = lambda: None
+
+
+            def setup_windowed() -> None:
+                pipeline = experiment.setup_experiment(subject_info,
+                                                       rows,
+                                                       cols,
+                                                       set_sizes,
+                                                       experiment.target_states,
+                                                       experiment.trials_per_condition,
+                                                       logging.WARNING,
+                                                       pages = list(experiment.instruction))[-1]
+                pipeline.wait("main")
+                experiment.idle_tasks.remove(pipeline.step)
+
+            results["setup_experiment"]["windowed"] = summarize(time_calls(setup_windowed, max(repeats // 5, 1)))
+
+        return results
+
+    finally:
+        if win is not None:
+            win.close()
+
+        # Closes the log file opened by setup_experiment before its directory is removed
+        for handler in logging.root.handlers[:]:
+            if handler not in handlers:
+                logging.root.removeHandler(handler)
+                handler.close()
+
+        shutil.rmtree(path, ignore_errors = True)
+
+
+
+def median_timings(results: Dict[str, Any],
+                   prefix: str = "") -> Dict[str, float]:
+    """
+    Collects the median of every summary in nested benchmark results, keyed by the path of the summary, e.g. "suite/draw_stimulus/19".
+    """
+
+    if "median" in results:
+        return {prefix: results["median"]}
+
+    timings = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            timings.update(median_timings(value, f"{prefix}/{key}" if prefix else key))
+
+    return timings
+
+
+
+def find_regressions(results: Dict[str, Any],
+                     baseline: Dict[str, Any],
+                     tolerance: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Compares the medians of two benchmark runs and returns every benchmark, that got slower by more than the tolerance.
+    The suite is only compared if both runs used the same backend.
+
+    Parameters
+    ----------
+    results : dict
+        The current results as returned by run_benchmarks.
+    baseline : dict
+        The results of an earlier run, as stored with --output.
+    tolerance : float, optional
+        The relative slowdown allowed, e.g. 0.2 for 20 %. Defaults to regression_tolerance.
+
+    Returns
+    -------
+    list of dict
+        The "benchmark", its "baseline" and "current" median in seconds and the relative "change" of every regression.
+    """
+
+    tolerance = regression_tolerance if tolerance is None else tolerance
+    current = results["benchmarks"]
+    previous = dict(baseline["benchmarks"])
+
+    if previous.get("suite", {}).get("backend") != current.get("suite", {}).get("backend"):
+        previous.pop("suite", None)
+
+    previous_timings = median_timings(previous)
+    regressions = []
+
+    for name, median in median_timings(current).items():
+        before = previous_timings.get(name)
+
+        if before and median > before * (1 + tolerance):
+            regressions.append({"benchmark": name,
+                                "baseline": before,
+                                "current": median,
+                                "change": median / before - 1})
+
+    return regressions
+
+
+
+def benchmark_import(repeats: int = 10) -> Dict[str, Any]:
+    """
+    Measures how long it takes to start a Python interpreter and import the experiment script, compared to an empty interpreter start.
+
+    Parameters
+    ----------
+    repeats : int, optional
+        The number of runs. Defaults to 10.
+
+    Returns
+    -------
+    dict
+        The summaries of the "interpreter" start alone and the start including the "import".
+    """
+
+    return {
+        "interpreter": summarize(time_subprocess("pass", repeats)),
+        "import": summarize(time_subprocess(f"import {module_name}", repeats))
+    }
+
+
+
+def benchmark_scaling(repeats: int = 20) -> Dict[str, Any]:
+    """
+    Measures how the preparation, drawing and flip of search displays and of the response grid scale with the size of the grid
+    and the set size, for every render mode. A window of the configured size is opened for this, so PsychoPy and a display are needed.
+    The flips wait for the vertical blank, so a display fits into one frame as long as its preparation and drawing take less than the frame period.
+
+    Parameters
+    ----------
+    repeats : int, optional
+        The number of displays measured per grid and set size. Defaults to 20.
+
+    Returns
+    -------
+    dict
+        The "frame_period" and for every render mode and grid ("rows x cols") the summaries of the grid's "prepare" and "flip" times
+        and, for every set size, the summaries of the "prepare", "draw" and "flip" times in seconds with the number of displays "over_frame",
+        whose preparation and drawing took longer than a frame. Only a "skipped" reason if PsychoPy is not available.
+    """
+
+    try:
+        experiment = importlib.import_module(module_name)
+        from psychopy import visual
+    except ImportError as e:
+        return {"skipped": f"PsychoPy is not available: {e}"}
+
+    settings = (experiment.render_mode, experiment.rows, experiment.cols)
+    rng = random.Random(0)
+
+    win = visual.Window(size = experiment.monitor_size_pix,
+                        units = "cm",
+                        color = "black",
+                        fullscr = False,
+                        monitor = experiment.create_monitor())
+
+    frame = experiment.frame_period(win)
+    results = {"frame_period": frame}
+
+    try:
+        for render_mode in scaling_render_modes:
+            experiment.render_mode = render_mode
+            results[render_mode] = {}
+
+            for rows, cols in scaling_grids:
+                experiment.rows, experiment.cols = rows, cols
+
+                positions = experiment.calculate_positions(win, rows, cols)
+                set_sizes = [set_size for set_size in scaling_set_sizes if set_size <= rows * cols]
+                stimuli = experiment.preload_display(win, max(set_sizes))
+
+                if render_mode == "vector":
+                    rectangles = experiment.load_rectangles(win, positions)
+                else:
+                    rectangles = [experiment.load_rectangle_array(win, positions)]
+
+                grid_prepare, grid_flip = [], []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    grid_prepare.append(experiment.display_grid(win, 
+                                                                positions, 
+                                                                rectangles, 
+                                                                experiment.color2, 
+                                                                experiment.color)[0])
+                    grid_flip.append(time.perf_counter() - start - grid_prepare[-1])
+
+                grid = {"grid": {"prepare": summarize(grid_prepare), 
+                                 "flip": summarize(grid_flip)}}
+
+                for set_size in set_sizes:
+                    prepare, draw, flip = [], [], []
+
+                    for _ in range(repeats):
+                        cells = rng.sample(range(rows * cols), set_size)
+
+                        start = time.perf_counter()
+                        prepared = experiment.prepare_trial(win,
+                                                            set_size,
+                                                            positions,
+                                                            rng.choice(experiment.target_states),
+                                                            stimuli,
+                                                            experiment.continue_key,
+                                                            target_index = cells[0],
+                                                            distractor_indices = cells[1:])
+                        prepared_time = time.perf_counter()
+
+                        for stim in prepared["draw_list"]:
+                            stim.draw()
+                        drawn_time = time.perf_counter()
+
+                        win.flip()
+                        prepare.append(prepared_time - start)
+                        draw.append(drawn_time - prepared_time)
+                        flip.append(time.perf_counter() - drawn_time)
+
+                    grid[str(set_size)] = {"prepare": summarize(prepare),
+                                           "draw": summarize(draw),
+                                           "flip": summarize(flip),
+                                           "over_frame": sum(p + d > frame for p, d in zip(prepare, draw))}
+
+                results[render_mode][f"{rows}x{cols}"] = grid
+
+    finally:
+        experiment.render_mode, experiment.rows, experiment.cols = settings
+        win.close()
+
+    return results
+
+
+
+def run_benchmarks(repeats: int,
+                   scaling: bool = False,
+                   backend: str = "auto") -> Dict[str, Any]:
+    """
+    Runs all benchmarks and returns their results together with information about the machine.
+
+    Parameters
+    ----------
+    repeats : int
+        The number of repetitions of every benchmark.
+    scaling : bool, optional
+        Whether to run benchmark_scaling as well, which opens a window. Defaults to False.
+    backend : str, optional
+        The backend of the suite, see open_window. Defaults to "auto".
+
+    Returns
+    -------
+    dict
+        The results of all benchmarks.
+    """
+
+    benchmarks = {
+        "import": benchmark_import(repeats),
+        "suite": benchmark_suite(repeats,
+                                 backend)
+    }
+
+    if scaling:
+        benchmarks["scaling"] = benchmark_scaling(max(repeats, 20))
+
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": benchmarks
+    }
+
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Runs the benchmarks, prints their results and optionally stores them as json. With a baseline, the regressions are printed as well
+    and the exit status is 1 if there are any, so the benchmarks can guard changes in a CI job.
+    """
+
+    parser = argparse.ArgumentParser(description = "Benchmarks for the differential attentional guidance experiment.")
+    parser.add_argument("--repeats", type = int, default = 10, help = "Repetitions of every benchmark.")
+    parser.add_argument("--output", help = "Path of a json file to store the results in.")
+    parser.add_argument("--scaling", action = "store_true", help = "Also measure how display preparation and flips scale with grid and set size. Opens a window.")
+    parser.add_argument("--backend", choices = ["auto", "psychopy", "stub"], default = "auto", help = "Window of the suite: an invisible PsychoPy window, stubs, or PsychoPy if available.")
+    parser.add_argument("--baseline", help = "Path of the json file of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type = float, default = regression_tolerance, help = "Relative slowdown of a median, above which a benchmark counts as regression.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeats,
+                             scaling = args.scaling,
+                             backend = args.backend)
+    print(json.dumps(results, indent = 2))
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as file:
+            json.dump(results, file, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline, encoding = "utf-8") as file:
+            baseline = json.load(file)
+
+        regressions = find_regressions(results, 
+                                       baseline, 
+                                       args.tolerance)
+
+        for regression in regressions:
+            print(f"Regression: {regression['benchmark']} {regression['baseline'] * 1e3:.3f} ms -> {regression['current'] * 1e3:.3f} ms "
+                  f"(+{regression['change']:.0%})")
+
+        if not regressions:
+            print(f"No regressions against {args.baseline}")
+
+        sys.exit(1 if regressions else 0)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# Collects the trial records of many stations into one csv file. Run "python collector.py --port 8765" and set collector_address = "<host>:8765" on the stations.
+
+import os
+import csv
+import json
+import asyncio
+import logging
+import argparse
+import functools
+import concurrent.futures
+from typing import Optional, List, Dict, Any
+
+from differential_attentional_guidance import result_columns
+
+
+collected_columns = ["source", "batch"] + result_columns
+
+
+
+class CollectedResults:
+    """
+    Appends the records of all stations to one csv file, with the source (station, subject and session start) and batch number
+    of every record. The last batch of every source is remembered, also across restarts by reading the file,
+    so a batch resent after a lost confirmation is stored only once. A resent batch whose number of records differs
+    from the stored one is still not stored, but logged, as it means the station changed the batch after numbering it.
+    Positions, which travel as json lists, are written as tuples like in the csv files of the stations.
+
+    Parameters
+    ----------
+    path : str
+        The path of the csv file. A header row is written if the file doesn't exist yet.
+    fsync : bool, optional
+        If True, every batch is forced to disk before it is confirmed. Defaults to True.
+    """
+
+    def __init__(self,
+                 path: str,
+                 fsync: bool = True) -> None:
+
+        self.path = path
+        self.fsync = fsync
+        self.last_batch = {}
+        self.last_size = {}
+        self.records = 0
+
+        if os.path.exists(path):
+            with open(path, newline = "", encoding = "utf-8") as file:
+                for row in csv.DictReader(file):
+                    source, batch = row["source"], int(row["batch"])
+
+                    if batch > self.last_batch.get(source, -1):
+                        self.last_batch[source] = batch
+                        self.last_size[source] = 0
+                    if batch == self.last_batch[source]:
+                        self.last_size[source] += 1
+
+        new_file = not os.path.exists(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        self.file = open(path, "a", newline = "", encoding = "utf-8")
+        self.writer = csv.writer(self.file)
+
+        if new_file:
+            self.writer.writerow(collected_columns)
+
+
+    def append(self,
+               source: str,
+               batch: int,
+               records: List[Dict[str, Any]]) -> bool:
+        """Appends a batch of records unless it was stored before. Returns whether it was appended."""
+
+        if batch <= self.last_batch.get(source, -1):
+            if batch == self.last_batch[source] and len(records) != self.last_size[source]:
+                logging.error(f"Batch {batch} of {source} was resent with {len(records)} instead of {self.last_size[source]} records, "
+                              f"the resent records are not stored")
+            return False
+
+        for record in records:
+            values = (record.get(column) for column in result_columns)
+            self.writer.writerow([source, batch] + [tuple(value) if isinstance(value, list) else value for value in values])
+
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+        self.last_batch[source] = batch
+        self.last_size[source] = len(records)
+        self.records += len(records)
+        return True
+
+
+    def close(self) -> None:
+        """Closes the file."""
+
+        self.file.close()
+
+
+
+async def handle_station(reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter,
+                         store: CollectedResults,
+                         executor: concurrent.futures.Executor) -> None:
+    """
+    Serves the connection of one station: every line is a batch as sent by NetworkSink, which is stored and confirmed
+    with its sequence number. Batches are stored on the executor, so writing and forcing them to disk doesn't hold up
+    the other stations.
+    """
+
+    loop = asyncio.get_running_loop()
+    peer = writer.get_extra_info("peername") or "unix socket"
+    logging.info(f"Station connected: {peer}")
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                message = json.loads(line)
+                stored = await loop.run_in_executor(executor,
+                                                    store.append,
+                                                    message["source"],
+                                                    message["sequence"],
+                                                    message["records"])
+            except (ValueError, KeyError) as e:
+                logging.error(f"Invalid batch from {peer}: {e}")
+                writer.write(b'{"error":"invalid batch"}\n')
+            else:
+                if stored:
+                    logging.info(f"Stored {len(message['records'])} records of {message['source']}, {store.records} in total")
+                writer.write(json.dumps({"ack": message["sequence"]}).encode("utf-8") + b"\n")
+
+            await writer.drain()
+
+    except ConnectionError as e:
+        logging.warning(f"Connection to {peer} lost: {e}")
+
+    finally:
+        writer.close()
+        logging.info(f"Station disconnected: {peer}")
+
+
+
+async def serve(store: CollectedResults,
+                host: str = "127.0.0.1",
+                port: int = 8765,
+                unix: Optional[str] = None) -> None:
+    """
+    Accepts stations on a TCP port or, if unix is given, on a Unix socket at that path, until the process is stopped.
+    """
+
+    # A single writer thread stores the batches one after another, in the order they arrive
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+        handler = functools.partial(handle_station, store = store, executor = executor)
+
+        if unix is not None:
+            server = await asyncio.start_unix_server(handler, path = unix)
+        else:
+            server = await asyncio.start_server(handler, host = host, port = port)
+
+        logging.info(f"Collecting into {store.path} at {unix or f'{host}:{port}'}")
+
+        async with server:
+            await server.serve_forever()
+
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Runs the collector until it is interrupted.
+    """
+
+    parser = argparse.ArgumentParser(description = "Collector of the trial records of many stations.")
+    parser.add_argument("--host", default = "127.0.0.1", help = "Address to listen on. Use 0.0.0.0 to accept other machines of the lab network.")
+    parser.add_argument("--port", type = int, default = 8765, help = "TCP port to listen on.")
+    parser.add_argument("--unix", help = "Path of a Unix socket to listen on instead of a TCP port.")
+    parser.add_argument("--output", default = os.path.join("results", "collected_results.csv"), help = "Path of the consolidated csv file.")
+    parser.add_argument("--no-fsync", action = "store_true", help = "Don't force every batch to disk before confirming it.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO,
+                        format = "%(asctime)s %(levelname)s %(message)s")
+
+    store = CollectedResults(args.output,
+                             fsync = not args.no_fsync)
+    try:
+        asyncio.run(serve(store,
+                          host = args.host,
+                          port = args.port,
+                          unix = args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+
+if __name__ == "__main__":
+    main()
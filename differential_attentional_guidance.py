@@ -1,40 +1,128 @@
 # The experiment is based on experiment 1A in Eastwood, Smilek, & Merikle (2001)
 
-from psychopy import event, gui, core, visual, monitors
+from __future__ import annotations
+
 import os
-import pandas as pd
 import time
 import random
-import numpy as np
 import logging
-from typing import Union, Optional, Tuple, List, Dict, Any
+import functools
+import importlib
+import math
+import argparse
+import threading
+import queue
+import atexit
+import csv
+import json
+import zlib
+import glob
+import shutil
+import socket
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from types import SimpleNamespace
+from typing import Union, Optional, Tuple, List, Dict, Any, Callable, Iterable
+
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported when one of its attributes is used for the first time.
+    Every attribute is cached on the stand-in after its first lookup, so later lookups cost no more than on the module itself.
+    The stand-in has no public attributes of its own, so it can't shadow any of the module's.
+    This keeps importing this script fast, as PsychoPy, pandas and NumPy take seconds to import.
+
+    Parameters
+    ----------
+    module_name : str
+        The full name of the module, e.g. "psychopy.visual".
+    """
+
+    def __init__(self, 
+                 module_name: str) -> None:
+
+        self.__dict__["_module_name"] = module_name
+
+
+    def _lazy_load(self) -> Any:
+        """Imports the module and returns it."""
+
+        return importlib.import_module(self._module_name)
+
+
+    def __getattr__(self, 
+                    attribute: str) -> Any:
+
+        value = getattr(self._lazy_load(), attribute)
+        self.__dict__[attribute] = value
+
+        return value
+
+
+
+event = LazyModule("psychopy.event")
+gui = LazyModule("psychopy.gui")
+core = LazyModule("psychopy.core")
+visual = LazyModule("psychopy.visual")
+monitors = LazyModule("psychopy.monitors")
+hardware_keyboard = LazyModule("psychopy.hardware.keyboard")
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+cProfile = LazyModule("cProfile")
+pstats = LazyModule("pstats")
    
 
 # !!!Enter your monitor setting here before running the code!!!
-my_monitor = monitors.Monitor("")
-my_monitor.setWidth(53.5)                               # Enter the physical width of your monitor in centimeters. 
-my_monitor.setSizePix([1920, 1080])                     # Enter the screen resolution in pixels (width, height).
+monitor_width_cm = 53.5                                 # Enter the physical width of your monitor in centimeters. 
+monitor_size_pix = [1920, 1080]                         # Enter the screen resolution in pixels (width, height).
 
-pix_per_cm = my_monitor.getSizePix()[0] / my_monitor.getWidth()
-height_cm = my_monitor.getSizePix()[1] / pix_per_cm
+pix_per_cm = monitor_size_pix[0] / monitor_width_cm
+height_cm = monitor_size_pix[1] / pix_per_cm
 
 
 # Modify these values in case the sizes of different elements need to be adjusted. (Note: The unit is centimeters.)
 spacing = 2.12                                # Distance between the calculated positions
 text_height = 0.5                             # Height of the text
+text_pool_size = 256                          # Number of laid out texts kept for reuse by present_text. The least recently used ones are discarded first.
+page_font = "arial.ttf"                       # Font used to pre-render the instruction, block and end pages. Falls back to Pillow's default font if not found, which needs Pillow 10.1 or newer.
+page_wrap_width = 15                          # Width in centimeters after which the lines of pre-rendered pages wrap, like the default of TextStim.
 stim_size = 1.3                               # Diameter of the targets, distractors and size of the rectangles
 
+# How the smileys of a search display are drawn. "vector" draws every smiley from its own circles and shapes (four draw calls per item),
+# "batched" packs all heads, eyes and mouths of a display into a few element arrays, so the number of draw calls doesn't grow with the set size.
+# "atlas" renders each of the three faces once into a texture atlas and draws a display as textured quads.
+# Both also draw the grid rectangles as one element array. Use one of them for large grids and set sizes, which "vector" can't draw within a frame.
+render_mode = "vector"
+batch_mask_res = 256                          # Resolution (power of two) of the masks used for heads and mouths in the "batched" render mode
+atlas_res = 128                               # Resolution (power of two) of every face in the texture atlas of the "atlas" render mode
+
 # The numbers added as comments below reflect the amount of training trials, that have to be answered correctly and the trails per condition that will be used when testing subjects.
 # For the sake of testing, lower trial numbers are advised. Feel free to play around with the amount of rows, columns, trials and the set sizes (under the noted constraints).
 # Depending on the screen size the spacing and stim_size might need adjustments to fit everything on the screen for more rows or columns.
 rows = 6                                     # Rows and cols numbers will be used to generate a rows times cols matrix for the possible stimulus locations.
-cols = 6                                     # Valid values for cols and rows range from 1 to 9. Higher values would require modifications to the input collection.
+cols = 6                                     # Up to 9 rows or columns are answered with a single key, more (e.g. 15 x 15) with a typed number confirmed by grid_confirm_key.
+grid_confirm_key = "return"                  # Key confirming a typed row or column number in grids with more than 9 rows or columns
+grid_delete_key = "backspace"                # Key deleting the last typed digit of a row or column number
 set_sizes = [7, 11, 15, 19]                  # Set sizes (amount of items); neither value should exceed the amount of possible positions (cols * rows)
 training_set_size = 3                        # Set size for training phase
 training_trials = 4                          # 2
 target_states = ["positive", "negative"]     # Possible target types (emotional expressions)
 trials_per_condition = 30                    # 2
 
+schedule_seed = None                         # Seed of the trial schedule. None draws a fresh seed, that is saved with the schedule.
+schedule_file = None                         # Path of a saved schedule (.npz) to rerun a session exactly. None generates a new schedule.
+max_condition_run = 2                        # Longest run of consecutive trials with the same set size and target state. None leaves runs unconstrained.
+
+# "fixed" runs every trial of the schedule. "adaptive" assigns every trial to the set size and target state that most narrow the confidence interval
+# of the least precise search slope and ends the session once all slopes are precise enough (see AdaptiveAllocator). Blocks and results stay the same.
+allocation = "fixed"
+adaptive_ci_width = 0.010                    # Width in seconds per item of the 95% confidence interval every slope needs, before the adaptive session ends
+adaptive_min_trials = 5                      # Trials every combination of set size and target state gets, before the adaptive allocation starts
+adaptive_max_trials = None                   # Maximum number of main trials in the adaptive allocation. None allows as many as the fixed schedule has.
+
 continue_key = "b"                           # Key to advance the instruction page, display next stimulus display and signaling target has been found.
 return_key = "v"                             # Key to go back to the previous instruction page.
 
@@ -50,12 +138,51 @@ info = {
 color = (0.8, 0.8, 0.8)
 color2 = (0.8, -0.8, -0.8)
 
+# Saving of the results. "async" hands every trial to a background writer thread that appends it to an open file,
+# "sync" saves every trial directly with save_experiment_data.
+result_writer = "async"
+results_format = "csv"                      # "csv" writes one csv file per session, "columnar" writes a directory with one typed binary file per column (see ColumnarResults).
+flush_policy = "trial"                      # When the background writer flushes the file to disk: after every "trial", at the end of every "block" or every flush_interval seconds ("time").
+flush_interval = 5.0                        # Seconds between flushes with the "time" flush policy
+fsync_results = True                        # If True, every flush is followed by an fsync, so the data survives a crash of the machine.
+journal_sessions = True                     # If True, the schedule and every completed trial are recorded in a journal, from which a crashed session can be resumed (see SessionJournal).
+
+# Optional network sink, which additionally pushes every trial record to a collector process (see collector.py and NetworkSink).
+# The local results are written as usual, so stations keep working while the collector is down.
+collector_address = None                    # "host:port" or "unix:<path>" of the collector. None disables the sink.
+collector_batch_size = 20                   # Records sent at once. Smaller batches are sent at block ends and after collector_flush_interval seconds.
+collector_flush_interval = 10.0             # Seconds a record waits at most for its batch to fill up
+collector_retry_interval = 5.0              # Seconds between reconnection attempts while the collector is unreachable
+collector_max_buffer = 100000               # Records kept while the collector is unreachable. The oldest are dropped beyond this.
+
+# Running statistics of the session, updated after every trial and summarized at every block end (see OnlineStatistics).
+outlier_rt_range = (0.15, 5.0)              # Reaction times in seconds outside this range count as outliers
+outlier_sd = 3.0                            # Reaction times further than this many standard deviations from the mean of their cell count as outliers
+outlier_min_trials = 10                     # Trials a cell needs before the standard deviation criterion applies
+
+# Opt-in profiling of a session (see SessionProfiler), also enabled by the --profile flag or the environment variable DAG_PROFILE=1.
+# Writes cProfile stats of every phase, the stage timings of every trial and tracemalloc snapshots at block boundaries to results/profile_subject_<sub_id>.
+profiling = os.environ.get("DAG_PROFILE", "0") not in ("", "0")
+profile_top = 30                            # Entries in the text summaries of the cProfile stats and of the memory growth between snapshots
+
 # Timings
 feedback_delay = 0.5
 feedback_duration = 1
 skip_prot = 0.5                             # Delay to avoid accidental skipping of instruction or block messages. If annoying, set it to 0.
 
 
+# How rows and columns are answered, by single keys up to 9 and by typed numbers beyond (see get_grid_response)
+if max(rows, cols) <= 9:
+    grid_instruction = f"Nutzen Sie dazu die Tasten '1' bis '{max(rows, cols)}' auf der Tastatur."
+else:
+    grid_instruction = "".join(f"Die {name} geben Sie mit den Tasten '1' bis '{n_options}' an. "
+                               for name, n_options in (("Zeile", rows), ("Spalte", cols)) if n_options <= 9)
+    grid_instruction += (f"Die Nummer {'der Zeile und der Spalte' if min(rows, cols) > 9 else 'der Zeile' if rows > 9 else 'der Spalte'}"
+                         f" tippen Sie mit den Zifferntasten ein, sie wird unter dem Raster angezeigt."
+                         f" Bestätigen Sie die Nummer mit der Taste '{grid_confirm_key.upper()}',"
+                         f" mit der Taste '{grid_delete_key.upper()}' löschen Sie die zuletzt getippte Ziffer.")
+
+
 instruction = [
                 "Willkommen zum Experiment!"
                 "\n\nLesen Sie sich diese Instruktion bitte sorgfältig durch:"
@@ -67,7 +194,7 @@ instruction = [
 
                 "Danach wird ein Raster über alle möglichen Positionen gelegt, dessen Zeilen und Reihen nummeriert sind."
                 "\n\nIhre zweite Aufgabe ist es dann zuerst die Zeile und danach die Spalte des Rasters anzugeben, an der sich dieser eine abweichende Smiley auf dem Bildschirm befunden hat."
-                f"\n\nNutzen Sie dazu die Tasten '1' bis '{max(rows,cols)}' auf der Tastatur. Hierbei kommt es nicht darauf an so schnell wie möglich zu antworten!"
+                f"\n\n{grid_instruction} Hierbei kommt es nicht darauf an so schnell wie möglich zu antworten!"
                 "\n\nArbeiten Sie dabei aber bitte so genau wie möglich."
                 "\n\nAls Hilfestellung, ob gerade die Zeile oder Spalte angegeben werden soll, wird die jeweilige Nummerierung farblich hervorgehoben."
                 f"\n\nDrücken Sie die Taste '{continue_key.upper()}' um fortzufahren ..."
@@ -90,777 +217,4237 @@ instruction = [
 
 
 
+atlas_expressions = ("positive", "negative", "neutral")    # Order of the faces in the texture atlas
+
+
+
 # Functions  
-def present_text(win: visual.Window, 
-                 text: str, 
-                 pos: Tuple[float, float] = (0, 0), 
-                 height: float = text_height,
-                 textColor: Union[str, Tuple[float, float, float]] = color, 
-                 flip: bool = False) -> None:
+class VirtualClock:
     """
-    Draws a text stimulus in a window and optionally flips the window to make the text visible.
-
-    Parameters
-    ----------
-    win : visual.Window
-        The window where the text stimulus will be presented.
-    text : str
-        The text content to be displayed.
-    pos : tuple, optional
-        The (x, y) position where the text will be drawn. Defaults to (0, 0), the center of the screen.
-    height: float, optional
-        The text height in centimeters. Defaults to the global text_height variable.
-    textColor : str or list, optional
-        The color of the text. Defaults to the global "color" variable.
-    flip : bool, optional
-        If True, the window will be flipped after drawing the text, making it visible on the screen. Defaults to False.
+    A clock that only moves when it is told to, used in headless mode so that waits and responses take no real time.
     """
 
-    text = visual.TextStim(
-        win,
-        units = "cm",
-        height = height,
-        color = textColor,
-        pos = pos,  
-        text = text
-    )
-    text.draw()
+    def __init__(self) -> None:
 
-    if flip:
-        win.flip()
+        self.time = 0.0
 
 
+    def getTime(self) -> float:
+        """Returns the current virtual time in seconds."""
 
-def present_instructions(win: visual.Window, 
-                         instructions: List[str], 
-                         continue_key: str, 
-                         return_key: str) -> None:
+        return self.time
+
+
+    def advance(self, 
+                seconds: float) -> None:
+        """Moves the clock forward by the given number of seconds."""
+
+        self.time += max(seconds, 0)
+
+
+
+class HeadlessWindow:
     """
-    Displays a sequence of instructions on the screen and allowing the user to navigate through them using specified keys.
+    Stands in for the PsychoPy window in headless mode. Nothing is drawn; flips move the virtual clock to the next frame
+    and run the functions registered with callOnFlip, and the search display of the current trial is remembered
+    in search_display, so the simulated participant can respond to it.
 
     Parameters
     ----------
-    win : visual.Window
-        The window where the instructions will be presented.
-    instructions : list of str
-        A list of instruction strings to be displayed, one at a time.
-    continue_key : str
-        The key that advances to the next instruction in the sequence.
-    return_key : str
-        The key that returns to the previous instruction, allowing the user to review.
+    participant : SimulatedParticipant
+        The simulated participant answering all key requests.
+    frame_rate : float, optional
+        The simulated refresh rate in Hz. Defaults to 60.
     """
 
-    current_instr = 0
+    def __init__(self,
+                 participant: SimulatedParticipant,
+                 frame_rate: float = 60) -> None:
 
-    while current_instr < len(instructions):
+        self.size = monitor_size_pix
+        self.clock = VirtualClock()
+        self.frame_period = 1 / frame_rate
+        self.last_flip = 0.0
+        self.flip_callbacks = []
+        self.search_display = None
 
-        present_text(win, 
-                     text = instructions[current_instr],
-                     flip = True)
-        
-        logging.info(f"Presenting instruction {current_instr + 1}")
-        core.wait(skip_prot)
+        self.participant = participant
+        participant.win = self
 
-        key = event.waitKeys(keyList = [continue_key, return_key])
 
-        if continue_key in key:
-            current_instr += 1
+    def callOnFlip(self, 
+                   function: Callable, 
+                   *args, 
+                   **kwargs) -> None:
+        """Registers a function to be called right after the next flip."""
 
-        elif return_key in key:
-            if current_instr > 0:
-                current_instr -= 1
+        self.flip_callbacks.append((function, args, kwargs))
 
 
+    def flip(self, 
+             clearBuffer: bool = True) -> float:
+        """Moves the virtual clock to the next frame, runs the registered functions and returns the flip time."""
 
-def arc_vertices(radius: float, 
-                 start_angle: float, 
-                 end_angle: float) -> List[Tuple[float, float]]:
-    """
-    Helper function to create vertices for a circular arc given a radius and angular range, 
-    that are used for the mouth of the smiley stimuli, which will be the targets.
+        self.last_flip = (math.floor(self.clock.getTime() / self.frame_period) + 1) * self.frame_period
+        self.clock.time = self.last_flip
 
-    Parameters
-    ----------
-    radius : float
-        The radius of the arc (distance from the center).
-    start_angle : float
-        The starting angle of the arc, in degrees.
-    end_angle : float
-        The ending angle of the arc, in degrees.
+        callbacks, self.flip_callbacks = self.flip_callbacks, []
+        for function, args, kwargs in callbacks:
+            function(*args, **kwargs)
 
-    Returns
-    -------
-    arc : list of tuple
-        A list of (x, y) vertices representing the arc in Cartesian coordinates.
-    """
-    
-    # Converting degrees to radians, because the linspace function won't take degrees as a unit
-    start_rad = np.deg2rad(start_angle)
-    end_rad = np.deg2rad(end_angle)
-    
-    # Calculates angles between start and end_rad
-    angles = np.linspace(start_rad, 
-                         end_rad, 
-                         25) 
-    
-    # Calculates the Cartesian coordinates for every angle
-    arc = [(radius * np.cos(angle), radius * np.sin(angle)) for angle in angles]
+        return self.last_flip
 
-    return arc
 
+    def clearBuffer(self) -> None:
+        """Does nothing, as nothing is drawn."""
 
 
-def preload_stimuli(win: visual.Window, 
-                    set_size: int) -> List[Dict[str, Any]]:
+    def close(self) -> None:
+        """Does nothing, as there is no window to close."""
+
+
+
+class SimulatedParticipant:
     """
-    Preloads a list of smiley stimuli built out of circles and shapes, which can be both targets or 
-    distractors. These will be reused across trials with just their position and expression beeing updated
-    by another function.
+    Responds to every key request of a headless session like a participant. Reaction times to the search display follow
+    intercept + slope * set_size plus Gaussian noise, with a slope per target state. Row and column are answered correctly,
+    except for a random error with the probability error_rate. All other screens are continued after think_time seconds.
 
     Parameters
     ----------
-    win : visual.Window
-        The window where the stimuli will be displayed.
-    set_size : int
-        The number of smiley stimuli to preload. This defines the number of visual elements that will be created and stored.
-
-    Returns
-    -------
-    stimuli : list of dict
-        A list of dictionaries where each dictionary contains the visual components (head, eyes, mouth) of a smiley face.
+    intercept : float, optional
+        The reaction time in seconds without any distractors. Defaults to 0.45.
+    slopes : dict, optional
+        The additional seconds per item of the display for every target state. Defaults to 20 ms for "positive" and 12 ms for "negative" targets.
+    noise : float, optional
+        The standard deviation of the reaction times in seconds. Defaults to 0.1.
+    error_rate : float, optional
+        The probability of answering the row or the column wrong. Defaults to 0.02.
+    think_time : float, optional
+        The seconds taken to continue any other screen. Defaults to 0.3.
+    seed : int, optional
+        The seed of the participant's random number generator.
     """
 
-    try:
-        radius_head = stim_size / 2
-        radius_eye = stim_size * 0.0577
-        mouth_radius = stim_size * 0.2885
-        line_width_cm = stim_size * 0.0577
-        line_width_pix = line_width_cm * pix_per_cm                # Necessary because lineWidth only takes pix as a unit
-        
-        positive_mouth_vertices = arc_vertices(mouth_radius, 
-                                               195, 
-                                               345)
-        
-        negative_mouth_vertices = arc_vertices(mouth_radius, 
-                                               15, 
-                                               165)
-    
-        stimuli = []
-        for _ in range(set_size):
-
-            stimulus = {
-                "head": visual.Circle(win = win, 
-                                    lineColor = color, 
-                                    fillColor = None, 
-                                    radius = radius_head,
-                                    lineWidth = line_width_pix),
+    def __init__(self,
+                 intercept: float = 0.45,
+                 slopes: Optional[Dict[str, float]] = None,
+                 noise: float = 0.1,
+                 error_rate: float = 0.02,
+                 think_time: float = 0.3,
+                 seed: Optional[int] = None) -> None:
 
-                "left_eye": visual.Circle(win = win, 
-                                        lineColor = color, 
-                                        fillColor = color, 
-                                        radius = radius_eye),
+        self.intercept = intercept
+        self.slopes = slopes or {"positive": 0.020, "negative": 0.012}
+        self.noise = noise
+        self.error_rate = error_rate
+        self.think_time = think_time
+        self.rng = random.Random(seed)
 
-                "right_eye": visual.Circle(win = win, 
-                                        lineColor = color, 
-                                        fillColor = color, 
-                                        radius = radius_eye),
+        self.win = None
+        self.grid_answers = []
 
-                "mouth_positive": visual.ShapeStim(win = win, 
-                                                vertices = positive_mouth_vertices, 
-                                                lineWidth = line_width_pix, 
-                                                lineColor = color, 
-                                                closeShape = False),
 
-                "mouth_negative": visual.ShapeStim(win = win, 
-                                                vertices = negative_mouth_vertices, 
-                                                lineWidth = line_width_pix, 
-                                                lineColor = color, 
-                                                closeShape = False),
+    def answer(self, 
+               correct: int, 
+               n_options: int) -> int:
+        """Returns the correct row or column number, or with the probability error_rate another one."""
 
-                "mouth_neutral": visual.Line(win = win, 
-                                            start = (0, 0), 
-                                            end = (0, 0), 
-                                            lineWidth = line_width_pix, 
-                                            lineColor = color)
-            }
-            stimuli.append(stimulus)
+        if n_options > 1 and self.rng.random() < self.error_rate:
+            return self.rng.choice([i for i in range(1, n_options + 1) if i != correct])
 
-        logging.info(f"Preloaded {set_size} stimuli")
-        return stimuli
+        return correct
 
-    except Exception as e:
-        logging.error(f"Error preloading stimuli: {e}")
-    
 
+    def clearEvents(self, 
+                    eventType: Optional[str] = None) -> None:
+        """Does nothing, as simulated keys are never pressed too early."""
 
-def calculate_positions(win: visual.Window, 
-                        rows: int, 
-                        cols: int) -> List[Tuple[float, float]]:
-    """
-    Calculates and returns a list of rows times cols (x, y) positions in a rectangular grid, spacing value, 
-    both on the x- and y-axis, apart from each other and centered on the screen, 
-    that will be used as positions for the stimulus presentation and localization task.
 
-    Parameters
-    ----------
-    win : visual.Window
-        The Window!
-    rows : int
-        The number of rows in the grid.
-    cols : int
-        The number of columns in the grid.
+    def waitKeys(self, 
+                 keyList: Optional[List[str]] = None, 
+                 **kwargs) -> List[SimpleNamespace]:
+        """Responds to a key request and moves the virtual clock to the time of the key press."""
 
-    Returns
-    -------
-    positions : list of tuple
-        A list of (x, y) coordinates for each position in the grid.
-    """
+        win = self.win
+        display = win.search_display
 
-    try:
-        screen_width_cm = win.size[0] / pix_per_cm
-        screen_height_cm = win.size[1] / pix_per_cm
+        if display is not None and display["key"] in keyList:
+            rt = self.intercept + self.slopes.get(display["target_state"], 0) * display["set_size"] + self.rng.gauss(0, self.noise)
+            rt = max(rt, 0.15)
 
-        grid_width = (cols - 1) * spacing
-        grid_height = (rows - 1) * spacing
+            self.grid_answers = (response_keys(self.answer(display["target_row"], rows), rows) 
+                                 + response_keys(self.answer(display["target_col"], cols), cols))
+            win.search_display = None
 
-        offset_x = (screen_width_cm - grid_width) / 2
-        offset_y = (screen_height_cm - grid_height) / 2
+            key, t_down = display["key"], win.last_flip + rt
 
-        positions = []
+        elif self.grid_answers and self.grid_answers[0] in keyList:
+            key, t_down = self.grid_answers.pop(0), win.clock.getTime() + self.think_time
 
-        for row in range(rows):
-            for col in range(cols):
-                x = offset_x + col * spacing - (screen_width_cm / 2)
-                y = offset_y + row * spacing - (screen_height_cm / 2)
-                positions.append((x, y))
+        else:
+            key, t_down = keyList[0], win.clock.getTime() + self.think_time
 
-        logging.info(f"{len(positions)} positions calculated")
+        win.clock.advance(t_down - win.clock.getTime())
 
-        return positions
-    
-    except Exception as e:
-        logging.error(f"Error calculating positions for {rows} rows and {cols} columns: {e}")
+        return [SimpleNamespace(name = key, tDown = t_down, rt = t_down - win.last_flip)]
 
 
 
-def draw_stimulus(stimulus: Dict[str, Any], 
-                  expression: str, 
-                  pos: Tuple[float, float]) -> None:
+def is_headless(win: Any) -> bool:
     """
-    Updates the position and expression of a preloaded smiley stimulus and draws it.
-
-    Parameters
-    ----------
-    stimulus : dict
-        A dictionary representing the smiley stimulus containing all the parts.
-    expression : str
-        The emotional expression of the stimulus. Should be either "positive", "negative", or "neutral".
-    pos : tuple
-        The (x, y) position on the screen where the stimulus will be displayed.
+    Returns True if the experiment runs headless, with a HeadlessWindow instead of a PsychoPy window.
     """
 
-    eye_x_offset = stim_size * 0.1538
-    eye_y_offset = stim_size * 0.1923
-    mouth_length = stim_size * 0.2885
-    mouth_neu_offset = stim_size * 0.1154
-    mouth_neg_offset = stim_size * 0.3077
-    mouth_pos_offset = stim_size * 0.0192
+    return isinstance(win, HeadlessWindow)
 
-    stimulus["head"].pos = pos
-    stimulus["head"].draw()
 
-    stimulus["left_eye"].pos = (pos[0] - eye_x_offset, pos[1] + eye_y_offset)
-    stimulus["left_eye"].draw()
 
-    stimulus["right_eye"].pos = (pos[0] + eye_x_offset, pos[1] + eye_y_offset)
-    stimulus["right_eye"].draw()
+def get_time(win: Any) -> float:
+    """
+    Returns the current time in the time base of win.flip, which is the virtual clock in headless mode.
+    """
 
-    if expression == "positive":
-        stimulus["mouth_positive"].pos = (pos[0], pos[1] + mouth_pos_offset)
-        stimulus["mouth_positive"].draw()
+    if is_headless(win):
+        return win.clock.getTime()
 
-    elif expression == "negative":
-        stimulus["mouth_negative"].pos = (pos[0], pos[1] - mouth_neg_offset)
-        stimulus["mouth_negative"].draw()
+    return core.getTime()
 
-    else:
-        stimulus["mouth_neutral"].start = (pos[0] - mouth_length, pos[1] - mouth_neu_offset)
-        stimulus["mouth_neutral"].end = (pos[0] + mouth_length, pos[1] - mouth_neu_offset)
-        stimulus["mouth_neutral"].draw()
 
 
+idle_tasks = []                             # Functions doing a small piece of background work per call on the main thread, see run_idle_task
+idle_margin = 0.02                          # Seconds before the end of a wait, after which no more idle tasks are started
+poll_interval = 0.002                       # Seconds between two polls of the keyboard during waits, see FrameScheduler
 
-def load_rectangles(win: visual.Window,
-                    positions: List[Tuple[float, float]]) -> None:
+
+
+def run_idle_task() -> bool:
     """
-    Creates a rectangle for every positions.
+    Runs one step of the first registered idle task. A task is a function doing a small piece of work per call,
+    that returns True as long as work remains. Finished tasks are removed.
 
-    Parameters
-    ----------
-    win: visual.Window
-        THe window the rectangles will be displayed in.
-    positions : list of tuple
-        A list of (x, y) coordinates representing the grid positions.
+    Returns
+    -------
+    bool
+        True if a step was run, False if there was nothing to do.
     """
-    try:
-        rectangles = []
 
-        rect_size = stim_size
+    if not idle_tasks:
+        return False
 
-        for pos in positions:
-            rectangle = visual.Rect(
-                win = win,
-                units = "cm",
-                size = (rect_size, rect_size),
-                fillColor = color,
-                pos = pos
-                )
-            rectangles.append(rectangle)
+    task = idle_tasks[0]
 
-        logging.info(f"{len(rectangles)} rectangles loaded")
-        return rectangles
-    
+    try:
+        more_work = task()
     except Exception as e:
-        logging.info(f"Error loading {len(positions)} rectangles: {e}")
+        logging.error(f"Error in idle task: {e}")
+        more_work = False
 
+    if not more_work:
+        idle_tasks.remove(task)
 
+    return True
 
-def display_grid(win: visual.Window, 
-                 positions: List[Tuple[float, float]], 
-                 rectangles: List[visual.Rect],
-                 row_color: Union[str, Tuple[float, float, float]], 
-                 col_color: Union[str, Tuple[float, float, float]]) -> None:
+
+
+class FrameScheduler:
     """
-    Displays the rectangle grid at all possible positions as well as the (colored) row 
-    and column numbers for the localization task.
+    Runs the waits of the experiment flow cooperatively instead of blocking. A wait is a loop that polls its input every
+    interval seconds (several times per frame) and gives the time until the next poll to the idle tasks. The rest of the time it sleeps, where core.wait and event.waitKeys would keep a core busy.
+    Timed waits end with core.wait for their last idle_margin seconds, so their duration doesn't depend on the sleep granularity of the OS.
+    As the flow only changes the screen after a wait returned, the participant sees the same as with blocking waits.
 
     Parameters
     ----------
-    win : visual.Window
-        The window where the grid and numbers will be displayed.
-    positions : list of tuple
-        A list of (x, y) coordinates representing the grid positions.
-    rectangles : list of visual.Rect
-        A list of visual.Rect objects that will be displayed at the positions.
-    row_color : str or list
-        The color used for the row labels.
-    col_color : str or list
-        The color used for the column labels.
+    interval : float, optional
+        The seconds between polls. Defaults to poll_interval.
+    clock : callable, optional
+        The clock providing the current time. Defaults to core.getTime, the time base of win.flip.
     """
 
-    # Extracts the x-coordinates of the "first" row of the grid/matrix positions and 
-    # displays the column numbers spacing value below the "first" row
-    col_positions = [pos[0] for pos in positions[:cols]]
+    def __init__(self,
+                 interval: Optional[float] = None,
+                 clock: Optional[Callable[[], float]] = None) -> None:
 
-    for i, pos in enumerate(col_positions):
-        present_text(win, 
-                     text = str(i + 1), 
-                     pos = (pos, positions[0][1] - spacing), 
-                     textColor = col_color)
+        self.interval = interval
+        self.clock = clock
 
-    # Extracts the y-coordinates of the "first" column of the grid/matrix positions and 
-    # displays the row numbers the spacing value to the left of the "first" column
-    row_positions = [pos[1] for pos in positions[::cols]]
 
-    for i, pos in enumerate(row_positions):
-        present_text(win, 
-                     text = str(i + 1), 
-                     pos = (positions[0][0] - spacing, pos), 
-                     textColor = row_color)
+    def now(self) -> float:
+        """Returns the current time of the scheduler's clock."""
 
+        return self.clock() if self.clock is not None else core.getTime()
 
-    for rect in rectangles:
-        rect.draw()
 
-    win.flip()
+    def run(self,
+            poll: Optional[Callable[[], Any]] = None,
+            deadline: Optional[float] = None,
+            run_idle: bool = True) -> Any:
+        """
+        Polls until poll returns a true value or the deadline has passed, running idle tasks in between.
 
+        Parameters
+        ----------
+        poll : callable, optional
+            Checks the input, e.g. the keyboard. None waits for the deadline.
+        deadline : float, optional
+            The time on the scheduler's clock at which to return. None waits for the input only.
+        run_idle : bool, optional
+            Whether idle tasks may run. Defaults to True.
 
+        Returns
+        -------
+        any
+            The value returned by poll, or None if the deadline passed.
+        """
 
-def get_grid_response(win: visual.Window, 
-                      positions: List[Tuple[float, float]],
-                      rectangles: List[visual.Rect],
-                      row_color: Union[str, Tuple[float, float, float]] = "White", 
-                      col_color: Union[str, Tuple[float, float, float]] = "White",
-                      is_training: bool = False,
-                      row_response: bool = False) -> str:
+        interval = self.interval or poll_interval
+
+        while True:
+            if poll is not None:
+                result = poll()
+                if result:
+                    return result
+
+            now = self.now()
+            if deadline is not None and now >= deadline:
+                return None
+
+            # The last stretch of a timed wait is left to core.wait, which spins instead of relying on the granularity of time.sleep,
+            # so the wait ends on time (time.sleep can take up to 15 ms longer on Windows)
+            if poll is None and deadline is not None and deadline - now <= idle_margin:
+                core.wait(deadline - now)
+                return None
+
+            next_poll = now + interval if deadline is None else min(now + interval, deadline)
+
+            # Idle tasks get the time until the next poll, but none is started within idle_margin of the deadline
+            while (run_idle 
+                   and self.now() < next_poll 
+                   and (deadline is None or deadline - self.now() > idle_margin) 
+                   and run_idle_task()):
+                pass
+
+            remaining = next_poll - self.now()
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+
+scheduler = FrameScheduler()
+
+
+
+def wait(win: Any, 
+         seconds: float) -> None:
     """
-    Collects the participant's response for either row or column selection and displays the grid.
+    Waits for the given number of seconds with the scheduler, which runs idle tasks in the meantime,
+    as long as at least idle_margin seconds remain. In headless mode the wait only moves the virtual clock, 
+    after all idle tasks were run to completion, as waiting costs no time there.
 
     Parameters
     ----------
-    win : visual.Window
-        The window where the grid will be displayed.
-    positions : list of tuple
-        The list of (x, y) positions for the grid.
-    rectangles : list of visual.Rect
-        A list of visual.Rect objects that will be displayed at the positions.
-    row_color : str, optional
-        Color of the row numbers displayed on the grid. Defaults to "White".
-    col_color : str, optional
-        Color of the column numbers displayed on the grid. Defaults to "White".
-    is_training : bool, optional
-        Whether the trial is part of a training phase. Defaults to False.
-    row_response : bool, optional
-        Indicates whether the response is for a row (True) or a column (False). Defaults to False.
+    win : visual.Window or HeadlessWindow
+        The window of the experiment.
+    seconds : float
+        The time to wait in seconds.
+    """
+
+    if is_headless(win):
+        while run_idle_task():
+            pass
+
+        win.clock.advance(seconds)
+        return
+
+    scheduler.run(deadline = scheduler.now() + seconds)
+
+
+
+def wait_keys(win: Any, 
+              key_list: Union[str, List[str]],
+              timestamped: bool = False,
+              run_idle: bool = True) -> List[Union[str, Tuple[str, float]]]:
+    """
+    Waits until one of the given keys is pressed and returns the names of the pressed keys.
+    Like event.waitKeys, only keys pressed after the call count, so keys pressed too early (e.g. during skip_prot)
+    or left in the buffer (e.g. the key of the search display, which is read from the hardware keyboard) are discarded.
+    The keyboard is polled by the scheduler, which runs idle tasks between the polls.
+    In headless mode the simulated participant answers instead.
+
+    Parameters
+    ----------
+    win : visual.Window or HeadlessWindow
+        The window of the experiment.
+    key_list : str or list of str
+        The keys to wait for.
+    timestamped : bool, optional
+        If True, every key is returned as (name, time) with the time of the key press on the clock of the flip timestamps. Defaults to False.
+    run_idle : bool, optional
+        Whether idle tasks may run while waiting. Must be False while the back buffer holds a prepared display,
+        as an idle task may render offscreen. Defaults to True.
 
     Returns
     -------
-    str
-        The row or column number as selected by the participant.
+    list of str or list of tuple
+        The names of the pressed keys, or their names and times if timestamped.
     """
 
+    if isinstance(key_list, str):
+        key_list = [key_list]
 
-    if is_training:
-        if row_response:
-            text = f"In welcher Reihe war der abweichende Smiley? Nutzen Sie zur Eingabe die Tasten '1' bis '{rows}'."
-        else:
-            text = f"In welcher Spalte war der abweichende Smiley? Nutzen Sie zur Eingabe die Tasten '1' bis '{cols}'."
-
-        present_text(win,
-                     text,
-                     pos = (0, (height_cm / 2) - (spacing / 2)))
-        
-    display_grid(win, 
-                 positions,
-                 rectangles, 
-                 row_color,
-                 col_color)
+    if is_headless(win):
+        keys = win.participant.waitKeys(keyList = key_list)
+        return [(key.name, key.tDown) if timestamped else key.name for key in keys]
 
-    if row_response:
-        response = event.waitKeys(keyList = [str(i) for i in range(1, rows + 1)])[0]
-    
-    if not row_response:
-        response = event.waitKeys(keyList = [str(i) for i in range(1, cols + 1)])[0]
+    event.clearEvents(eventType = "keyboard")
 
-    return response
+    return scheduler.run(lambda: event.getKeys(keyList = key_list, 
+                                               timeStamped = timestamped),
+                         run_idle = run_idle)
 
 
 
-def run_trial(win: visual.Window, 
-              set_size: int, 
-              positions: List[Tuple[float, float]], 
-              rectangles: List[visual.Rect],
-              target_state: str,
-              stimuli: List[Dict[str, Any]],
-              continue_key: str,
-              is_training: bool = False) -> Dict[str, Any]:
+class TextStimPool:
     """
-    Executes a single trial in the main experiment or training phase, displaying stimuli at randomly selected positions and recording 
-    the participant's responses. It presents a target with a specified emotional expression, that has to be found 
-    among a specified amount of neutral distractors, then asks the participant to identify the target's position.
-    Returns a dictionary with trial data, including the tested condition (target state and display size), reaction time, accuracy, 
-    target location and the participant's response.
+    Keeps text stimuli that have already been laid out, keyed by (text, height, color, pos), so repeated labels and prompts
+    are only laid out once per session. When the pool is full, the least recently used text stimulus is discarded.
+    All text stimuli use the same font and therefore share its glyph textures, so every glyph is uploaded once per text height.
 
     Parameters
     ----------
     win : visual.Window
-        The window where stimuli will be displayed.
-    set_size : int
-        The number of stimuli (target and distractors) to display during the trial.
-    positions : list of tuple
-        A list of (x, y) coordinates that specify the positions where stimuli will be drawn on the screen.
-    rectangles : list of visual.Rect
-        A list of visual.Rect objects that will be displayed at the positions.
-    target_state : str
-        The emotional expression of the target stimulus. Possible values are "positive" or "negative".
-    stimuli : list of dict
-        A preloaded list of smiley stimuli, where each dict contains the visual elements for drawing a target or distractor.
-    continue_key : str
-        The key that participants must press to continue to the next display.
-    is_training : bool, optional
-        Whether the trial is part of a training phase. Defaults to False.
-
-    Returns
-    -------
-    dict
-        A dictionary containing trial data:
-            - "block" (int): 0.
-            - "trial_num" (int): 0.
-            - "set_size" (int): Number of stimuli displayed during the trial.
-            - "target_state" (str): Emotional expresion of the target ("positive" or "negative").
-            - "target_position" (tuple): Grid position of the target, as (row, column).
-            - "reaction_time" (float): Participant's reaction time in seconds.
-            - "response" (tuple): The participant's response, in terms of (row, column) position.
-            - "accuracy" (bool): Whether the participant's response was correct (True/False).
+        The window the text stimuli are drawn in.
+    size : int, optional
+        The maximal number of text stimuli kept. Defaults to text_pool_size.
     """
 
-    try:
-        help_pos = (0, (height_cm / 2) - (spacing / 2))
+    def __init__(self, 
+                 win: visual.Window,
+                 size: Optional[int] = None) -> None:
 
-        target_loc = random.choice(positions)
-        distractor_loc = random.sample([pos for pos in positions if pos != target_loc], set_size - 1)
+        self.win = win
+        self.size = text_pool_size if size is None else size
+        self.stimuli = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.pages = {}
 
 
-        present_text(win, 
-                    text = f"'{continue_key.upper()}'")
+    def prerender(self,
+                  texts: List[str]) -> None:
+        """
+        Renders the given full-screen texts to images in a worker thread. Once rendered, they are uploaded
+        as textures on the main thread by page, so presenting them is a single draw of a cached image.
+        """
 
-       
-        if is_training:
-            present_text(win, 
-                        text = f"'{continue_key.upper()}' drücken um das nächste Display anzuzeigen.",
-                        pos = help_pos)
+        if load_page_font(max(int(round(text_height * pix_per_cm)), 1)) is None:
+            return
 
-        win.flip()
-        event.waitKeys(keyList = continue_key)
+        executor = ThreadPoolExecutor(max_workers = 1, 
+                                      thread_name_prefix = "PageRenderer")
+        for text in texts:
+            if text not in self.pages:
+                self.pages[text] = executor.submit(render_text_page, text)
 
+        executor.shutdown(wait = False)
 
-        draw_stimulus(stimuli[0],
-                      expression = target_state,
-                      pos = target_loc)
 
-        for i, loc in enumerate(distractor_loc):
-            draw_stimulus(stimuli[1 + i],
-                          expression = "neutral", 
-                          pos = loc)
-        if is_training:
-            present_text(win,
-                         text = f"Abweichenden Smiley so schnell wie möglich finden und wenn gefunden die Taste '{continue_key.upper()}' drücken.",
-                         pos = help_pos)
+    def page(self,
+             text: str) -> Optional[visual.ImageStim]:
+        """Returns the pre-rendered page of a text, uploading it first if needed, or None if it isn't rendered (yet)."""
 
-        win.flip()
+        page = self.pages.get(text)
 
-        clock = core.Clock()
-        rt = event.waitKeys(keyList = continue_key, 
-                            timeStamped = clock)[0][1]
+        if isinstance(page, Future):
+            if not page.done():
+                return None
 
+            try:
+                image = page.result()
+            except Exception as e:
+                logging.error(f"Error pre-rendering page: {e}")
+                del self.pages[text]
+                return None
 
-        row_response = get_grid_response(win, 
-                                        positions,
-                                        rectangles,
-                                        row_color = color2, 
-                                        col_color = color,
-                                        is_training = is_training,
-                                        row_response = True)
+            page = self.pages[text] = visual.ImageStim(self.win,
+                                                       image = image,
+                                                       units = "pix",
+                                                       size = image.size,
+                                                       pos = (0, 0))
 
-        col_response = get_grid_response(win, 
-                                        positions,  
-                                        rectangles,
-                                        row_color = color, 
-                                        col_color = color2,
-                                        is_training = is_training,)
+        return page
 
 
-        # Converts target's position list index into row and column numbers and checks if it matches given input
-        target_index = positions.index(target_loc)
-        target_row = 1 + target_index // cols
-        target_col = 1 + target_index % cols
+    def upload_pages(self) -> None:
+        """Uploads all pages that finished rendering, to be called on the main thread while nothing time critical happens."""
 
-        if int(row_response) == target_row and int(col_response) == target_col:
-            accuracy = True
-            feedback = "Ihre Antwort ist richtig."
+        for text in list(self.pages):
+            self.page(text)
 
-        else:
-            accuracy = False
-            feedback = "Ihre Antwort ist falsch."
-        
-        core.wait(feedback_delay)
 
-        if is_training and not accuracy:
-            present_text(win,
-                         text = feedback + f"\n\nSie haben Reihe: {row_response} und Spalte: {col_response} geantwortet. \n\nRichtige wäre Reihe: {target_row} und Spalte: {target_col}.",
-                         flip = True)
-            core.wait(feedback_duration * 4)
-            
-        else:
-            present_text(win, 
-                         text = feedback,
-                         flip = True)
-        
-            core.wait(feedback_duration)
+    def get(self,
+            text: str,
+            pos: Tuple[float, float],
+            height: float,
+            textColor: Union[str, Tuple[float, float, float]]) -> visual.TextStim:
+        """Returns the text stimulus for the given text, position, height and color, laying it out only if it isn't pooled yet."""
 
+        key = (text, height, tuple(textColor) if isinstance(textColor, list) else textColor, tuple(pos))
+        text_stim = self.stimuli.get(key)
 
-        logging.info(f"Trial Data: RT: {rt}, ACC: {accuracy}, SIZE: {set_size}, STATE: {target_state}, LOC: {(target_row, target_col)}, RES: {(int(row_response), int(col_response))}")
-        
+        if text_stim is not None:
+            self.hits += 1
+            self.stimuli.move_to_end(key)
+            return text_stim
 
-        return {
-            "block": 0,
-            "trial_num": 0,
-            "set_size": set_size,
-            "target_state": target_state,
-            "target_position": (target_row, target_col),
-            "reaction_time": rt,
-            "response": (int(row_response), int(col_response)),
-            "accuracy": accuracy,
-        }
-    
-    except Exception as e:
-        logging.error(f"Error running trial: {e}")
+        self.misses += 1
+        text_stim = visual.TextStim(
+            self.win,
+            units = "cm",
+            height = height,
+            color = textColor,
+            pos = pos,  
+            text = text
+        )
+        self.stimuli[key] = text_stim
 
+        if len(self.stimuli) > self.size:
+            self.stimuli.popitem(last = False)
 
+        return text_stim
 
-def run_training(win: visual.Window, 
-                 positions: List[Tuple[float, float]],
-                 rectangles: List[visual.Rect],
-                 training_set_size: int,
-                 stimuli: List[Dict[str, Any]],
-                 training_trials: int,
-                 continue_key: str) -> None:
+
+
+@functools.lru_cache(maxsize = None)
+def load_page_font(font_size: int) -> Any:
     """
-    Runs the training phase of the experiment, repeating trials until the participant answers 
-    the required number of trials correctly.
+    Loads page_font in the given size in pixels for render_text_page. If it isn't found, Pillow's default font is used,
+    which can only be scaled from Pillow 10.1 on. Fonts are cached, so a fallback is logged only once.
 
     Parameters
     ----------
-    win : visual.Window
-        The window where stimuli, grid and feedback will be presented.
-    positions : list of tuple
-        A list of positions for the stimuli.
-    rectangles : list of visual.Rect
-        A list of visual.Rect objects that will be displayed at the positions.
-    training_set_size : int
-        The number of stimuli to present during each training trial.
-    stimuli : list of dict
-        The preloaded smiley stimuli used during the training trials.
-    training_trials : int
-        The number of correctly answered trials required to complete training.
-    continue_key : str
-        The key the participant presses to continue between trials.
+    font_size : int
+        The size of the font in pixels.
+
+    Returns
+    -------
+    PIL.ImageFont.FreeTypeFont or None
+        The font, or None if page_font isn't found and the default font can't be scaled, in which case pages are not pre-rendered.
     """
 
+    import PIL
+    from PIL import ImageFont
+
     try:
-        logging.info("Starting training phase")
-        correct_train_trials = 0
-        total_train_trials = 0
+        return ImageFont.truetype(page_font, font_size)
+    except OSError:
+        pass
 
-        unused_target_states = target_states.copy()
-        random.shuffle(unused_target_states)
+    try:
+        font = ImageFont.load_default(font_size)
+    except TypeError:
+        logging.warning(f"Page font {page_font} not found and Pillow {PIL.__version__} can't scale its default font (10.1 or newer is needed), "
+                        f"pages are drawn as text stimuli instead of being pre-rendered")
+        return None
 
-        while correct_train_trials < training_trials:
-            if not unused_target_states:
-                unused_target_states = target_states.copy() 
-                random.shuffle(unused_target_states) 
+    logging.warning(f"Page font {page_font} not found, pages are pre-rendered with Pillow's default font")
+    return font
 
-            target_state = unused_target_states.pop()
-            trial_data = run_trial(win, 
-                                   training_set_size, 
-                                   positions,
-                                   rectangles,
-                                   target_state,
-                                   stimuli,
-                                   continue_key,
-                                   is_training = True)
-            
-            total_train_trials += 1
 
-            if trial_data["accuracy"]:
-                correct_train_trials += 1
 
-        present_text(win, 
-                    text = (f"Training erfolgreich abgeschlossen. \n\nBitte denken Sie daran einen Finger auf die Taste '{continue_key.upper()}' zu legen und so schnell wie möglich zu antworten."
-                            f"\n\nDrücken Sie '{continue_key.upper()}' um das Experiment zu starten."),
-                    pos = (0, 0),
-                    flip = True)
+def render_text_page(text: str,
+                     height: float = text_height,
+                     textColor: Tuple[float, float, float] = color) -> Any:
+    """
+    Renders a page of text into a transparent image with Pillow, wrapped and centered like a TextStim.
+    Doesn't touch OpenGL, so it can run in a worker thread.
+
+    Parameters
+    ----------
+    text : str
+        The text of the page.
+    height : float, optional
+        The text height in centimeters. Defaults to the global text_height variable.
+    textColor : tuple, optional
+        The color of the text in PsychoPy's rgb color space (-1 to 1). Defaults to the global "color" variable.
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered page as RGBA image.
+    """
+
+    from PIL import Image, ImageDraw
+
+    font_size = max(int(round(height * pix_per_cm)), 1)
+    font = load_page_font(font_size)
+    if font is None:
+        raise OSError("No scalable font to render pages with, see load_page_font")
+
+    wrap_width = page_wrap_width * pix_per_cm
+    lines = []
+
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            candidate = f"{line} {word}" if line else word
+
+            if line and font.getlength(candidate) > wrap_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+
+        lines.append(line)
+
+    line_height = int(round(font_size * 1.2))
+    image = Image.new("RGBA", (int(np.ceil(wrap_width)), line_height * len(lines) + font_size // 2), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    fill = tuple(int(round((c + 1) / 2 * 255)) for c in textColor) + (255,)
+
+    for i, line in enumerate(lines):
+        draw.text((image.width / 2, i * line_height), line, font = font, fill = fill, anchor = "ma")
+
+    return image
+
+
+
+text_pools = {}
+
+
+
+def get_text_pool(win: visual.Window) -> TextStimPool:
+    """
+    Returns the text stimulus pool of a window, creating it on first use.
+    """
+
+    pool = text_pools.get(id(win))
+
+    if pool is None or pool.win is not win:
+        pool = text_pools[id(win)] = TextStimPool(win)
+
+    return pool
+
+
+
+def present_text(win: visual.Window, 
+                 text: str, 
+                 pos: Tuple[float, float] = (0, 0), 
+                 height: float = text_height,
+                 textColor: Union[str, Tuple[float, float, float]] = color, 
+                 flip: bool = False) -> None:
+    """
+    Draws a text stimulus in a window and optionally flips the window to make the text visible.
+    The text stimulus is taken from the window's TextStimPool, so a text is only laid out the first time it is presented.
+    Texts centered with the default height and color, that were pre-rendered with TextStimPool.prerender, are drawn as their cached page.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the text stimulus will be presented.
+    text : str
+        The text content to be displayed.
+    pos : tuple, optional
+        The (x, y) position where the text will be drawn. Defaults to (0, 0), the center of the screen.
+    height: float, optional
+        The text height in centimeters. Defaults to the global text_height variable.
+    textColor : str or list, optional
+        The color of the text. Defaults to the global "color" variable.
+    flip : bool, optional
+        If True, the window will be flipped after drawing the text, making it visible on the screen. Defaults to False.
+    """
+
+    if is_headless(win):
+        if flip:
+            win.flip()
+        return
+
+    text_pool = get_text_pool(win)
+    page = None
+
+    if tuple(pos) == (0, 0) and height == text_height and textColor == color:
+        page = text_pool.page(text)
+
+    if page is None:
+        page = text_pool.get(text,
+                             pos,
+                             height,
+                             textColor)
+    page.draw()
+
+    if flip:
+        win.flip()
+
+
+
+def present_instructions(win: visual.Window, 
+                         instructions: List[str], 
+                         continue_key: str, 
+                         return_key: str) -> None:
+    """
+    Displays a sequence of instructions on the screen and allowing the user to navigate through them using specified keys.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the instructions will be presented.
+    instructions : list of str
+        A list of instruction strings to be displayed, one at a time.
+    continue_key : str
+        The key that advances to the next instruction in the sequence.
+    return_key : str
+        The key that returns to the previous instruction, allowing the user to review.
+    """
+
+    current_instr = 0
+
+    while current_instr < len(instructions):
+
+        present_text(win, 
+                     text = instructions[current_instr],
+                     flip = True)
+        
+        logging.info(f"Presenting instruction {current_instr + 1}")
+        wait(win, skip_prot)
+
+        key = wait_keys(win, [continue_key, return_key])
+
+        if continue_key in key:
+            current_instr += 1
+
+        elif return_key in key:
+            if current_instr > 0:
+                current_instr -= 1
+
+
+
+def training_end_text(continue_key: str) -> str:
+    """
+    Returns the text shown after the training was completed successfully.
+    """
+
+    return (f"Training erfolgreich abgeschlossen. \n\nBitte denken Sie daran einen Finger auf die Taste '{continue_key.upper()}' zu legen und so schnell wie möglich zu antworten."
+            f"\n\nDrücken Sie '{continue_key.upper()}' um das Experiment zu starten.")
+
+
+
+def block_start_text(block: int,
+                     num_blocks: int,
+                     continue_key: str,
+                     open_ended: bool = False) -> str:
+    """
+    Returns the text shown at the start of a block of the main trials, counting blocks from 1.
+    If open_ended, num_blocks is only the most there can be, as the adaptive allocation may end the session earlier.
+    """
+
+    total = f"höchstens {num_blocks}" if open_ended else num_blocks
+
+    return (f"Block: {block} von {total}.\
+                                \n\nWenn Sie bereit sind drücken Sie '{continue_key.upper()}' um den nächsten Block zu starten.")
+
+
+
+def end_text(return_key: str) -> str:
+    """
+    Returns the text shown at the end of the experiment.
+    """
+
+    return (f"Das Experiment ist beendet." 
+            "\n\nVielen Dank für Ihre Teilnahme!"
+            "\n\nIn diesem Experiment mussten Sie Gesichter mit einem positiven oder negativen Ausdruck in Mitten von unterschiedlich vielen neutralen Gesichtern finden."
+            "\n\nZiel des Experiments ist es, durch die Analyse der Reaktionszeiten, in Abhängigkeit \nvom emotionalen Ausdruck der Gesichter und der Anzahl der neutralen Gesichter, zu untersuchen, wie emotionale Gesichtsaudrücke die Aufmerksamkeitslenkung beeinflussen."
+            "\n\nWir möchten herausfinden, ob negative oder positive Gesichtsausdrücke die Aufmerksamkeit unterschiedlich stark auf sich ziehen können."
+            f"\n\nDrücken Sie '{return_key.upper()}' um das Fenster zu schließen.")
+
+
+
+def arc_vertices(radius: float, 
+                 start_angle: float, 
+                 end_angle: float) -> np.ndarray:
+    """
+    Helper function to create vertices for a circular arc given a radius and angular range, 
+    that are used for the mouth of the smiley stimuli, which will be the targets.
+
+    Parameters
+    ----------
+    radius : float
+        The radius of the arc (distance from the center).
+    start_angle : float
+        The starting angle of the arc, in degrees.
+    end_angle : float
+        The ending angle of the arc, in degrees.
+
+    Returns
+    -------
+    arc : numpy.ndarray
+        An array of shape (25, 2) with the (x, y) vertices of the arc in Cartesian coordinates.
+    """
+    
+    # Converting degrees to radians, because the linspace function won't take degrees as a unit
+    start_rad = np.deg2rad(start_angle)
+    end_rad = np.deg2rad(end_angle)
+    
+    # Calculates angles between start and end_rad
+    angles = np.linspace(start_rad, 
+                         end_rad, 
+                         25) 
+    
+    # Calculates the Cartesian coordinates for all angles at once
+    arc = radius * np.column_stack((np.cos(angles), np.sin(angles)))
+
+    return arc
+
+
+
+def preload_stimuli(win: visual.Window, 
+                    set_size: int) -> List[Dict[str, Any]]:
+    """
+    Preloads a list of smiley stimuli built out of circles and shapes, which can be both targets or 
+    distractors. These will be reused across trials with just their position and expression beeing updated
+    by another function.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the stimuli will be displayed.
+    set_size : int
+        The number of smiley stimuli to preload. This defines the number of visual elements that will be created and stored.
+
+    Returns
+    -------
+    stimuli : list of dict
+        A list of dictionaries where each dictionary contains the visual components (head, eyes, mouth) of a smiley face.
+    """
+
+    try:
+        radius_head = stim_size / 2
+        radius_eye = stim_size * 0.0577
+        mouth_radius = stim_size * 0.2885
+        line_width_cm = stim_size * 0.0577
+        line_width_pix = line_width_cm * pix_per_cm                # Necessary because lineWidth only takes pix as a unit
+        
+        positive_mouth_vertices = arc_vertices(mouth_radius, 
+                                               195, 
+                                               345)
+        
+        negative_mouth_vertices = arc_vertices(mouth_radius, 
+                                               15, 
+                                               165)
+    
+        stimuli = []
+        for _ in range(set_size):
+
+            stimulus = {
+                "head": visual.Circle(win = win, 
+                                    lineColor = color, 
+                                    fillColor = None, 
+                                    radius = radius_head,
+                                    lineWidth = line_width_pix),
+
+                "left_eye": visual.Circle(win = win, 
+                                        lineColor = color, 
+                                        fillColor = color, 
+                                        radius = radius_eye),
+
+                "right_eye": visual.Circle(win = win, 
+                                        lineColor = color, 
+                                        fillColor = color, 
+                                        radius = radius_eye),
+
+                "mouth_positive": visual.ShapeStim(win = win, 
+                                                vertices = positive_mouth_vertices, 
+                                                lineWidth = line_width_pix, 
+                                                lineColor = color, 
+                                                closeShape = False),
+
+                "mouth_negative": visual.ShapeStim(win = win, 
+                                                vertices = negative_mouth_vertices, 
+                                                lineWidth = line_width_pix, 
+                                                lineColor = color, 
+                                                closeShape = False),
+
+                "mouth_neutral": visual.Line(win = win, 
+                                            start = (0, 0), 
+                                            end = (0, 0), 
+                                            lineWidth = line_width_pix, 
+                                            lineColor = color)
+            }
+            stimuli.append(stimulus)
+
+        logging.info(f"Preloaded {set_size} stimuli")
+        return stimuli
+
+    except Exception as e:
+        logging.error(f"Error preloading stimuli: {e}")
+    
+
+
+@functools.lru_cache(maxsize = None)
+def part_offsets(size: float) -> Dict[str, np.ndarray]:
+    """
+    Returns where the parts of a smiley of the given size are placed relative to its center. The mouths are
+    ShapeStims positioned by their arc center, the neutral mouth is a line given by its start and end point.
+    The offsets are computed once per size and are read-only.
+
+    Parameters
+    ----------
+    size : float
+        The diameter of the smiley, i.e. stim_size.
+
+    Returns
+    -------
+    dict
+        The (x, y) offset of every part: "head", "left_eye", "right_eye", "mouth_positive", "mouth_negative", 
+        "mouth_neutral_start" and "mouth_neutral_end".
+    """
+
+    eye_x_offset = size * 0.1538
+    eye_y_offset = size * 0.1923
+    mouth_length = size * 0.2885
+    mouth_neu_offset = size * 0.1154
+    mouth_neg_offset = size * 0.3077
+    mouth_pos_offset = size * 0.0192
+
+    offsets = {"head": np.array([0.0, 0.0]),
+               "left_eye": np.array([-eye_x_offset, eye_y_offset]),
+               "right_eye": np.array([eye_x_offset, eye_y_offset]),
+               "mouth_positive": np.array([0.0, mouth_pos_offset]),
+               "mouth_negative": np.array([0.0, -mouth_neg_offset]),
+               "mouth_neutral_start": np.array([-mouth_length, -mouth_neu_offset]),
+               "mouth_neutral_end": np.array([mouth_length, -mouth_neu_offset])}
+
+    for offset in offsets.values():
+        offset.setflags(write = False)
+
+    return offsets
+
+
+
+def smiley_parts(centers: np.ndarray, 
+                 size: Optional[float] = None) -> Dict[str, np.ndarray]:
+    """
+    Places the parts of smileys at the given centers.
+
+    Parameters
+    ----------
+    centers : numpy.ndarray
+        An (n, 2) array with the centers of the smileys.
+    size : float, optional
+        The diameter of the smileys. Defaults to stim_size.
+
+    Returns
+    -------
+    dict
+        An (n, 2) array with the positions of every part, keyed like the offsets of part_offsets.
+    """
+
+    centers = np.asarray(centers, dtype = float).reshape(-1, 2)
+    offsets = part_offsets(stim_size if size is None else size)
+
+    return {name: centers + offset for name, offset in offsets.items()}
+
+
+
+class GridGeometry:
+    """
+    Holds the positions of all cells of the grid and the positions of every part of a smiley in every cell
+    as read-only arrays, computed once per configuration. Placing a display is then a matter of indexing.
+
+    Parameters
+    ----------
+    rows : int
+        The number of rows in the grid.
+    cols : int
+        The number of columns in the grid.
+    spacing : float
+        The distance between neighboring cells in centimeters.
+    stim_size : float
+        The diameter of the smileys in centimeters.
+    pix_per_cm : float
+        The pixels per centimeter of the screen.
+    window_size : tuple of int
+        The width and height of the window in pixels.
+    """
+
+    def __init__(self,
+                 rows: int,
+                 cols: int,
+                 spacing: float,
+                 stim_size: float,
+                 pix_per_cm: float,
+                 window_size: Tuple[int, int]) -> None:
+
+        screen_width_cm = window_size[0] / pix_per_cm
+        screen_height_cm = window_size[1] / pix_per_cm
+
+        offset_x = (screen_width_cm - (cols - 1) * spacing) / 2
+        offset_y = (screen_height_cm - (rows - 1) * spacing) / 2
+
+        # Cells are numbered row by row, like the indices of the trial schedule
+        row, col = np.divmod(np.arange(rows * cols), cols)
+
+        self.rows = rows
+        self.cols = cols
+        self.positions = np.column_stack((offset_x + col * spacing - (screen_width_cm / 2),
+                                          offset_y + row * spacing - (screen_height_cm / 2)))
+        self.parts = smiley_parts(self.positions, 
+                                  stim_size)
+
+        for points in [self.positions, *self.parts.values()]:
+            points.setflags(write = False)
+
+
+    def select(self, 
+               cells: Union[List[int], np.ndarray]) -> Dict[str, np.ndarray]:
+        """
+        Returns the positions of the parts of the smileys in the given cells, in the order of cells.
+        """
+
+        return {name: points[cells] for name, points in self.parts.items()}
+
+
+
+geometries = {}
+
+
+
+def get_geometry(win: visual.Window, 
+                 rows: int, 
+                 cols: int) -> GridGeometry:
+    """
+    Returns the geometry of a grid in the window, computing it only the first time it is needed for the current
+    rows, cols, spacing, stim_size, pix_per_cm and window size.
+    """
+
+    key = (rows, cols, spacing, stim_size, pix_per_cm, tuple(int(length) for length in win.size))
+
+    geometry = geometries.get(key)
+    if geometry is None:
+        geometry = geometries[key] = GridGeometry(*key)
+        logging.info(f"Computed geometry of {rows * cols} cells")
+
+    return geometry
+
+
+
+def calculate_positions(win: visual.Window, 
+                        rows: int, 
+                        cols: int) -> np.ndarray:
+    """
+    Returns the rows times cols (x, y) positions in a rectangular grid, spacing value, 
+    both on the x- and y-axis, apart from each other and centered on the screen, 
+    that will be used as positions for the stimulus presentation and localization task.
+    The positions are taken from the cached geometry of the grid, see get_geometry.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The Window!
+    rows : int
+        The number of rows in the grid.
+    cols : int
+        The number of columns in the grid.
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        A read-only array of shape (rows * cols, 2) with the (x, y) coordinates of each position in the grid, row by row.
+    """
+
+    try:
+        positions = get_geometry(win, rows, cols).positions
+        logging.info(f"{len(positions)} positions calculated")
+
+        return positions
+    
+    except Exception as e:
+        logging.error(f"Error calculating positions for {rows} rows and {cols} columns: {e}")
+
+
+
+def place_stimulus(stimulus: Dict[str, Any], 
+                   expression: str, 
+                   parts: Dict[str, np.ndarray],
+                   index: int) -> List[Any]:
+    """
+    Moves the parts of a preloaded smiley stimulus to the positions of one smiley in parts, as returned by smiley_parts
+    or GridGeometry.select, and returns the parts to draw, in drawing order.
+    """
+
+    stimulus["head"].pos = parts["head"][index]
+    stimulus["left_eye"].pos = parts["left_eye"][index]
+    stimulus["right_eye"].pos = parts["right_eye"][index]
+
+    if expression == "positive":
+        mouth = stimulus["mouth_positive"]
+        mouth.pos = parts["mouth_positive"][index]
+
+    elif expression == "negative":
+        mouth = stimulus["mouth_negative"]
+        mouth.pos = parts["mouth_negative"][index]
+
+    else:
+        mouth = stimulus["mouth_neutral"]
+        mouth.start = parts["mouth_neutral_start"][index]
+        mouth.end = parts["mouth_neutral_end"][index]
+
+    return [stimulus["head"], stimulus["left_eye"], stimulus["right_eye"], mouth]
+
+
+
+def prepare_stimulus(stimulus: Dict[str, Any], 
+                     expression: str, 
+                     pos: Tuple[float, float]) -> List[Any]:
+    """
+    Updates the position and expression of a preloaded smiley stimulus without drawing it.
+
+    Parameters
+    ----------
+    stimulus : dict
+        A dictionary representing the smiley stimulus containing all the parts.
+    expression : str
+        The emotional expression of the stimulus. Should be either "positive", "negative", or "neutral".
+    pos : tuple
+        The (x, y) position on the screen where the stimulus will be displayed.
+
+    Returns
+    -------
+    list
+        The parts of the stimulus to draw, in drawing order.
+    """
+
+    return place_stimulus(stimulus, 
+                          expression, 
+                          smiley_parts(pos), 
+                          0)
+
+
+
+def draw_stimulus(stimulus: Dict[str, Any], 
+                  expression: str, 
+                  pos: Tuple[float, float]) -> None:
+    """
+    Updates the position and expression of a preloaded smiley stimulus and draws it.
+
+    Parameters
+    ----------
+    stimulus : dict
+        A dictionary representing the smiley stimulus containing all the parts.
+    expression : str
+        The emotional expression of the stimulus. Should be either "positive", "negative", or "neutral".
+    pos : tuple
+        The (x, y) position on the screen where the stimulus will be displayed.
+    """
+
+    for part in prepare_stimulus(stimulus, expression, pos):
+        part.draw()
+
+
+
+def stroke_mask(distance: np.ndarray,
+                half_width: float,
+                texel: float) -> np.ndarray:
+    """
+    Converts the distance of every texel to a stroke into a smooth, anti-aliased mask
+    with the value 1 on the stroke and -1 everywhere else, as expected by PsychoPy.
+
+    Parameters
+    ----------
+    distance : numpy.ndarray
+        The distance of every texel center to the stroke in centimeters.
+    half_width : float
+        Half of the stroke width in centimeters.
+    texel : float
+        The size of one texel in centimeters, used as the width of the anti-aliased edge.
+
+    Returns
+    -------
+    numpy.ndarray
+        The mask with values between -1 and 1.
+    """
+
+    alpha = np.clip((half_width - distance) / texel + 0.5, 0, 1)
+
+    return alpha * 2 - 1
+
+
+
+def batched_part_masks(res: int) -> Tuple[float, Dict[str, np.ndarray]]:
+    """
+    Renders the head outline and the three mouths of a smiley into square masks centered on the smiley,
+    so that every part can be drawn as an element at the smiley's position without any further offsets.
+    The geometry matches the one used by preload_stimuli and draw_stimulus.
+
+    Parameters
+    ----------
+    res : int
+        The resolution of the masks in texels. Should be a power of two.
+
+    Returns
+    -------
+    box_size : float
+        The side length of the masks in centimeters.
+    masks : dict
+        A dictionary with the masks for "head", "positive", "negative" and "neutral".
+    """
+
+    radius_head = stim_size / 2
+    mouth_radius = stim_size * 0.2885
+    half_width = stim_size * 0.0577 / 2
+    mouth_length = stim_size * 0.2885
+    mouth_neu_offset = stim_size * 0.1154
+    mouth_neg_offset = stim_size * 0.3077
+    mouth_pos_offset = stim_size * 0.0192
+
+    box_size = stim_size + 4 * half_width
+    texel = box_size / res
+
+    # Texel centers in centimeters relative to the smiley's center, rows run bottom to top as OpenGL expects
+    coords = (np.arange(res) + 0.5) * texel - box_size / 2
+    x, y = np.meshgrid(coords, coords)
+
+
+    def arc_distance(center_y: float,
+                     start_angle: float,
+                     end_angle: float) -> np.ndarray:
+
+        dy = y - center_y
+        angle = np.rad2deg(np.arctan2(dy, x)) % 360
+        on_arc = np.abs(np.hypot(x, dy) - mouth_radius)
+
+        end_points = [(mouth_radius * np.cos(np.deg2rad(a)), center_y + mouth_radius * np.sin(np.deg2rad(a))) for a in (start_angle, end_angle)]
+        to_ends = np.minimum(*[np.hypot(x - ex, y - ey) for ex, ey in end_points])
+
+        return np.where((angle >= start_angle) & (angle <= end_angle), on_arc, to_ends)
+
+
+    neutral_x = np.clip(x, -mouth_length, mouth_length)
+    neutral_distance = np.hypot(x - neutral_x, y + mouth_neu_offset)
+
+    masks = {
+        "head": stroke_mask(np.abs(np.hypot(x, y) - radius_head), half_width, texel),
+        "positive": stroke_mask(arc_distance(mouth_pos_offset, 195, 345), half_width, texel),
+        "negative": stroke_mask(arc_distance(-mouth_neg_offset, 15, 165), half_width, texel),
+        "neutral": stroke_mask(neutral_distance, half_width, texel)
+    }
+
+    return box_size, masks
+
+
+
+def preload_batched_stimuli(win: visual.Window,
+                            set_size: int) -> Dict[str, Any]:
+    """
+    Preloads element arrays that hold every head, eye and mouth of a whole search display. Each array is drawn
+    with a single draw call, so a display takes at most five draw calls, independent of the set size.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the stimuli will be displayed.
+    set_size : int
+        The maximal number of smileys per display.
+
+    Returns
+    -------
+    stimuli : dict
+        A dictionary with the "mode", the "capacity" and the element arrays for "heads", "eyes" and each mouth expression.
+    """
+
+    try:
+        box_size, masks = batched_part_masks(batch_mask_res)
+        radius_eye = stim_size * 0.0577
+
+
+        def element_array(n_elements: int,
+                          size: float,
+                          mask: Union[str, np.ndarray]) -> visual.ElementArrayStim:
+
+            return visual.ElementArrayStim(win = win,
+                                           units = "cm",
+                                           nElements = n_elements,
+                                           sizes = size,
+                                           xys = np.zeros((n_elements, 2)),
+                                           elementTex = None,
+                                           elementMask = mask,
+                                           colors = color,
+                                           opacities = 0,
+                                           texRes = batch_mask_res)
+
+
+        stimuli = {
+            "mode": "batched",
+            "capacity": set_size,
+            "heads": element_array(set_size, box_size, masks["head"]),
+            "eyes": element_array(2 * set_size, 2 * radius_eye, "circle"),
+            "mouths": {expression: element_array(set_size, box_size, masks[expression])
+                       for expression in ("positive", "negative", "neutral")}
+        }
+
+        logging.info(f"Preloaded batched stimuli for up to {set_size} items")
+        return stimuli
+
+    except Exception as e:
+        logging.error(f"Error preloading batched stimuli: {e}")
+
+
+
+def place_elements(elements: visual.ElementArrayStim,
+                   xys: np.ndarray) -> None:
+    """
+    Moves the first elements of an element array to the given positions and hides the remaining ones.
+
+    Parameters
+    ----------
+    elements : visual.ElementArrayStim
+        The element array to update.
+    xys : numpy.ndarray
+        An (n, 2) array with the positions of the visible elements.
+    """
+
+    capacity = elements.nElements
+    all_xys = np.zeros((capacity, 2))
+    all_xys[:len(xys)] = xys
+
+    opacities = np.zeros(capacity)
+    opacities[:len(xys)] = 1
+
+    elements.xys = all_xys
+    elements.opacities = opacities
+
+
+
+def prepare_batched_display(stimuli: Dict[str, Any],
+                            target_state: str,
+                            target_loc: Tuple[float, float],
+                            distractor_loc: List[Tuple[float, float]],
+                            parts: Optional[Dict[str, np.ndarray]] = None) -> List[visual.ElementArrayStim]:
+    """
+    Places the target and all distractors in the preloaded element arrays without drawing them.
+
+    Parameters
+    ----------
+    stimuli : dict
+        The element arrays as returned by preload_batched_stimuli.
+    target_state : str
+        The emotional expression of the target.
+    target_loc : tuple
+        The (x, y) position of the target.
+    distractor_loc : list of tuple
+        The (x, y) positions of the neutral distractors.
+    parts : dict, optional
+        The positions of the parts of the target and the distractors, in this order, as returned by GridGeometry.select.
+        Computed from target_loc and distractor_loc if None.
+
+    Returns
+    -------
+    list of ElementArrayStim
+        The element arrays to draw, in drawing order.
+    """
+
+    if parts is None:
+        parts = smiley_parts([target_loc] + list(distractor_loc))
+
+    centers = parts["head"]
+    expressions = np.array([target_state] + ["neutral"] * (len(centers) - 1))
+
+    eyes = np.concatenate([parts["left_eye"], parts["right_eye"]])
+
+    place_elements(stimuli["heads"], centers)
+    place_elements(stimuli["eyes"], eyes)
+
+    draw_list = [stimuli["heads"], stimuli["eyes"]]
+
+    for expression, mouths in stimuli["mouths"].items():
+        mouth_centers = centers[expressions == expression]
+
+        if len(mouth_centers):
+            place_elements(mouths, mouth_centers)
+            draw_list.append(mouths)
+
+    return draw_list
+
+
+
+def render_face_atlas(win: visual.Window) -> Tuple[float, np.ndarray]:
+    """
+    Renders the positive, negative and neutral smiley once with the vector stimuli into the back buffer
+    and stores them side by side in a texture atlas. The atlas is used as a mask, so the faces keep
+    their anti-aliased edges when drawn in the stimulus color.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window used to render the faces. Its back buffer is cleared afterwards.
+
+    Returns
+    -------
+    box_size : float
+        The side length of every face in the atlas in centimeters.
+    atlas : numpy.ndarray
+        An array of shape (atlas_res, 3 * atlas_res) holding the masks of the faces in the order of atlas_expressions.
+    """
+
+    from PIL import Image
+
+    face = preload_stimuli(win, 1)[0]
+    box_size = stim_size * 1.2
+    box_pix = int(np.ceil(box_size * pix_per_cm))
+
+    # Pixel box around the window center, as PIL counts rows from the top
+    left = int(win.size[0] // 2 - box_pix // 2)
+    top = int(win.size[1] // 2 - box_pix // 2)
+    box = (left, top, left + box_pix, top + box_pix)
+
+    tiles = []
+    for expression in atlas_expressions:
+        win.clearBuffer()
+        draw_stimulus(face,
+                      expression,
+                      pos = (0, 0))
+
+        frame = win.getMovieFrame(buffer = "back")
+        win.movieFrames.remove(frame)
+
+        tile = frame.crop(box).convert("L").resize((atlas_res, atlas_res), Image.LANCZOS)
+        tiles.append(np.flipud(np.asarray(tile, dtype = float)))
+
+    win.clearBuffer()
+
+    atlas = np.concatenate(tiles, axis = 1)
+    atlas = atlas / max(atlas.max(), 1) * 2 - 1
+
+    return box_size, atlas
+
+
+
+def preload_atlas_stimuli(win: visual.Window,
+                          set_size: int) -> Dict[str, Any]:
+    """
+    Renders the face atlas and preloads one element array of textured quads per expression.
+    The atlas remembers the stim_size and pix_per_cm it was rendered for, so refresh_atlas_stimuli
+    can rebuild it when either of them changes.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the stimuli will be displayed.
+    set_size : int
+        The maximal number of smileys per display.
+
+    Returns
+    -------
+    stimuli : dict
+        A dictionary with the "mode", the "capacity", the "key" the atlas was rendered for, the "atlas" itself and the element arrays per expression in "faces".
+    """
+
+    try:
+        box_size, atlas = render_face_atlas(win)
+
+        faces = {}
+        for i, expression in enumerate(atlas_expressions):
+            faces[expression] = visual.ElementArrayStim(win = win,
+                                                        units = "cm",
+                                                        nElements = set_size,
+                                                        sizes = box_size,
+                                                        xys = np.zeros((set_size, 2)),
+                                                        elementTex = None,
+                                                        elementMask = atlas[:, i * atlas_res:(i + 1) * atlas_res],
+                                                        colors = color,
+                                                        opacities = 0,
+                                                        texRes = atlas_res)
+
+        logging.info(f"Rendered face atlas for stim_size {stim_size} and {pix_per_cm:.2f} pix/cm")
+
+        return {
+            "mode": "atlas",
+            "capacity": set_size,
+            "key": (stim_size, pix_per_cm),
+            "atlas": atlas,
+            "faces": faces
+        }
+
+    except Exception as e:
+        logging.error(f"Error preloading atlas stimuli: {e}")
+
+
+
+def refresh_atlas_stimuli(stimuli: Any) -> None:
+    """
+    Rebuilds the atlas if stim_size or pix_per_cm changed since it was rendered. Called between trials,
+    e.g. before a block, so the rendering never delays a display. If the rebuild fails, the old atlas is kept.
+
+    Parameters
+    ----------
+    stimuli : list of dict or dict
+        The stimuli as returned by preload_display. Stimuli of the other render modes are left as they are.
+    """
+
+    if not isinstance(stimuli, dict) or stimuli.get("mode") != "atlas" or stimuli["key"] == (stim_size, pix_per_cm):
+        return
+
+    win = stimuli["faces"]["neutral"].win
+    rebuilt = preload_atlas_stimuli(win, stimuli["capacity"])
+
+    if rebuilt is None:
+        logging.error(f"Keeping the face atlas rendered for stim_size {stimuli['key'][0]} and {stimuli['key'][1]:.2f} pix/cm")
+        return
+
+    stimuli.update(rebuilt)
+
+
+
+def prepare_atlas_display(stimuli: Dict[str, Any],
+                          target_state: str,
+                          target_loc: Tuple[float, float],
+                          distractor_loc: List[Tuple[float, float]],
+                          parts: Optional[Dict[str, np.ndarray]] = None) -> List[visual.ElementArrayStim]:
+    """
+    Places a whole search display as textured quads without drawing it, one element array per expression shown.
+
+    Parameters
+    ----------
+    stimuli : dict
+        The atlas stimuli as returned by preload_atlas_stimuli.
+    target_state : str
+        The emotional expression of the target.
+    target_loc : tuple
+        The (x, y) position of the target.
+    distractor_loc : list of tuple
+        The (x, y) positions of the neutral distractors.
+    parts : dict, optional
+        The positions of the parts of the target and the distractors, in this order, as returned by GridGeometry.select.
+        Computed from target_loc and distractor_loc if None.
+
+    Returns
+    -------
+    list of ElementArrayStim
+        The element arrays to draw.
+    """
+
+    if parts is None:
+        parts = smiley_parts([target_loc] + list(distractor_loc))
+
+    centers = parts["head"]
+    expressions = np.array([target_state] + ["neutral"] * (len(centers) - 1))
+
+    draw_list = []
+
+    for expression, faces in stimuli["faces"].items():
+        face_centers = centers[expressions == expression]
+
+        if len(face_centers):
+            place_elements(faces, face_centers)
+            draw_list.append(faces)
+
+    return draw_list
+
+
+
+def prepare_display(stimuli: Union[List[Dict[str, Any]], Dict[str, Any]],
+                    target_state: str,
+                    target_loc: Tuple[float, float],
+                    distractor_loc: List[Tuple[float, float]],
+                    parts: Optional[Dict[str, np.ndarray]] = None) -> List[Any]:
+    """
+    Places a whole search display with the renderer the stimuli were preloaded for,
+    either smiley by smiley ("vector"), all at once in element arrays ("batched") or as textured quads ("atlas"),
+    and returns what has to be drawn, so the display can be prepared well before it is shown.
+
+    Parameters
+    ----------
+    stimuli : list of dict or dict
+        The stimuli as returned by preload_stimuli, preload_batched_stimuli or preload_atlas_stimuli.
+    target_state : str
+        The emotional expression of the target.
+    target_loc : tuple
+        The (x, y) position of the target.
+    distractor_loc : list of tuple
+        The (x, y) positions of the neutral distractors.
+    parts : dict, optional
+        The positions of the parts of the target and the distractors, in this order, as returned by GridGeometry.select.
+        Computed from target_loc and distractor_loc if None.
+
+    Returns
+    -------
+    list
+        The stimuli to draw, in drawing order.
+    """
+
+    if isinstance(stimuli, dict) and stimuli.get("mode") == "batched":
+        return prepare_batched_display(stimuli,
+                                       target_state,
+                                       target_loc,
+                                       distractor_loc,
+                                       parts)
+
+    if isinstance(stimuli, dict) and stimuli.get("mode") == "atlas":
+        return prepare_atlas_display(stimuli,
+                                     target_state,
+                                     target_loc,
+                                     distractor_loc,
+                                     parts)
+
+    if parts is None:
+        parts = smiley_parts([target_loc] + list(distractor_loc))
+
+    draw_list = place_stimulus(stimuli[0],
+                               target_state,
+                               parts,
+                               0)
+
+    for i in range(1, len(parts["head"])):
+        draw_list += place_stimulus(stimuli[i],
+                                    "neutral",
+                                    parts,
+                                    i)
+
+    return draw_list
+
+
+
+def preload_display(win: visual.Window,
+                    set_size: int) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Preloads the stimuli for the configured render mode.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the stimuli will be displayed.
+    set_size : int
+        The maximal number of smileys per display.
+
+    Returns
+    -------
+    list of dict or dict
+        The preloaded stimuli, to be placed with prepare_display.
+    """
+
+    if render_mode == "batched":
+        return preload_batched_stimuli(win,
+                                       set_size)
+
+    if render_mode == "atlas":
+        return preload_atlas_stimuli(win,
+                                     set_size)
+
+    return preload_stimuli(win,
+                           set_size)
+
+
+
+def load_rectangles(win: visual.Window,
+                    positions: List[Tuple[float, float]]) -> None:
+    """
+    Creates a rectangle for every positions.
+
+    Parameters
+    ----------
+    win: visual.Window
+        THe window the rectangles will be displayed in.
+    positions : list of tuple
+        A list of (x, y) coordinates representing the grid positions.
+    """
+    try:
+        rectangles = []
+
+        rect_size = stim_size
+
+        for pos in positions:
+            rectangle = visual.Rect(
+                win = win,
+                units = "cm",
+                size = (rect_size, rect_size),
+                fillColor = color,
+                pos = pos
+                )
+            rectangles.append(rectangle)
+
+        logging.info(f"{len(rectangles)} rectangles loaded")
+        return rectangles
+    
+    except Exception as e:
+        logging.info(f"Error loading {len(positions)} rectangles: {e}")
+
+
+
+def load_rectangle_array(win: visual.Window,
+                         positions: np.ndarray) -> visual.ElementArrayStim:
+    """
+    Creates one element array holding a rectangle for every position, which draws the whole grid with a single draw call.
+
+    Parameters
+    ----------
+    win: visual.Window
+        The window the rectangles will be displayed in.
+    positions : numpy.ndarray
+        An (n, 2) array of the grid positions.
+
+    Returns
+    -------
+    visual.ElementArrayStim
+        The rectangles.
+    """
+    try:
+        rectangles = visual.ElementArrayStim(win = win,
+                                             units = "cm",
+                                             nElements = len(positions),
+                                             sizes = stim_size,
+                                             xys = np.asarray(positions, dtype = float),
+                                             elementTex = None,
+                                             elementMask = None,
+                                             colors = color)
+
+        logging.info(f"{len(positions)} rectangles loaded as element array")
+        return rectangles
+    
+    except Exception as e:
+        logging.error(f"Error loading {len(positions)} rectangles as element array: {e}")
+
+
+
+def display_grid(win: visual.Window, 
+                 positions: List[Tuple[float, float]], 
+                 rectangles: List[visual.Rect],
+                 row_color: Union[str, Tuple[float, float, float]], 
+                 col_color: Union[str, Tuple[float, float, float]]) -> Tuple[float, float]:
+    """
+    Displays the rectangle grid at all possible positions as well as the (colored) row 
+    and column numbers for the localization task and returns the time it took to draw them before the flip and the flip timestamp.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the grid and numbers will be displayed.
+    positions : list of tuple
+        A list of (x, y) coordinates representing the grid positions.
+    rectangles : list of visual.Rect
+        A list of visual.Rect objects that will be displayed at the positions.
+    row_color : str or list
+        The color used for the row labels.
+    col_color : str or list
+        The color used for the column labels.
+
+    Returns
+    -------
+    prep_time : float
+        The draw-preparation time of the grid in seconds.
+    flip_time : float
+        The flip timestamp of the grid.
+    """
+
+    prep_start = time.perf_counter()
+
+    # Extracts the x-coordinates of the "first" row of the grid/matrix positions and 
+    # displays the column numbers spacing value below the "first" row
+    col_positions = [pos[0] for pos in positions[:cols]]
+
+    for i, pos in enumerate(col_positions):
+        present_text(win, 
+                     text = str(i + 1), 
+                     pos = (pos, positions[0][1] - spacing), 
+                     textColor = col_color)
+
+    # Extracts the y-coordinates of the "first" column of the grid/matrix positions and 
+    # displays the row numbers the spacing value to the left of the "first" column
+    row_positions = [pos[1] for pos in positions[::cols]]
+
+    for i, pos in enumerate(row_positions):
+        present_text(win, 
+                     text = str(i + 1), 
+                     pos = (positions[0][0] - spacing, pos), 
+                     textColor = row_color)
+
+
+    for rect in rectangles:
+        rect.draw()
+
+    prep_time = time.perf_counter() - prep_start
+    flip_time = win.flip()
+
+    return prep_time, flip_time
+
+
+
+def get_grid_response(win: visual.Window, 
+                      positions: List[Tuple[float, float]],
+                      rectangles: List[visual.Rect],
+                      row_color: Union[str, Tuple[float, float, float]] = "White", 
+                      col_color: Union[str, Tuple[float, float, float]] = "White",
+                      is_training: bool = False,
+                      row_response: bool = False,
+                      timing: Optional[Dict[str, float]] = None) -> str:
+    """
+    Collects the participant's response for either row or column selection and displays the grid.
+    Up to 9 rows or columns are answered with a single key. Larger grids are answered with a typed number, shown below the grid,
+    which can be corrected with grid_delete_key and is accepted with grid_confirm_key once it is a valid row or column.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where the grid will be displayed.
+    positions : list of tuple
+        The list of (x, y) positions for the grid.
+    rectangles : list of visual.Rect
+        A list of visual.Rect objects that will be displayed at the positions, or a single element array holding all of them.
+    row_color : str, optional
+        Color of the row numbers displayed on the grid. Defaults to "White".
+    col_color : str, optional
+        Color of the column numbers displayed on the grid. Defaults to "White".
+    is_training : bool, optional
+        Whether the trial is part of a training phase. Defaults to False.
+    row_response : bool, optional
+        Indicates whether the response is for a row (True) or a column (False). Defaults to False.
+    timing : dict, optional
+        If given, the draw-preparation time of the grid is added to its "grid_prep_time". The first flip of the grid is stored
+        as "row_grid_flip_time" or "col_grid_flip_time" with the time since the flip in "last_flip_time" as "row_grid_flip_interval"
+        or "col_grid_flip_interval", and "last_flip_time" is updated with every flip.
+
+    Returns
+    -------
+    str
+        The row or column number as selected by the participant.
+    """
+
+
+    n_options = rows if row_response else cols
+    multi_digit = n_options > 9
+
+    if multi_digit:
+        key_list = [str(i) for i in range(10)] + [grid_confirm_key, grid_delete_key]
+    else:
+        key_list = [str(i) for i in range(1, n_options + 1)]
+
+    if row_response:
+        text = "In welcher Reihe war der abweichende Smiley?"
+    else:
+        text = "In welcher Spalte war der abweichende Smiley?"
+
+    if multi_digit:
+        text += f" Geben Sie die Nummer (1 bis {n_options}) ein und bestätigen Sie mit '{grid_confirm_key.upper()}'."
+    else:
+        text += f" Nutzen Sie zur Eingabe die Tasten '1' bis '{n_options}'."
+
+    typed = ""
+
+    # The grid is shown again after every typed digit, together with the number typed so far
+    while True:
+        if is_training:
+            present_text(win,
+                         text,
+                         pos = (0, (height_cm / 2) - (spacing / 2)))
+
+        if multi_digit:
+            present_text(win,
+                         f"{'Reihe' if row_response else 'Spalte'}: {typed}",
+                         pos = (0, positions[0][1] - 2 * spacing))
+
+        prep_time, flip_time = display_grid(win, 
+                                            positions,
+                                            rectangles, 
+                                            row_color,
+                                            col_color)
+
+        if timing is not None:
+            timing["grid_prep_time"] = timing.get("grid_prep_time", 0.0) + prep_time
+
+            screen = "row" if row_response else "col"
+            if f"{screen}_grid_flip_time" not in timing:
+                timing[f"{screen}_grid_flip_time"] = flip_time
+                timing[f"{screen}_grid_flip_interval"] = flip_time - timing.get("last_flip_time", flip_time)
+            timing["last_flip_time"] = flip_time
+
+        key = wait_keys(win, key_list)[0]
+
+        if not multi_digit:
+            return key
+
+        if key == grid_delete_key:
+            typed = typed[:-1]
+
+        elif key == grid_confirm_key:
+            if typed and 1 <= int(typed) <= n_options:
+                return str(int(typed))
+
+        elif len(typed) < len(str(n_options)):
+            typed += key
+
+
+
+def response_keys(number: int,
+                  n_options: int) -> List[str]:
+    """
+    Returns the keys entering a row or column number in get_grid_response: the number's key for up to 9 options,
+    otherwise its digits followed by grid_confirm_key.
+    """
+
+    if n_options <= 9:
+        return [str(number)]
+
+    return list(str(number)) + [grid_confirm_key]
+
+
+
+@functools.lru_cache(maxsize = 1)
+def get_keyboard() -> hardware_keyboard.Keyboard:
+    """
+    Returns the high-resolution keyboard used to measure reaction times. It is created on first use and reused afterwards.
+    Key presses are timestamped by the keyboard backend (Psychtoolbox if available) instead of the pyglet event queue.
+
+    Returns
+    -------
+    Keyboard
+        The shared keyboard.
+    """
+
+    return hardware_keyboard.Keyboard()
+
+
+
+class SimulatedKeyboard:
+    """
+    A stand-in for the keyboard, that answers waitKeys with scripted key presses, so the reaction time capture
+    can be run without a participant. Every response is a (key, delay) pair and the key press is timestamped
+    delay seconds after the last flip of the window it was bound to (or after the time of the call if unbound).
+
+    Parameters
+    ----------
+    responses : iterable of tuple
+        The (key, delay) pairs to answer with, in order.
+    win : visual.Window or HeadlessWindow, optional
+        The window whose flips the key presses follow. capture_reaction_time binds the keyboard to its window on the onset flip.
+    clock : callable, optional
+        The clock providing the current time. Defaults to the time base of the window's flips (see get_time),
+        which is the virtual clock of a HeadlessWindow.
+    """
+
+    def __init__(self,
+                 responses: Iterable[Tuple[str, float]],
+                 win: Optional[Any] = None,
+                 clock: Optional[Callable[[], float]] = None) -> None:
+
+        self.responses = iter(responses)
+        self.win = win
+        self.clock = clock
+        self.last_flip = None
+
+
+    def now(self) -> float:
+        """Returns the current time of the clock, or else in the time base of the window."""
+
+        return self.clock() if self.clock is not None else get_time(self.win)
+
+
+    def on_flip(self, 
+                win: Optional[Any] = None) -> None:
+        """Binds the keyboard to the window, if given, and remembers the time of the flip, to be registered with win.callOnFlip."""
+
+        if win is not None:
+            self.win = win
+
+        self.last_flip = self.now()
+
+
+    def clearEvents(self, 
+                    eventType: Optional[str] = None) -> None:
+        """Does nothing, as scripted key presses can't be pressed too early."""
+
+
+    def waitKeys(self, 
+                 keyList: Optional[List[str]] = None, 
+                 **kwargs) -> List[SimpleNamespace]:
+        """Returns the next scripted key press, timestamped like a key press of the Keyboard."""
+
+        key, delay = next(self.responses)
+        t_start = self.now() if self.last_flip is None else self.last_flip
+
+        return [SimpleNamespace(name = key, tDown = t_start + delay, rt = delay)]
+
+
+
+def capture_reaction_time(win: visual.Window,
+                          keyboard: Any,
+                          key_list: List[str]) -> Tuple[float, float, float]:
+    """
+    Flips the window to show the drawn display and measures the reaction time from the actual flip timestamp
+    to the hardware timestamp of the first key press. Keys pressed before the flip are discarded on the flip itself.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window with the display drawn to its back buffer.
+    keyboard : Keyboard or SimulatedKeyboard
+        The key source used to collect the response.
+    key_list : list of str
+        The keys that count as a response.
+
+    Returns
+    -------
+    rt : float
+        The reaction time in seconds, measured from the flip timestamp.
+    flip_latency : float
+        The time in seconds from the flip timestamp until win.flip returned.
+    flip_time : float
+        The flip timestamp of the onset.
+    """
+
+    win.callOnFlip(keyboard.clearEvents, 
+                   eventType = "keyboard")
+
+    if isinstance(keyboard, SimulatedKeyboard):
+        win.callOnFlip(keyboard.on_flip, win)
+
+    flip_time = win.flip()
+    flip_latency = get_time(win) - flip_time
+
+    if is_headless(win) or isinstance(keyboard, SimulatedKeyboard):
+        key = keyboard.waitKeys(keyList = key_list)[0]
+    else:
+        # Key presses carry their hardware timestamps, so polling leaves the reaction time unaffected
+        key = scheduler.run(lambda: keyboard.getKeys(keyList = key_list, 
+                                                     waitRelease = False),
+                            run_idle = False)[0]
+
+    rt = key.tDown - flip_time
+
+    return rt, flip_latency, flip_time
+
+
+
+def frame_period(win: visual.Window) -> float:
+    """
+    Returns the refresh period of the monitor in seconds, as measured by PsychoPy when the window was created.
+    """
+
+    if is_headless(win):
+        return win.frame_period
+
+    return win.monitorFramePeriod
+
+
+
+def draw_ready_screen(win: visual.Window,
+                      continue_key: str,
+                      is_training: bool = False) -> None:
+    """
+    Draws the screen asking to press the continue key to show the next display, with a help text during training.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window the screen will be drawn in.
+    continue_key : str
+        The key that participants must press to continue to the next display.
+    is_training : bool, optional
+        Whether the trial is part of a training phase. Defaults to False.
+    """
+
+    present_text(win, 
+                 text = f"'{continue_key.upper()}'")
+
+    if is_training:
+        present_text(win, 
+                     text = f"'{continue_key.upper()}' drücken um das nächste Display anzuzeigen.",
+                     pos = (0, (height_cm / 2) - (spacing / 2)))
+
+
+
+frame_timing_columns = ["draw_prep_time", "onset_flip_time", "onset_frame_interval", "keypress_to_onset", "onset_dropped_frames", "grid_prep_time", 
+                        "row_grid_flip_time", "row_grid_flip_interval", "col_grid_flip_time", "col_grid_flip_interval", "flip_latency"]
+
+
+
+def summarize_frame_timing(trials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Summarizes the frame timing of a session by the 50th, 90th, 99th and 100th percentile of every timing measure (in milliseconds)
+    and the number of trials whose onset was compromised by a dropped frame.
+
+    Parameters
+    ----------
+    trials : list of dict
+        The trial data of the session, containing the frame_timing_columns.
+
+    Returns
+    -------
+    dict
+        The percentiles of every measure, the number of "trials" and the number of "compromised_trials".
+    """
+
+    summary = {"trials": len(trials),
+               "compromised_trials": sum(not trial["onset_timing_ok"] for trial in trials)}
+
+    for column in ("draw_prep_time", "onset_frame_interval", "keypress_to_onset", "grid_prep_time", "flip_latency"):
+        values = np.array([trial[column] for trial in trials], dtype = float) * 1000
+        percentiles = np.percentile(values, [50, 90, 99, 100]) if len(values) else [np.nan] * 4
+
+        summary[f"{column}_ms"] = dict(zip(["p50", "p90", "p99", "max"], map(float, percentiles)))
+
+    return summary
+
+
+
+def prepare_trial(win: visual.Window,
+                  set_size: int,
+                  positions: List[Tuple[float, float]],
+                  target_state: str,
+                  stimuli: Union[List[Dict[str, Any]], Dict[str, Any]],
+                  continue_key: str,
+                  is_training: bool = False,
+                  target_index: Optional[int] = None,
+                  distractor_indices: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    Prepares the complete search display of a trial without drawing it: selects the positions, places the stimuli
+    and lays out the help text of training trials. Drawing the returned draw list is all that is left before the onset.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where stimuli will be displayed.
+    set_size : int
+        The number of stimuli (target and distractors) to display during the trial.
+    positions : list of tuple
+        A list of (x, y) coordinates that specify the positions where stimuli will be drawn on the screen.
+    target_state : str
+        The emotional expression of the target stimulus.
+    stimuli : list of dict or dict
+        The preloaded smiley stimuli as returned by preload_display.
+    continue_key : str
+        The key that participants must press when they found the target.
+    is_training : bool, optional
+        Whether the trial is part of a training phase, which adds the help text. Defaults to False.
+    target_index : int, optional
+        The index of the target's position in positions. Drawn at random if None.
+    distractor_indices : numpy.ndarray, optional
+        The indices of the distractors' positions in positions. Drawn at random if None.
+
+    Returns
+    -------
+    dict
+        The "draw_list" of the display, the "target_index", "target_row" and "target_col" and the "search_display"
+        a simulated participant answers to in headless mode.
+    """
+
+    if target_index is None:
+        target_index = random.randrange(len(positions))
+        distractor_indices = random.sample([i for i in range(len(positions)) if i != target_index], set_size - 1)
+
+    # Converts target's position list index into row and column numbers
+    target_row = 1 + target_index // cols
+    target_col = 1 + target_index % cols
+
+    draw_list = []
+
+    if not is_headless(win):
+        # The parts of every cell are precomputed, unless the positions are not those of the grid's geometry
+        geometry = get_geometry(win, rows, cols)
+        cells = np.concatenate(([target_index], distractor_indices)).astype(int)
+        parts = geometry.select(cells) if positions is geometry.positions else None
+
+        draw_list = prepare_display(stimuli,
+                                    target_state,
+                                    positions[target_index],
+                                    [positions[i] for i in distractor_indices],
+                                    parts)
+
+        if is_training:
+            draw_list.append(get_text_pool(win).get(f"Abweichenden Smiley so schnell wie möglich finden und wenn gefunden die Taste '{continue_key.upper()}' drücken.",
+                                                    pos = (0, (height_cm / 2) - (spacing / 2)),
+                                                    height = text_height,
+                                                    textColor = color))
+
+    return {"draw_list": draw_list,
+            "target_index": target_index,
+            "target_row": target_row,
+            "target_col": target_col,
+            "search_display": {"key": continue_key,
+                               "set_size": set_size,
+                               "target_state": target_state,
+                               "target_row": target_row,
+                               "target_col": target_col}}
+
+
+
+def prefetch_trial(prefetched: Dict[int, Dict[str, Any]],
+                   trial_index: int,
+                   *args, 
+                   **kwargs) -> Callable[[], bool]:
+    """
+    Returns an idle task that prepares a trial with prepare_trial and stores the result in prefetched under trial_index.
+    Registered once the current search display has been answered, it runs during the grid and feedback waits.
+
+    Parameters
+    ----------
+    prefetched : dict
+        The prepared trials by their index in the schedule.
+    trial_index : int
+        The index of the trial to prepare.
+    *args, **kwargs
+        The arguments passed to prepare_trial.
+
+    Returns
+    -------
+    callable
+        The idle task, see run_idle_task.
+    """
+
+    def task() -> bool:
+        prefetched[trial_index] = prepare_trial(*args, **kwargs)
+        return False
+
+    return task
+
+
+
+def end_stage(stage_times: Dict[str, float],
+              stage: str,
+              start: float) -> float:
+    """
+    Records the wall time of a trial stage, that started at start on the perf_counter clock, and returns the current time as start of the next stage.
+    """
+
+    now = time.perf_counter()
+    stage_times[stage] = now - start
+
+    return now
+
+
+
+def run_trial(win: visual.Window, 
+              set_size: int, 
+              positions: List[Tuple[float, float]], 
+              rectangles: List[visual.Rect],
+              target_state: str,
+              stimuli: List[Dict[str, Any]],
+              continue_key: str,
+              is_training: bool = False,
+              target_index: Optional[int] = None,
+              distractor_indices: Optional[np.ndarray] = None,
+              keyboard: Optional[Any] = None,
+              prepared: Optional[Dict[str, Any]] = None,
+              prefetch: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """
+    Executes a single trial in the main experiment or training phase, displaying stimuli at randomly selected positions and recording 
+    the participant's responses. It presents a target with a specified emotional expression, that has to be found 
+    among a specified amount of neutral distractors, then asks the participant to identify the target's position.
+    Returns a dictionary with trial data, including the tested condition (target state and display size), reaction time, accuracy, 
+    target location and the participant's response.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where stimuli will be displayed.
+    set_size : int
+        The number of stimuli (target and distractors) to display during the trial.
+    positions : list of tuple
+        A list of (x, y) coordinates that specify the positions where stimuli will be drawn on the screen.
+    rectangles : list of visual.Rect
+        A list of visual.Rect objects that will be displayed at the positions.
+    target_state : str
+        The emotional expression of the target stimulus. Possible values are "positive" or "negative".
+    stimuli : list of dict or dict
+        The preloaded smiley stimuli as returned by preload_display, either one dict of visual elements per item or the batched element arrays.
+    continue_key : str
+        The key that participants must press to continue to the next display.
+    is_training : bool, optional
+        Whether the trial is part of a training phase. Defaults to False.
+    target_index : int, optional
+        The index of the target's position in positions, as precomputed in the trial schedule. Drawn at random if None.
+    distractor_indices : numpy.ndarray, optional
+        The indices of the distractors' positions in positions, as precomputed in the trial schedule. Drawn at random if None.
+    keyboard : Keyboard or SimulatedKeyboard, optional
+        The key source used to measure the reaction time. Defaults to the shared hardware keyboard.
+    prepared : dict, optional
+        The display of this trial as prepared in advance by prepare_trial. Prepared before the ready screen if None.
+    prefetch : callable, optional
+        An idle task preparing the next trial, see prefetch_trial. It is registered once the search display has been answered,
+        so the next display is prepared during the grid and feedback waits.
+
+    Returns
+    -------
+    dict
+        A dictionary containing trial data:
+            - "block" (int): 0.
+            - "trial_num" (int): 0.
+            - "set_size" (int): Number of stimuli displayed during the trial.
+            - "target_state" (str): Emotional expresion of the target ("positive" or "negative").
+            - "target_position" (tuple): Grid position of the target, as (row, column).
+            - "reaction_time" (float): Participant's reaction time in seconds, measured from the onset flip.
+            - "flip_latency" (float): Time in seconds from the onset flip until the flip returned.
+            - "draw_prep_time" (float): Time in seconds it took to draw the prepared search display into the back buffer.
+            - "onset_flip_time" (float): Timestamp of the onset flip.
+            - "onset_frame_interval" (float): Time in seconds between the flip of the ready screen and the onset flip.
+            - "keypress_to_onset" (float): Time in seconds from the key press on the ready screen to the onset flip.
+            - "onset_dropped_frames" (int): Number of frames the onset flip came later than the first frame after the key press.
+            - "onset_timing_ok" (bool): Whether the onset came without a dropped frame.
+            - "grid_prep_time" (float): Time in seconds it took to draw both grid screens before their flips.
+            - "row_grid_flip_time", "col_grid_flip_time" (float): Timestamps of the first flips of the row and the column grid.
+            - "row_grid_flip_interval", "col_grid_flip_interval" (float): Time in seconds from the flip before to these flips.
+            - "response" (tuple): The participant's response, in terms of (row, column) position.
+            - "accuracy" (bool): Whether the participant's response was correct (True/False).
+            - "stage_times" (dict): Wall time in seconds of the "ready_screen", "search_display", "grid_responses" and "feedback" stages.
+    """
+
+    try:
+        stage_times = {}
+        stage_start = time.perf_counter()
+
+        if prepared is None:
+            prepared = prepare_trial(win,
+                                     set_size,
+                                     positions,
+                                     target_state,
+                                     stimuli,
+                                     continue_key,
+                                     is_training = is_training,
+                                     target_index = target_index,
+                                     distractor_indices = distractor_indices)
+
+        target_row = prepared["target_row"]
+        target_col = prepared["target_col"]
+
+        if keyboard is None:
+            keyboard = win.participant if is_headless(win) else get_keyboard()
+
+        draw_ready_screen(win,
+                          continue_key,
+                          is_training)
+        win.callOnFlip(keyboard.clearEvents, 
+                       eventType = "keyboard")
+        ready_flip_time = win.flip()
+
+        # Draws the prepared display into the back buffer while the ready screen is shown, 
+        # so only the onset flip is left after the key press
+        prep_start = time.perf_counter()
+
+        for stim in prepared["draw_list"]:
+            stim.draw()
+
+        draw_prep_time = time.perf_counter() - prep_start
+
+        if is_headless(win) or isinstance(keyboard, SimulatedKeyboard):
+            _, key_time = wait_keys(win, 
+                                    continue_key, 
+                                    timestamped = True, 
+                                    run_idle = False)[0]
+        else:
+            # The hardware timestamp of the key press, as the poll timestamp of event.getKeys adds the input latency
+            key_time = scheduler.run(lambda: keyboard.getKeys(keyList = [continue_key], 
+                                                              waitRelease = False),
+                                     run_idle = False)[0].tDown
+
+        stage_start = end_stage(stage_times, "ready_screen", stage_start)
+
+        if is_headless(win):
+            win.search_display = prepared["search_display"]
+
+        rt, flip_latency, onset_flip_time = capture_reaction_time(win,
+                                                                  keyboard,
+                                                                  [continue_key])
+
+        stage_start = end_stage(stage_times, "search_display", stage_start)
+
+        if prefetch is not None:
+            idle_tasks.append(prefetch)
+
+        # The onset is due with the first frame after the key press. Frames are counted from the flip of the ready screen,
+        # so the onset's frame is measured on the flip timestamps. A key press within a tenth of a frame before a frame
+        # is tolerated to make only the frame after, as jitter of the timestamps
+        keypress_to_onset = onset_flip_time - key_time
+        onset_frame_interval = onset_flip_time - ready_flip_time
+        due_frame = math.floor((key_time - ready_flip_time) / frame_period(win) + 0.1) + 1
+        onset_dropped_frames = max(0, round(onset_frame_interval / frame_period(win)) - due_frame)
+        timing = {"grid_prep_time": 0.0,
+                  "last_flip_time": onset_flip_time}
+
+
+        row_response = get_grid_response(win, 
+                                        positions,
+                                        rectangles,
+                                        row_color = color2, 
+                                        col_color = color,
+                                        is_training = is_training,
+                                        row_response = True,
+                                        timing = timing)
+
+        col_response = get_grid_response(win, 
+                                        positions,  
+                                        rectangles,
+                                        row_color = color, 
+                                        col_color = color2,
+                                        is_training = is_training,
+                                        timing = timing)
+
+        stage_start = end_stage(stage_times, "grid_responses", stage_start)
+
+
+        # Checks if the given input matches the target's row and column
+        if int(row_response) == target_row and int(col_response) == target_col:
+            accuracy = True
+            feedback = "Ihre Antwort ist richtig."
+
+        else:
+            accuracy = False
+            feedback = "Ihre Antwort ist falsch."
+        
+        wait(win, feedback_delay)
+
+        if is_training and not accuracy:
+            present_text(win,
+                         text = feedback + f"\n\nSie haben Reihe: {row_response} und Spalte: {col_response} geantwortet. \n\nRichtige wäre Reihe: {target_row} und Spalte: {target_col}.",
+                         flip = True)
+            wait(win, feedback_duration * 4)
+            
+        else:
+            present_text(win, 
+                         text = feedback,
+                         flip = True)
+        
+            wait(win, feedback_duration)
+
+        end_stage(stage_times, "feedback", stage_start)
+
+
+        logging.info(f"Trial Data: RT: {rt}, ACC: {accuracy}, SIZE: {set_size}, STATE: {target_state}, LOC: {(target_row, target_col)}, RES: {(int(row_response), int(col_response))}, "
+                     f"PREP: {draw_prep_time * 1000:.2f} ms, KEYPRESS TO ONSET: {keypress_to_onset * 1000:.2f} ms, DROPPED: {onset_dropped_frames}")
+        
+
+        return {
+            "block": 0,
+            "trial_num": 0,
+            "set_size": set_size,
+            "target_state": target_state,
+            "target_position": (target_row, target_col),
+            "reaction_time": rt,
+            "flip_latency": flip_latency,
+            "draw_prep_time": draw_prep_time,
+            "onset_flip_time": onset_flip_time,
+            "onset_frame_interval": onset_frame_interval,
+            "keypress_to_onset": keypress_to_onset,
+            "onset_dropped_frames": onset_dropped_frames,
+            "onset_timing_ok": onset_dropped_frames == 0,
+            "grid_prep_time": timing["grid_prep_time"],
+            "row_grid_flip_time": timing["row_grid_flip_time"],
+            "row_grid_flip_interval": timing["row_grid_flip_interval"],
+            "col_grid_flip_time": timing["col_grid_flip_time"],
+            "col_grid_flip_interval": timing["col_grid_flip_interval"],
+            "response": (int(row_response), int(col_response)),
+            "accuracy": accuracy,
+            "stage_times": stage_times
+        }
+    
+    except Exception as e:
+        logging.error(f"Error running trial: {e}")
+
+
+
+def run_training(win: visual.Window, 
+                 positions: List[Tuple[float, float]],
+                 rectangles: List[visual.Rect],
+                 training_set_size: int,
+                 stimuli: List[Dict[str, Any]],
+                 training_trials: int,
+                 continue_key: str) -> None:
+    """
+    Runs the training phase of the experiment, repeating trials until the participant answers 
+    the required number of trials correctly.
+
+    Parameters
+    ----------
+    win : visual.Window
+        The window where stimuli, grid and feedback will be presented.
+    positions : list of tuple
+        A list of positions for the stimuli.
+    rectangles : list of visual.Rect
+        A list of visual.Rect objects that will be displayed at the positions.
+    training_set_size : int
+        The number of stimuli to present during each training trial.
+    stimuli : list of dict
+        The preloaded smiley stimuli used during the training trials.
+    training_trials : int
+        The number of correctly answered trials required to complete training.
+    continue_key : str
+        The key the participant presses to continue between trials.
+    """
+
+    try:
+        logging.info("Starting training phase")
+        refresh_atlas_stimuli(stimuli)
+
+        correct_train_trials = 0
+        total_train_trials = 0
+
+        unused_target_states = target_states.copy()
+        random.shuffle(unused_target_states)
+
+        while correct_train_trials < training_trials:
+            if not unused_target_states:
+                unused_target_states = target_states.copy() 
+                random.shuffle(unused_target_states) 
+
+            target_state = unused_target_states.pop()
+            trial_data = run_trial(win, 
+                                   training_set_size, 
+                                   positions,
+                                   rectangles,
+                                   target_state,
+                                   stimuli,
+                                   continue_key,
+                                   is_training = True)
+            
+            total_train_trials += 1
+
+            if trial_data["accuracy"]:
+                correct_train_trials += 1
+
+        present_text(win, 
+                    text = training_end_text(continue_key),
+                    pos = (0, 0),
+                    flip = True)
+
+        wait_keys(win, continue_key)
+
+        logging.info(f"Training completed in {total_train_trials} trials")
+
+    except Exception as e:
+        logging.error(f"Error during training: {e}")
+
+
+
+def get_participant_info(info: Dict[str, str]) -> Dict[str, str]:
+    """
+    Collects participant information using a graphical user interface.
+
+    Parameters
+    ----------
+    info : dict
+        A dictionary containing the fields and default values for the participant information to enter.
+
+    Returns
+    -------
+    dict
+        The updated dictionary with the input.
+    """
+
+    try:
+        info_data = gui.DlgFromDict(title = "Supervisor Input", dictionary = info)
+        if info_data.OK:
+            print("Info: Data entry succesful")
+            return info
+        
+        else:
+            print("Warning: Exited setup during data input.")
+            core.quit()
+
+    except Exception as e:
+        print(f"Error collecting participant info: {e}")
+        core.quit()
+
+
+
+result_columns = ["sub_id", "age", "sex", "vision", "handedness", "block", "trial", "target_state", "set_size",
+                  "reaction_time", "flip_latency", "target_position", "response", "accuracy",
+                  "draw_prep_time", "onset_flip_time", "onset_frame_interval", "keypress_to_onset", "onset_dropped_frames", "onset_timing_ok", 
+                  "grid_prep_time", "row_grid_flip_time", "row_grid_flip_interval", "col_grid_flip_time", "col_grid_flip_interval"]
+
+
+
+def trial_record(subject_info: Dict[str, str],
+                 trial_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Combines the participant information and the data of a single trial into one record with the result_columns as keys.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    trial_data : dict
+        A dictionary containing the data from an individual trial.
+
+    Returns
+    -------
+    dict
+        The record of the trial.
+    """
+
+    record = {key: subject_info[key] for key in ("sub_id", "age", "sex", "vision", "handedness")}
+    record["trial"] = trial_data["trial_num"]
+    record.update({key: trial_data[key] for key in result_columns if key in trial_data})
+
+    return {key: record[key] for key in result_columns}
+
+
+
+def new_results_path(subject_info: Dict[str, str],
+                     prefix: str = "results",
+                     extension: str = ".csv") -> str:
+    """
+    Returns the path of a new file named <prefix>_subject_<sub_id><extension> in the "results" directory, located in the same directory the script is in.
+    If a file with the same name already exists, a timestamp is appended in order to prevent overwriting it.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    prefix : str, optional
+        The beginning of the file name. Defaults to "results".
+    extension : str, optional
+        The file extension. Defaults to ".csv".
+
+    Returns
+    -------
+    str
+        The path of the new file.
+    """
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output_path = os.path.join(directory, "results")
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    output_file = os.path.join(output_path, f"{prefix}_subject_{subject_info['sub_id']}{extension}")
+
+    if os.path.exists(output_file):
+        timestamp = time.strftime("%d%m%Y-%H%M%S")
+        output_file = os.path.join(output_path, f"{prefix}_subject_{subject_info['sub_id']}_{timestamp}{extension}")
+
+    return output_file
+
+
+
+# Column types of the columnar results. "category" columns are stored as int16 codes into the categories listed in the schema.json of every results directory.
+columnar_schema = {
+    "sub_id": "category",
+    "age": "category",
+    "sex": "category",
+    "vision": "category",
+    "handedness": "category",
+    "block": "<i4",
+    "trial": "<i4",
+    "target_state": "category",
+    "set_size": "<i4",
+    "reaction_time": "<f8",
+    "flip_latency": "<f8",
+    "target_row": "<i2",
+    "target_col": "<i2",
+    "response_row": "<i2",
+    "response_col": "<i2",
+    "accuracy": "|b1",
+    "draw_prep_time": "<f8",
+    "onset_flip_time": "<f8",
+    "onset_frame_interval": "<f8",
+    "keypress_to_onset": "<f8",
+    "onset_dropped_frames": "<i2",
+    "onset_timing_ok": "|b1",
+    "grid_prep_time": "<f8",
+    "row_grid_flip_time": "<f8",
+    "row_grid_flip_interval": "<f8",
+    "col_grid_flip_time": "<f8",
+    "col_grid_flip_interval": "<f8"
+}
+
+
+
+class CsvResults:
+    """
+    Appends trial records as rows to a csv file kept open until close is called.
+
+    Parameters
+    ----------
+    path : str
+        The path of the csv file. A header row is written if the file doesn't exist yet.
+    """
+
+    def __init__(self, 
+                 path: str) -> None:
+
+        new_file = not os.path.exists(path)
+        self.file = open(path, "a", newline = "", encoding = "utf-8")
+        self.writer = csv.writer(self.file)
+
+        if new_file:
+            self.writer.writerow(result_columns)
+
+
+    def append(self, 
+               record: Dict[str, Any]) -> None:
+        """Appends a record with the result_columns as keys."""
+
+        self.writer.writerow(record.values())
+
+
+    def flush(self, 
+              fsync: bool = False) -> None:
+        """Flushes the file and, if requested, forces it to disk."""
+
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+
+    def close(self) -> None:
+        """Closes the file."""
+
+        self.file.close()
+
+
+
+class ColumnarResults:
+    """
+    Appends trial records to a typed, columnar results directory. Every column of columnar_schema is stored in its own
+    raw binary file (<column>.bin), so single columns can be memory-mapped without reading the others (see load_results).
+    Row and column of the target position and the response are stored as separate integer columns and strings as categorical codes,
+    whose categories are kept in schema.json next to the column files.
+
+    Parameters
+    ----------
+    path : str
+        The path of the results directory. It is created if it doesn't exist yet.
+    """
+
+    def __init__(self, 
+                 path: str) -> None:
+
+        self.path = path
+        self.schema_file = os.path.join(path, "schema.json")
+        os.makedirs(path, exist_ok = True)
+
+        if os.path.exists(self.schema_file):
+            with open(self.schema_file, encoding = "utf-8") as file:
+                self.categories = json.load(file)["categories"]
+        else:
+            self.categories = {column: [] for column, dtype in columnar_schema.items() if dtype == "category"}
+            self.write_schema()
+
+        self.files = {column: open(os.path.join(path, f"{column}.bin"), "ab") for column in columnar_schema}
+
+
+    def write_schema(self) -> None:
+        """Replaces schema.json with the current column types and categories."""
+
+        temp_file = self.schema_file + ".tmp"
+        with open(temp_file, "w", encoding = "utf-8") as file:
+            json.dump({"columns": columnar_schema, "categories": self.categories}, file, indent = 2)
+
+        os.replace(temp_file, self.schema_file)
+
+
+    def append(self, 
+               record: Dict[str, Any]) -> None:
+        """Appends a record with the result_columns as keys."""
+
+        values = dict(record)
+        values["target_row"], values["target_col"] = record["target_position"]
+        values["response_row"], values["response_col"] = record["response"]
+
+        for column, dtype in columnar_schema.items():
+            value = values[column]
+
+            if dtype == "category":
+                categories = self.categories[column]
+                value = str(value)
+
+                if value not in categories:
+                    categories.append(value)
+                    self.write_schema()
+
+                value = categories.index(value)
+                dtype = "<i2"
+
+            self.files[column].write(np.array(value, dtype = dtype).tobytes())
+
+
+    def flush(self, 
+              fsync: bool = False) -> None:
+        """Flushes all column files and, if requested, forces them to disk."""
+
+        for file in self.files.values():
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+
+
+    def close(self) -> None:
+        """Closes all column files."""
+
+        for file in self.files.values():
+            file.close()
+
+
+
+def open_results(path: str,
+                 format: str) -> Union[CsvResults, ColumnarResults]:
+    """
+    Opens a results file of the given format for appending trial records.
+
+    Parameters
+    ----------
+    path : str
+        The path of the csv file or columnar results directory.
+    format : str
+        Either "csv" or "columnar".
+
+    Returns
+    -------
+    CsvResults or ColumnarResults
+        The opened results.
+    """
+
+    if format == "columnar":
+        return ColumnarResults(path)
+
+    return CsvResults(path)
+
+
+
+def results_extension(format: str) -> str:
+    """
+    Returns the file extension used for results of the given format, ".cols" for "columnar" and ".csv" otherwise.
+    """
+
+    return ".cols" if format == "columnar" else ".csv"
+
+
+
+def load_results(paths: Union[str, List[str]],
+                 columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Loads one or more columnar results directories as written by ColumnarResults. Only the requested columns are read,
+    each by memory-mapping its column file, and categorical columns are returned as pandas categoricals.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        The path(s) of the results directories.
+    columns : list of str, optional
+        The columns to load. Loads all columns if None.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The requested columns of all results directories, concatenated in the given order.
+    """
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    frames = []
+    categorical = set()
+    for path in paths:
+        with open(os.path.join(path, "schema.json"), encoding = "utf-8") as file:
+            schema = json.load(file)
+
+        selected = columns or list(schema["columns"])
+        arrays = {}
+
+        for column in selected:
+            dtype = schema["columns"][column]
+            column_file = os.path.join(path, f"{column}.bin")
+            storage_dtype = "<i2" if dtype == "category" else dtype
+
+            if os.path.getsize(column_file) == 0:
+                values = np.empty(0, dtype = storage_dtype)
+            else:
+                values = np.memmap(column_file, dtype = storage_dtype, mode = "r")
+
+            if dtype == "category":
+                values = pd.Categorical.from_codes(np.asarray(values), categories = schema["categories"][column])
+                categorical.add(column)
+
+            arrays[column] = values
+
+        # A crash during an append can leave the last record incomplete in some column files
+        n_rows = min(len(values) for values in arrays.values())
+        frames.append(pd.DataFrame({column: values[:n_rows] for column, values in arrays.items()}))
+
+    results = pd.concat(frames, ignore_index = True)
+
+    # Concatenating categoricals with different categories falls back to strings
+    for column in categorical:
+        results[column] = results[column].astype("category")
+
+    return results
+
+
+
+def save_experiment_data(subject_info: Dict[str, str], 
+                         trial_data: Dict[str, Any], 
+                         output_file: Union[str, None] = None,
+                         output_format: Optional[str] = None) -> str:
+    """
+    Organizes and saves the data collected during an experimental trial into a csv file. If an output file is not specified, 
+    the function will create a new file in a "results" directory, located in the same directory the script is in and named according to the subject's ID. 
+    If a file with the same name already exists, the function will append a timestamp to create a unique filename in order to prevent overwriting off an already existing file.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    trial_data : dict
+        A dictionary containing the data from an individual trial.
+    output_file : str, optional
+        The file path for saving the results. If None, a new file is created based on the subject's ID.
+    output_format : str, optional
+        Either "csv" or "columnar", in which case the trial is appended to a typed, columnar results directory (see ColumnarResults). 
+        Defaults to the global results_format variable.
+    """
+    try:
+        output_format = output_format or results_format
+        record = trial_record(subject_info, 
+                              trial_data)
+
+        if output_file is None:
+            output_file = new_results_path(subject_info,
+                                           extension = results_extension(output_format))
+
+        if output_format == "columnar":
+            results = ColumnarResults(output_file)
+            results.append(record)
+            results.close()
+
+            logging.info(f"Data saved to {output_file}")
+            return output_file
+
+
+        trial_data_frame = pd.DataFrame({key: [value] for key, value in record.items()})
+
+
+        if not os.path.exists(output_file):
+            trial_data_frame.to_csv(output_file, 
+                                    index = False)
+
+        else:
+            trial_data_frame.to_csv(output_file, 
+                                    mode = "a", 
+                                    header = False, 
+                                    index = False)
+            
+        logging.info(f"Data saved to {output_file}")
+        return output_file
+    
+    except FileNotFoundError as e:
+        logging.error(f"FileNotFoundError: {e}")
+
+    except PermissionError as e:
+        logging.error(f"PermissionError: {e}")
+
+    except Exception as e:
+        logging.error(f"Unexpected error saving data: {e}")
+
+
+
+class ResultWriter:
+    """
+    Saves trial records from a background thread. The trial loop only puts the record into a queue,
+    while the thread appends it (in the format of save_experiment_data) to results it keeps open
+    and flushes them according to the flush policy. The queue is drained when close is called, which is also
+    registered to run at interpreter exit, so no trial is lost if the experiment crashes.
+    Trials that can't be saved, e.g. while a network share is unreachable, are kept and retried. As long as saving fails,
+    write raises an OSError after queueing the trial, so the trial loop logs the failure, and close logs the trials never saved.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    output_file : str, optional
+        The file path for saving the results. If None, a new file is created based on the subject's ID.
+    policy : str, optional
+        When the file is flushed: after every "trial", at the end of every "block" or every interval seconds ("time"). Defaults to flush_policy.
+    interval : float, optional
+        The seconds between flushes with the "time" policy. Defaults to flush_interval.
+    fsync : bool, optional
+        If True, every flush is followed by an fsync. Defaults to fsync_results.
+    format : str, optional
+        Either "csv" or "columnar". Defaults to results_format.
+    journal : SessionJournal, optional
+        A journal, to which the thread appends every trial after writing it to the results. A "journal" entry of the trial data
+        is added to the trial's journal entry.
+    sink : NetworkSink, optional
+        A network sink, to which the thread hands every record after writing it to the results.
+    retry_interval : float, optional
+        The seconds between attempts to save trials that failed, if no new trial comes first. Defaults to 1.
+    """
+
+    def __init__(self,
+                 subject_info: Dict[str, str],
+                 output_file: Optional[str] = None,
+                 policy: Optional[str] = None,
+                 interval: Optional[float] = None,
+                 fsync: Optional[bool] = None,
+                 format: Optional[str] = None,
+                 journal: Optional[SessionJournal] = None,
+                 sink: Optional[NetworkSink] = None,
+                 retry_interval: float = 1.0) -> None:
+
+        self.subject_info = subject_info
+        self.format = format or results_format
+        self.output_file = output_file or new_results_path(subject_info, 
+                                                           extension = results_extension(self.format))
+        self.policy = policy or flush_policy
+        self.interval = flush_interval if interval is None else interval
+        self.fsync = fsync_results if fsync is None else fsync
+        self.journal = journal
+        self.sink = sink
+        self.retry_interval = retry_interval
+
+        # Trials not completely saved yet, in order, and the last error saving them, which is None while saving works
+        self.unsaved = []
+        self.error = None
+
+        # Main thread cost of handing over the records
+        self.n_records = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target = self.run, 
+                                       name = "ResultWriter", 
+                                       daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def write(self, 
+              trial_data: Dict[str, Any]) -> None:
+        """Hands the data of a trial over to the writer thread. Raises an OSError afterwards if saving currently fails."""
+
+        start = time.perf_counter()
+        self.queue.put(trial_data)
+        latency = time.perf_counter() - start
+
+        self.n_records += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+        error = self.error
+        if error is not None:
+            raise OSError(f"Saving to {self.output_file} fails, {len(self.unsaved)} trials are kept to retry: {error}")
+
+
+    def end_block(self) -> None:
+        """Marks the end of a block, which flushes the file with the "block" policy."""
+
+        self.queue.put("block")
+
+
+    def close(self) -> None:
+        """Writes all queued records, closes the file and waits for the writer thread to finish."""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+        if self.unsaved:
+            logging.critical(f"{len(self.unsaved)} trials could not be saved to {self.output_file}, "
+                             f"trials {[entry['data'].get('trial_num') for entry in self.unsaved]}: {self.error}")
+
+        if self.n_records:
+            logging.info(f"Result writer closed after {self.n_records} trials, main thread latency mean: {self.total_latency / self.n_records * 1e6:.1f} us, max: {self.max_latency * 1e6:.1f} us")
+
+
+    def run(self) -> None:
+        """
+        Appends the queued records to the results until close is called. Every trial is first appended to the results
+        and then to the journal and the sink. If a step fails, the error is logged and the trial stays in unsaved,
+        whose remaining steps are retried with the next item, after reopening the results. Trials appended since the last flush
+        are appended again if the flush fails, which may duplicate a row that partly reached the file.
+        """
+
+        results = None
+        unflushed = []
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = self.retry_interval if self.unsaved else self.interval if self.policy == "time" else None
+
+            try:
+                item = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                item = "timer"
+
+            if isinstance(item, dict):
+                self.unsaved.append({"data": item,
+                                     "record": trial_record(self.subject_info, item),
+                                     "written": False,
+                                     "journaled": False,
+                                     "sent": False})
+            try:
+                if results is None:
+                    results = open_results(self.output_file, 
+                                           self.format)
+
+                for entry in self.unsaved:
+                    if not entry["written"]:
+                        results.append(entry["record"])
+                        entry["written"] = True
+                        unflushed.append(entry)
+                        logging.info(f"Data saved to {self.output_file}")
+
+                if (item is None
+                        or self.policy == "trial" and unflushed
+                        or self.policy == "block" and item == "block"
+                        or self.policy == "time" and time.monotonic() - last_flush >= self.interval):
+                    results.flush(self.fsync)
+                    unflushed = []
+                    last_flush = time.monotonic()
+
+            except Exception as e:
+                self.error = e
+                logging.error(f"Error writing results to {self.output_file}, keeping {len(self.unsaved)} trials to retry: {e}")
+
+                # Trials that may not have reached the file are appended again, those done otherwise first, as they are older
+                unsaved = {id(entry) for entry in self.unsaved}
+                for entry in unflushed:
+                    entry["written"] = False
+                self.unsaved = [entry for entry in unflushed if id(entry) not in unsaved] + self.unsaved
+                unflushed = []
+
+                results = self.close_results(results)
+
+            try:
+                while self.unsaved and self.unsaved[0]["written"]:
+                    entry = self.unsaved[0]
+
+                    if self.journal is not None and not entry["journaled"]:
+                        self.journal.append({"type": "trial", **entry["data"].get("journal", {}), "record": entry["record"]})
+                        entry["journaled"] = True
+
+                    if self.sink is not None and not entry["sent"]:
+                        self.sink.send(entry["record"])
+                        entry["sent"] = True
+
+                    del self.unsaved[0]
+
+                if item == "block":
+                    if self.journal is not None:
+                        self.journal.sync()
+                    if self.sink is not None:
+                        self.sink.flush()
+
+                if results is not None:
+                    self.error = None
+
+            except Exception as e:
+                self.error = e
+                logging.error(f"Error journaling trials of {self.output_file}, keeping {len(self.unsaved)} trials to retry: {e}")
+
+            if item is None:
+                break
+
+        self.close_results(results)
+
+
+    def close_results(self,
+                      results: Optional[Union[CsvResults, ColumnarResults]]) -> None:
+        """Closes the results, if they are open, logging instead of raising errors, and returns None."""
+
+        try:
+            if results is not None:
+                results.close()
+        except Exception as e:
+            logging.error(f"Error closing results {self.output_file}: {e}")
+
+
+
+class NetworkSink:
+    """
+    Pushes trial records in batches to a collector process (see collector.py) from a background thread, so neither the trial loop
+    nor the result writer ever wait for the network. Records are buffered while the collector is unreachable and sent once
+    it is back. Every batch is sent as one line of json and confirmed by the collector. Batches carry a sequence number,
+    so a batch resent after a lost confirmation is stored only once. A batch is frozen once it got its sequence number
+    and is resent with exactly the same records until it is confirmed.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    address : str, optional
+        "host:port" or "unix:<path>" of the collector. Defaults to collector_address.
+    batch_size : int, optional
+        The number of records sent at once. Defaults to collector_batch_size.
+    flush_interval : float, optional
+        The seconds a record waits at most for its batch to fill up. Defaults to collector_flush_interval.
+    retry_interval : float, optional
+        The seconds between reconnection attempts. Defaults to collector_retry_interval.
+    max_buffer : int, optional
+        The number of buffered records beyond which the oldest are dropped, except those of the batch being sent. Defaults to collector_max_buffer.
+    timeout : float, optional
+        The seconds to wait for a connection or a confirmation. Defaults to 2.
+    """
+
+    def __init__(self,
+                 subject_info: Dict[str, str],
+                 address: Optional[str] = None,
+                 batch_size: Optional[int] = None,
+                 flush_interval: Optional[float] = None,
+                 retry_interval: Optional[float] = None,
+                 max_buffer: Optional[int] = None,
+                 timeout: float = 2.0) -> None:
+
+        self.address = address or collector_address
+        self.batch_size = batch_size or collector_batch_size
+        self.flush_interval = collector_flush_interval if flush_interval is None else flush_interval
+        self.retry_interval = collector_retry_interval if retry_interval is None else retry_interval
+        self.max_buffer = max_buffer or collector_max_buffer
+        self.timeout = timeout
+
+        # Identifies this session's batches at the collector
+        self.source = f"{socket.gethostname()}:{subject_info['sub_id']}:{time.strftime('%Y%m%d-%H%M%S')}"
+        self.sequence = 0
+        self.sent = 0
+        self.dropped = 0
+
+        self.buffer = []
+        self.pending = None                 # The records and message of the batch being sent, frozen with its sequence number
+        self.connection = None
+        self.reader = None
+        self.next_attempt = 0.0
+
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target = self.run, 
+                                       name = "NetworkSink", 
+                                       daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def send(self,
+             record: Dict[str, Any]) -> None:
+        """Hands a record over to the sink thread without waiting."""
+
+        self.queue.put(record)
+
+
+    def flush(self) -> None:
+        """Asks the sink thread to send the buffered records now, e.g. at the end of a block."""
+
+        self.queue.put("flush")
+
+
+    def close(self, 
+              timeout: float = 5.0) -> None:
+        """Makes a last attempt to send the remaining records, waiting at most timeout seconds, and stops the sink thread."""
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+        atexit.unregister(self.close)
+
+        logging.info(f"Network sink closed after sending {self.sent} records, {self.unsent()} unsent, {self.dropped} dropped")
+
+
+    def unsent(self) -> int:
+        """Returns the number of records not confirmed by the collector yet."""
+
+        return len(self.buffer) + (len(self.pending[0]) if self.pending is not None else 0)
+
+
+    def connect(self) -> socket.socket:
+        """Opens a connection to the collector."""
+
+        if self.address.startswith("unix:"):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            target = self.address[len("unix:"):]
+        else:
+            host, _, port = self.address.rpartition(":")
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target = (host, int(port))
+
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(target)
+        except OSError:
+            connection.close()
+            raise
+
+        return connection
+
+
+    def send_batch(self) -> bool:
+        """
+        Sends the pending batch, or else takes the oldest records of the buffer as the next batch, and waits for its confirmation.
+        Returns False if the collector is unreachable, in which case the batch stays pending.
+        """
+
+        if time.monotonic() < self.next_attempt:
+            return False
+
+        if self.pending is None:
+            batch = self.buffer[:self.batch_size]
+            del self.buffer[:len(batch)]
+
+            message = json.dumps({"source": self.source, "sequence": self.sequence, "records": batch},
+                                 separators = (",", ":"),
+                                 default = lambda value: value.item())
+            self.pending = (batch, message)
+
+        batch, message = self.pending
+
+        try:
+            if self.connection is None:
+                self.connection = self.connect()
+                self.reader = self.connection.makefile("r", encoding = "utf-8")
+
+            self.connection.sendall(message.encode("utf-8") + b"\n")
+            reply = json.loads(self.reader.readline() or "{}")
+
+            if reply.get("ack") != self.sequence:
+                raise OSError(f"unexpected reply {reply}")
+
+        except (OSError, ValueError) as e:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+                logging.warning(f"Collector {self.address} unreachable, buffering {self.unsent()} records: {e}")
+
+            self.next_attempt = time.monotonic() + self.retry_interval
+            return False
+
+        self.pending = None
+        self.sequence += 1
+        self.sent += len(batch)
+        return True
+
+
+    def run(self) -> None:
+        """Collects the handed over records and sends them in batches until close is called."""
+
+        oldest = None
+        closing = False
+        flush = False
+
+        while True:
+            # While records wait, the queue is only waited on until the next send is due
+            timeout = None
+            if self.pending is not None:
+                timeout = max(self.next_attempt - time.monotonic(), 0)
+            elif self.buffer:
+                due = self.next_attempt if flush or len(self.buffer) >= self.batch_size else max(oldest + self.flush_interval, self.next_attempt)
+                timeout = max(due - time.monotonic(), 0)
+
+            if not closing:
+                try:
+                    item = self.queue.get(timeout = timeout)
+                except queue.Empty:
+                    item = "timer"
+
+                if item is None:
+                    closing = True
+                    self.next_attempt = 0.0
+                elif item == "flush":
+                    flush = True
+                elif isinstance(item, dict):
+                    if not self.buffer:
+                        oldest = time.monotonic()
+                    self.buffer.append(item)
+
+                    # The batch being sent is not part of the buffer, so dropping never changes a numbered batch
+                    if len(self.buffer) > self.max_buffer:
+                        del self.buffer[0]
+                        self.dropped += 1
+
+                        if self.dropped == 1:
+                            logging.warning("Network sink buffer full, dropping the oldest unsent records")
+
+            send = (closing or flush or self.pending is not None or len(self.buffer) >= self.batch_size
+                    or self.buffer and time.monotonic() - oldest >= self.flush_interval)
+
+            while send and (self.buffer or self.pending is not None) and self.send_batch():
+                oldest = time.monotonic()
+
+            if not self.buffer and self.pending is None:
+                flush = False
+
+            if closing and (not self.unsent() or time.monotonic() < self.next_attempt):
+                break
+
+        if self.connection is not None:
+            self.connection.close()
+
+
+
+class SessionJournal:
+    """
+    An append-only journal of a session, from which the session can be resumed after a crash (see load_journal).
+    Every entry is one line of json preceded by its CRC-32 checksum, so an entry cut off by a crash is recognized.
+    The first entry holds the participant information, the results path and the schedule, every following one a completed trial
+    with its record and, in the adaptive allocation, its schedule row and the allocator's random state.
+    Entries are flushed to the operating system right away and forced to disk at block ends with fsync_results.
+
+    Parameters
+    ----------
+    path : str
+        The path of the journal, which is appended to if it exists.
+    fsync : bool, optional
+        If True, sync forces the journal to disk. Defaults to fsync_results.
+    truncate : int, optional
+        The size in bytes of the intact entries of an existing journal, as found by read_journal. The journal is cut to this size
+        before appending, so an entry torn by a crash doesn't swallow the first new one. Defaults to None, which keeps the journal as it is.
+    """
+
+    def __init__(self,
+                 path: str,
+                 fsync: Optional[bool] = None,
+                 truncate: Optional[int] = None) -> None:
+
+        self.path = path
+        self.fsync = fsync_results if fsync is None else fsync
+
+        if truncate is not None and os.path.exists(path) and os.path.getsize(path) > truncate:
+            logging.warning(f"Dropping the damaged end of journal {path} after byte {truncate}")
+            with open(path, "r+b") as file:
+                file.truncate(truncate)
+
+        self.file = open(path, "a", encoding = "utf-8")
+        self.lock = threading.Lock()
+
+
+    def append(self,
+               entry: Dict[str, Any]) -> None:
+        """Appends an entry with its checksum and flushes it."""
+
+        line = json.dumps(entry, separators = (",", ":"), default = lambda value: value.item())
+
+        with self.lock:
+            self.file.write(f"{zlib.crc32(line.encode('utf-8')):08x} {line}\n")
+            self.file.flush()
+
+
+    def sync(self) -> None:
+        """Forces the journal to disk if fsync is set."""
+
+        with self.lock:
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+
+    def close(self) -> None:
+        """Forces the journal to disk and closes it."""
+
+        self.sync()
+        self.file.close()
+
+
+
+def read_journal(path: str) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Reads the entries of a journal written by SessionJournal. Reading stops at the first entry whose checksum doesn't match,
+    which is the entry a crash cut off.
+
+    Parameters
+    ----------
+    path : str
+        The path of the journal.
+
+    Returns
+    -------
+    entries : list of dict
+        The intact entries.
+    size : int
+        The size in bytes of the intact entries, where appending has to continue.
+    """
+
+    entries = []
+    size = 0
+
+    with open(path, "rb") as file:
+        for line_number, line in enumerate(file, 1):
+            checksum, _, text = line.rstrip(b"\r\n").partition(b" ")
+
+            if not line.endswith(b"\n") or checksum != f"{zlib.crc32(text):08x}".encode("ascii"):
+                logging.warning(f"Journal {path} is damaged from line {line_number} on, the rest is ignored.")
+                break
+
+            entries.append(json.loads(text))
+            size += len(line)
+
+    return entries, size
+
+
+
+def load_journal(sub_id: str) -> Dict[str, Any]:
+    """
+    Loads the latest journal of a participant to resume the session.
+
+    Parameters
+    ----------
+    sub_id : str
+        The subject ID of the session.
+
+    Returns
+    -------
+    dict
+        The "journal_path", the "journal_size" of its intact entries, "subject_info", "output_file", results "format", "allocation" and "schedule"
+        of the session, the "records" of the completed trials, the "allocator" random state after the last of them and whether the session "completed".
+    """
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+    paths = glob.glob(os.path.join(directory, f"journal_subject_{sub_id}.jsonl")) + glob.glob(os.path.join(directory, f"journal_subject_{sub_id}_*.jsonl"))
+
+    if not paths:
+        raise FileNotFoundError(f"No journal of subject {sub_id} in {directory}")
+
+    journal_path = max(paths, key = os.path.getmtime)
+    entries, journal_size = read_journal(journal_path)
+
+    if not entries or entries[0]["type"] != "session":
+        raise ValueError(f"Journal {journal_path} has no session entry")
+
+    session = entries[0]
+    schedule = {key: np.asarray(value) for key, value in session["schedule"].items()}
+    trials = [entry for entry in entries if entry["type"] == "trial"]
+
+    for entry in trials:
+        for key, value in entry.get("row", {}).items():
+            schedule[key][entry["index"]] = value
+
+    records = [entry["record"] for entry in trials]
+    for record in records:
+        record["target_position"] = tuple(record["target_position"])
+        record["response"] = tuple(record["response"])
+
+    return {"journal_path": journal_path,
+            "journal_size": journal_size,
+            "subject_info": session["subject_info"],
+            "output_file": session["output_file"],
+            "format": session["format"],
+            "allocation": session["allocation"],
+            "schedule": schedule,
+            "records": records,
+            "allocator": trials[-1].get("allocator") if trials else None,
+            "completed": any(entry["type"] == "end" for entry in entries)}
+
+
+
+def restore_results(resumed: Dict[str, Any]) -> None:
+    """
+    Makes the results of a resumed session match its journal. If a crash left the results with more or fewer trials than journaled,
+    they are rewritten from the journaled records, so the resumed session continues in the same results without gaps or duplicates.
+
+    Parameters
+    ----------
+    resumed : dict
+        The session as returned by load_journal.
+    """
+
+    path = resumed["output_file"]
+    records = resumed["records"]
+
+    if not os.path.exists(path):
+        n_results = 0
+    elif resumed["format"] == "columnar":
+        n_results = len(load_results(path, columns = ["trial"]))
+    else:
+        with open(path, encoding = "utf-8") as file:
+            n_results = sum(1 for _ in file) - 1
+
+    if n_results == len(records):
+        return
+
+    logging.warning(f"Results {path} hold {n_results} trials, the journal {len(records)}. Rewriting the results from the journal.")
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    results = open_results(path, 
+                           resumed["format"])
+    try:
+        for record in records:
+            results.append(record)
+        results.flush(fsync_results)
+    finally:
+        results.close()
+
+
+
+class OnlineStatistics:
+    """
+    Running statistics of a session, updated in constant time after every trial: the Welford mean and variance of the reaction time
+    per (set_size, target_state) cell, the regression slope of reaction time on set size per target state,
+    the accuracy per target state and the number of reaction time outliers. Only correctly answered trials that are no outliers
+    enter the reaction time statistics. The statistics of a running session are available from get_online_statistics.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    """
+
+    def __init__(self,
+                 subject_info: Dict[str, str]) -> None:
+
+        self.subject_info = subject_info
+        self.summary_path = None
+
+        self.trials = 0
+        self.outliers = 0
+        self.cells = {}                     # (set_size, target_state): [n, mean, m2]
+        self.regressions = {}               # target_state: [n, mean_x, mean_y, m2_x, m2_y, c_xy]
+        self.accuracy = {}                  # target_state: [trials, correct]
+
+
+    def is_outlier(self,
+                   rt: float,
+                   cell: List[float]) -> bool:
+        """Whether a reaction time lies outside outlier_rt_range or further than outlier_sd standard deviations from the mean of its cell."""
+
+        if not outlier_rt_range[0] <= rt <= outlier_rt_range[1]:
+            return True
+
+        n, mean, m2 = cell
+        if n >= outlier_min_trials and m2 > 0:
+            return abs(rt - mean) > outlier_sd * math.sqrt(m2 / (n - 1))
+
+        return False
+
+
+    def update(self,
+               trial_data: Dict[str, Any]) -> None:
+        """
+        Adds a trial to the statistics.
+
+        Parameters
+        ----------
+        trial_data : dict
+            The trial data as returned by run_trial.
+        """
+
+        set_size = trial_data["set_size"]
+        target_state = trial_data["target_state"]
+        rt = trial_data["reaction_time"]
+
+        self.trials += 1
+        accuracy = self.accuracy.setdefault(target_state, [0, 0])
+        accuracy[0] += 1
+        accuracy[1] += bool(trial_data["accuracy"])
+
+        if not trial_data["accuracy"]:
+            return
+
+        cell = self.cells.setdefault((set_size, target_state), [0, 0.0, 0.0])
+        if self.is_outlier(rt, cell):
+            self.outliers += 1
+            return
+
+        # Welford's update of the mean and the sum of squared deviations
+        cell[0] += 1
+        delta = rt - cell[1]
+        cell[1] += delta / cell[0]
+        cell[2] += delta * (rt - cell[1])
+
+        # The same for set size and reaction time per target state, together with their co-moment
+        regression = self.regressions.setdefault(target_state, [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        regression[0] += 1
+        dx = set_size - regression[1]
+        dy = rt - regression[2]
+        regression[1] += dx / regression[0]
+        regression[2] += dy / regression[0]
+        regression[3] += dx * (set_size - regression[1])
+        regression[4] += dy * (rt - regression[2])
+        regression[5] += dx * (rt - regression[2])
+
+
+    def slope(self,
+              target_state: str) -> Tuple[float, float]:
+        """Returns the slope in seconds per item and the intercept in seconds of the reaction times of a target state, NaN while undetermined."""
+
+        n, mean_x, mean_y, m2_x, m2_y, c_xy = self.regressions.get(target_state, [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        if m2_x <= 0:
+            return math.nan, math.nan
+
+        slope = c_xy / m2_x
+        return slope, mean_y - slope * mean_x
+
+
+    def slope_ci_width(self,
+                       target_state: str,
+                       z: float = 1.96) -> float:
+        """Returns the width in seconds per item of the confidence interval of a target state's slope (95% by default), infinite while undetermined."""
+
+        n, mean_x, mean_y, m2_x, m2_y, c_xy = self.regressions.get(target_state, [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        if n < 3 or m2_x <= 0:
+            return math.inf
+
+        residual_variance = max(m2_y - c_xy ** 2 / m2_x, 0) / (n - 2)
+        return 2 * z * math.sqrt(residual_variance / m2_x)
+
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns a compact summary of the statistics.
+
+        Returns
+        -------
+        dict
+            The number of "trials" and "outliers", and per target state the "accuracy", the "slope_ms" per item, the width of its
+            95% confidence interval "slope_ci_ms", the "intercept_ms" and the "cells" with the number "n", "mean_ms" and "sd_ms" of the reaction times per set size.
+        """
+
+        target_states = {}
+        for target_state, (trials, correct) in self.accuracy.items():
+            slope, intercept = self.slope(target_state)
+            ci_width = self.slope_ci_width(target_state)
+            cells = {}
+
+            for (set_size, state), (n, mean, m2) in sorted(self.cells.items()):
+                if state == target_state and n:
+                    cells[str(set_size)] = {"n": n,
+                                            "mean_ms": round(mean * 1000, 1),
+                                            "sd_ms": round(math.sqrt(m2 / (n - 1)) * 1000, 1) if n > 1 else None}
+
+            target_states[target_state] = {"accuracy": round(correct / trials, 4),
+                                           "slope_ms": None if math.isnan(slope) else round(slope * 1000, 2),
+                                           "slope_ci_ms": None if math.isinf(ci_width) else round(ci_width * 1000, 2),
+                                           "intercept_ms": None if math.isnan(intercept) else round(intercept * 1000, 1),
+                                           "cells": cells}
+
+        return {"trials": self.trials,
+                "outliers": self.outliers,
+                "target_states": target_states}
+
+
+    def save_block_summary(self,
+                           block: int) -> Optional[str]:
+        """
+        Logs the summary and appends it as one json line to online_statistics_subject_<sub_id>.jsonl in the "results" directory.
+
+        Parameters
+        ----------
+        block : int
+            The number of the block that ended.
+
+        Returns
+        -------
+        str
+            The path of the summary file.
+        """
+
+        try:
+            summary = self.summary()
+
+            if self.summary_path is None:
+                self.summary_path = new_results_path(self.subject_info,
+                                                     prefix = "online_statistics",
+                                                     extension = ".jsonl")
+
+            with open(self.summary_path, "a", encoding = "utf-8") as file:
+                file.write(json.dumps({"block": block, **summary}) + "\n")
+
+            slopes = ", ".join(f"{state}: {values['slope_ms']} ms/item, {values['accuracy']:.0%} correct" for state, values in summary["target_states"].items())
+            logging.info(f"Block {block} statistics: {summary['trials']} trials, {summary['outliers']} outliers, {slopes}")
+            return self.summary_path
+
+        except Exception as e:
+            logging.error(f"Error saving online statistics: {e}")
+
+
+
+online_statistics = {}
+
+
+
+def get_online_statistics(sub_id: str) -> Optional[OnlineStatistics]:
+    """
+    Returns the running statistics of the session of a participant, or None if no session with this ID was started in this process.
+    """
+
+    return online_statistics.get(sub_id)
+
+
+
+def save_frame_timing_summary(subject_info: Dict[str, str],
+                              trials: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Summarizes the frame timing of a session with summarize_frame_timing, logs it and saves it as
+    frame_timing_subject_<sub_id>.json in the "results" directory.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    trials : list of dict
+        The trial data of the session, containing the frame_timing_columns.
+
+    Returns
+    -------
+    str
+        The path of the summary file.
+    """
+
+    try:
+        summary = summarize_frame_timing(trials)
+        summary_path = new_results_path(subject_info,
+                                        prefix = "frame_timing",
+                                        extension = ".json")
+
+        with open(summary_path, "w", encoding = "utf-8") as file:
+            json.dump(summary, file, indent = 2)
+
+        logging.info(f"Frame timing: {summary['compromised_trials']} of {summary['trials']} trials with a dropped onset frame, "
+                     f"draw prep p99: {summary['draw_prep_time_ms']['p99']:.2f} ms, keypress to onset p99: {summary['keypress_to_onset_ms']['p99']:.2f} ms")
+        return summary_path
+
+    except Exception as e:
+        logging.error(f"Error saving frame timing summary: {e}")
+
+
+
+def run_lengths(sequence: np.ndarray) -> np.ndarray:
+    """
+    Returns for every element of a sequence how many equal elements directly precede it, including itself.
+    """
+
+    starts = np.flatnonzero(np.r_[True, sequence[1:] != sequence[:-1]])
+    run_starts = np.repeat(starts, np.diff(np.r_[starts, len(sequence)]))
+
+    return np.arange(len(sequence)) - run_starts + 1
+
+
+
+def limit_runs(order: np.ndarray,
+               max_run: int,
+               block_size: int,
+               rng: np.random.Generator,
+               max_swaps: int = 10000) -> np.ndarray:
+    """
+    Breaks up runs of more than max_run equal conditions by swapping the trial that is one too many with a random trial
+    of the same block, whose swap creates no new run that is too long. Swaps within blocks keep the conditions of every block.
+
+    Parameters
+    ----------
+    order : numpy.ndarray
+        The condition of every trial, which is modified in place.
+    max_run : int
+        The longest allowed run.
+    block_size : int
+        The number of trials per block.
+    rng : numpy.random.Generator
+        The generator choosing the swaps.
+    max_swaps : int, optional
+        The number of swaps tried before giving up. Defaults to 10000.
+
+    Returns
+    -------
+    numpy.ndarray
+        The order.
+    """
+
+    def fits(j: int) -> bool:
+        # Whether the run through trial j is at most max_run long
+        start, end = j, j
+        while start > 0 and order[start - 1] == order[j] and j - start < max_run:
+            start -= 1
+        while end < len(order) - 1 and order[end + 1] == order[j] and end - start < max_run:
+            end += 1
+        return end - start < max_run
+
+    for _ in range(max_swaps):
+        violations = np.flatnonzero(run_lengths(order) > max_run)
+        if not len(violations):
+            return order
+
+        j = violations[0]
+        block_start = j - j % block_size
+        candidates = block_start + rng.permutation(min(block_size, len(order) - block_start))
+
+        for k in candidates:
+            if order[k] == order[j]:
+                continue
+
+            order[j], order[k] = order[k], order[j]
+            if fits(j) and fits(k):
+                break
+            order[j], order[k] = order[k], order[j]
+
+        else:
+            break
+
+    logging.warning(f"Could not limit all condition runs to {max_run} trials.")
+    return order
+
+
+
+def balanced_targets(n_trials: int,
+                     rows: int,
+                     cols: int,
+                     rng: np.random.Generator) -> np.ndarray:
+    """
+    Draws the target cells of a condition's trials, so every cell is used equally often (up to one) and the grid's quadrants
+    take turns. Each cycle through all cells interleaves a random order of every quadrant's cells.
+
+    Parameters
+    ----------
+    n_trials : int
+        The number of trials.
+    rows : int
+        The number of rows in the grid.
+    cols : int
+        The number of columns in the grid.
+    rng : numpy.random.Generator
+        The generator drawing the cells.
+
+    Returns
+    -------
+    numpy.ndarray
+        The target cell of every trial, in random order.
+    """
+
+    cells = np.arange(rows * cols)
+    quadrants = (2 * (cells // cols) // rows) * 2 + 2 * (cells % cols) // cols
+
+    cycles = []
+    for _ in range(-(-n_trials // len(cells))):
+        # Sorting by the rank within the quadrant, with a random quadrant order in every round, interleaves the quadrants
+        keys = rng.random(len(cells))
+        shuffled = cells[np.argsort(keys)]
+        rank = np.zeros(len(cells), dtype = int)
+        for quadrant in np.unique(quadrants):
+            in_quadrant = quadrants[shuffled] == quadrant
+            rank[in_quadrant] = np.arange(in_quadrant.sum())
+
+        quadrant_order = rng.permutation(4)
+        cycles.append(shuffled[np.lexsort((quadrant_order[quadrants[shuffled]], rank))])
+
+    return rng.permutation(np.concatenate(cycles)[:n_trials])
+
+
+
+def generate_trial_schedule(set_sizes: List[int],
+                            target_states: List[str],
+                            trials_per_condition: int,
+                            rows: int,
+                            cols: int,
+                            seed: Optional[int] = None,
+                            max_run: Optional[int] = None,
+                            trials_per_block: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Generates the complete schedule of the main trials with a seeded NumPy Generator: the randomized condition order,
+    the target cell, the distractor cells and the expected row and column of every trial.
+    Cells are indices into the positions returned by calculate_positions.
+
+    The order is constrained instead of fully random: every block of run_main_trials holds every condition equally often (up to one),
+    no condition repeats more than max_run times in a row (see limit_runs), and the targets of every condition are spread
+    evenly over the cells and quadrants of the grid (see balanced_targets).
+
+    Parameters
+    ----------
+    set_sizes : list of int
+        A list of set sizes (number of stimuli) to be displayed in the experiment.
+    target_states : list of str
+        A list of possible target emotional expressions.
+    trials_per_condition : int
+        The number of trials to run for each combination of set size and target state.
+    rows : int
+        The number of rows in the grid.
+    cols : int
+        The number of columns in the grid.
+    seed : int, optional
+        The seed of the Generator. If None, a fresh seed is drawn.
+    max_run : int, optional
+        The longest run of trials with the same condition. Defaults to max_condition_run.
+    trials_per_block : int, optional
+        The number of trials per block. Defaults to trials_per_condition, like in run_main_trials.
+
+    Returns
+    -------
+    schedule : dict
+        A dictionary of arrays with one entry per trial ("set_size", "target_state", "target", "distractors", "target_row", "target_col"),
+        the "target_states" the state indices refer to and the "seed". Unused distractor slots are -1.
+    """
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    rng = np.random.default_rng(seed)
+    n_positions = rows * cols
+    max_set_size = max(set_sizes)
+
+    max_run = max_condition_run if max_run is None else max_run
+    trials_per_block = trials_per_block or trials_per_condition
+    n_conditions = len(set_sizes) * len(target_states)
+    n_trials = n_conditions * trials_per_condition
+
+    # Dealing the trials sorted by condition to the blocks in turn gives every block the same share of every condition,
+    # which are then shuffled within their block
+    conditions = np.repeat(np.arange(n_conditions), trials_per_condition)
+    n_blocks = max(n_trials // trials_per_block, 1)
+    dealt = conditions[np.argsort(np.arange(n_trials) % n_blocks, kind = "stable")]
+    block_keys = np.arange(n_trials) // trials_per_block
+    order = dealt[np.lexsort((rng.random(n_trials), block_keys))]
+
+    if max_run:
+        limit_runs(order, 
+                   max_run, 
+                   trials_per_block, 
+                   rng)
+
+    sizes = np.asarray(set_sizes)[order // len(target_states)]
+    states = order % len(target_states)
+
+    targets = np.empty(n_trials, dtype = int)
+    for condition in range(n_conditions):
+        trials = order == condition
+        targets[trials] = balanced_targets(trials.sum(), rows, cols, rng)
+
+    # Sorting random keys gives an independent random order of all cells per trial, whose first cell is the target,
+    # as its key is below all others, and the following ones are the distractors
+    keys = rng.random((n_trials, n_positions))
+    keys[np.arange(n_trials), targets] = -1
+    cells = np.argsort(keys, axis = 1)[:, :max_set_size]
+    distractors = cells[:, 1:].copy()
+    distractors[np.arange(max_set_size - 1) >= (sizes - 1)[:, None]] = -1
+
+    return {
+        "set_size": sizes,
+        "target_state": states,
+        "target": targets,
+        "distractors": distractors,
+        "target_row": 1 + targets // cols,
+        "target_col": 1 + targets % cols,
+        "target_states": np.array(target_states),
+        "seed": np.array(str(seed))
+    }
+
+
+
+def save_trial_schedule(subject_info: Dict[str, str],
+                        schedule: Dict[str, np.ndarray]) -> str:
+    """
+    Saves the trial schedule next to the results, in the "results" directory, as schedule_subject_<sub_id>.npz.
+    Like save_experiment_data, a timestamp is appended if such a file already exists.
+
+    Parameters
+    ----------
+    subject_info : dict
+        A dictionary containing information about the participant.
+    schedule : dict
+        The trial schedule as returned by generate_trial_schedule.
+
+    Returns
+    -------
+    str
+        The path of the schedule file.
+    """
+
+    try:
+        schedule_path = new_results_path(subject_info,
+                                         prefix = "schedule",
+                                         extension = ".npz")
+        np.savez(schedule_path, **schedule)
 
-        event.waitKeys(keyList = continue_key)
+        logging.info(f"Trial schedule saved to {schedule_path}")
+        return schedule_path
 
-        logging.info(f"Training completed in {total_train_trials} trials")
+    except PermissionError as e:
+        logging.error(f"PermissionError: {e}")
 
     except Exception as e:
-        logging.error(f"Error during training: {e}")
+        logging.error(f"Unexpected error saving trial schedule: {e}")
 
 
 
-def get_participant_info(info: Dict[str, str]) -> Dict[str, str]:
+def load_trial_schedule(schedule_path: str,
+                        rows: int,
+                        cols: int,
+                        set_sizes: List[int]) -> Dict[str, np.ndarray]:
     """
-    Collects participant information using a graphical user interface.
+    Loads a trial schedule saved by save_trial_schedule, e.g. to rerun a session exactly, and checks that it fits
+    the current grid and set sizes, as its cells are indices into the positions of the grid it was generated for.
 
     Parameters
     ----------
-    info : dict
-        A dictionary containing the fields and default values for the participant information to enter.
+    schedule_path : str
+        The path of the schedule file.
+    rows : int
+        The number of rows in the grid.
+    cols : int
+        The number of columns in the grid.
+    set_sizes : list of int
+        The set sizes of the experiment.
 
     Returns
     -------
     dict
-        The updated dictionary with the input.
+        The trial schedule.
+
+    Raises
+    ------
+    ValueError
+        If the schedule doesn't fit the grid or the set sizes.
     """
 
-    try:
-        info_data = gui.DlgFromDict(title = "Supervisor Input", dictionary = info)
-        if info_data.OK:
-            print("Info: Data entry succesful")
-            return info
-        
-        else:
-            print("Warning: Exited setup during data input.")
-            core.quit()
+    with np.load(schedule_path) as schedule_file:
+        schedule = {key: schedule_file[key] for key in schedule_file.files}
 
-    except Exception as e:
-        print(f"Error collecting participant info: {e}")
-        core.quit()
+    missing = {"set_size", "target_state", "target", "distractors", "target_row", "target_col", "target_states"} - schedule.keys()
+    if missing:
+        raise ValueError(f"Schedule {schedule_path} lacks {', '.join(sorted(missing))}")
 
+    unknown_sizes = sorted(set(schedule["set_size"].tolist()) - set(set_sizes))
+    if unknown_sizes:
+        raise ValueError(f"Schedule {schedule_path} has set sizes {unknown_sizes}, which are not among set_sizes {list(set_sizes)}")
 
+    targets = schedule["target"]
+    distractors = schedule["distractors"]
+    if (targets.min() < 0 or targets.max() >= rows * cols or distractors.max() >= rows * cols
+            or np.any(schedule["target_row"] != 1 + targets // cols) or np.any(schedule["target_col"] != 1 + targets % cols)):
+        raise ValueError(f"Schedule {schedule_path} was generated for another grid than {rows} x {cols}")
 
-def save_experiment_data(subject_info: Dict[str, str], 
-                         trial_data: Dict[str, Any], 
-                         output_file: Union[str, None] = None) -> str:
+    return schedule
+
+
+
+class AdaptiveAllocator:
     """
-    Organizes and saves the data collected during an experimental trial into a csv file. If an output file is not specified, 
-    the function will create a new file in a "results" directory, located in the same directory the script is in and named according to the subject's ID. 
-    If a file with the same name already exists, the function will append a timestamp to create a unique filename in order to prevent overwriting off an already existing file.
+    Assigns the trials of a schedule one at a time for the "adaptive" allocation. Every combination of set size and target state
+    first gets adaptive_min_trials trials in random order. Then every trial goes to the target state whose slope has the widest
+    confidence interval relative to adaptive_ci_width, with the set size that adds the most to the spread of its set sizes,
+    which narrows the interval the most. The allocation stops once every slope is precise enough or max_trials were assigned.
+    Trials are assigned one ahead, so the next display can be prefetched while the current trial runs.
+
+    The target and distractor cells of assigned trials are drawn from a Generator derived from the schedule's seed,
+    and the rows of the schedule are overwritten in place, so it describes the trials actually run.
 
     Parameters
     ----------
-    subject_info : dict
-        A dictionary containing information about the participant.
-    trial_data : dict
-        A dictionary containing the data from an individual trial.
-    output_file : str, optional
-        The file path for saving the results. If None, a new file is created based on the subject's ID.
+    schedule : dict
+        The trial schedule as returned by generate_trial_schedule, whose rows are overwritten.
+    statistics : OnlineStatistics
+        The running statistics of the session, providing the confidence intervals of the slopes.
+    set_sizes : list of int
+        The set sizes to choose from.
+    n_positions : int
+        The number of positions of the grid.
+    ci_width : float, optional
+        The width in seconds per item every confidence interval needs. Defaults to adaptive_ci_width.
+    min_trials : int, optional
+        The trials of every combination before adapting. Defaults to adaptive_min_trials.
+    max_trials : int, optional
+        The maximum number of trials, at most the length of the schedule. Defaults to adaptive_max_trials.
     """
-    try:
-        directory = os.path.dirname(os.path.abspath(__file__))
-        output_path = os.path.join(directory, "results")
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-
-
-        trial_data_frame = pd.DataFrame({
-            "sub_id": [subject_info["sub_id"]],
-            "age": [subject_info["age"]],
-            "sex": [subject_info["sex"]],
-            "vision": [subject_info["vision"]],
-            "handedness": [subject_info["handedness"]],
-            "block": [trial_data["block"]],
-            "trial": [trial_data["trial_num"]],
-            "target_state": [trial_data["target_state"]],
-            "set_size": [trial_data["set_size"]],
-            "reaction_time": [trial_data["reaction_time"]],
-            "target_position": [trial_data["target_position"]],
-            "response": [trial_data["response"]],
-            "accuracy": [trial_data["accuracy"]]
-        })
 
+    def __init__(self,
+                 schedule: Dict[str, np.ndarray],
+                 statistics: OnlineStatistics,
+                 set_sizes: List[int],
+                 n_positions: int,
+                 ci_width: Optional[float] = None,
+                 min_trials: Optional[int] = None,
+                 max_trials: Optional[int] = None) -> None:
+
+        self.schedule = schedule
+        self.statistics = statistics
+        self.set_sizes = list(set_sizes)
+        self.target_states = [str(state) for state in schedule["target_states"]]
+        self.n_positions = n_positions
+        self.ci_width = adaptive_ci_width if ci_width is None else ci_width
+        self.min_trials = adaptive_min_trials if min_trials is None else min_trials
 
-        if output_file is None:
-            output_file = os.path.join(output_path, f"results_subject_{subject_info['sub_id']}.csv")
+        max_trials = adaptive_max_trials if max_trials is None else max_trials
+        self.max_trials = min(max_trials or len(schedule["set_size"]), len(schedule["set_size"]))
 
-            if os.path.exists(output_file):
-                timestamp = time.strftime("%d%m%Y-%H%M%S")
-                output_file = os.path.join(output_path, f"results_subject_{subject_info['sub_id']}_{timestamp}.csv")
+        self.rng = np.random.default_rng(np.random.SeedSequence(int(str(schedule["seed"]))).spawn(1)[0])
+        self.counts = np.zeros((len(self.set_sizes), len(self.target_states)), dtype = int)
+        self.assigned = 0
 
 
-        if not os.path.exists(output_file):
-            trial_data_frame.to_csv(output_file, 
-                                    index = False)
+    def choose(self) -> Optional[Tuple[int, int]]:
+        """Returns the indices of the set size and target state of the next trial, or None if the session can end."""
 
-        else:
-            trial_data_frame.to_csv(output_file, 
-                                    mode = "a", 
-                                    header = False, 
-                                    index = False)
-            
-        logging.info(f"Data saved to {output_file}")
-        return output_file
-    
-    except FileNotFoundError as e:
-        logging.error(f"FileNotFoundError: {e}")
+        if self.assigned >= self.max_trials:
+            return None
 
-    except PermissionError as e:
-        logging.error(f"PermissionError: {e}")
+        fewest = self.counts.min()
+        if fewest < self.min_trials:
+            candidates = np.argwhere(self.counts == fewest)
+            return tuple(candidates[self.rng.integers(len(candidates))])
 
-    except Exception as e:
-        logging.error(f"Unexpected error saving data: {e}")
+        widths = np.array([self.statistics.slope_ci_width(state) for state in self.target_states]) / self.ci_width
+        if np.all(widths <= 1):
+            return None
+
+        state = int(np.argmax(widths))
+
+        # Adding a trial with set size x to n trials with mean set size m adds n / (n + 1) * (x - m)^2 to their spread
+        counts = self.counts[:, state]
+        sizes = np.array(self.set_sizes, dtype = float)
+        mean = counts @ sizes / counts.sum()
+        gain = (sizes - mean) ** 2
+        best = np.flatnonzero(np.isclose(gain, gain.max()))
+
+        return int(best[self.rng.integers(len(best))]), state
+
+
+    def assign(self,
+               i: int) -> bool:
+        """
+        Chooses the condition of trial i, draws its cells and writes them into row i of the schedule.
+
+        Parameters
+        ----------
+        i : int
+            The index of the trial in the schedule.
+
+        Returns
+        -------
+        bool
+            False if no trial was assigned, because the session can end.
+        """
+
+        choice = self.choose()
+        if choice is None:
+            return False
+
+        size_index, state = choice
+        set_size = self.set_sizes[size_index]
+        cells = self.rng.permutation(self.n_positions)[:set_size]
+
+        self.schedule["set_size"][i] = set_size
+        self.schedule["target_state"][i] = state
+        self.schedule["target"][i] = cells[0]
+        self.schedule["distractors"][i] = -1
+        self.schedule["distractors"][i, :set_size - 1] = cells[1:]
+        self.schedule["target_row"][i] = 1 + cells[0] // cols
+        self.schedule["target_col"][i] = 1 + cells[0] % cols
+
+        self.counts[size_index, state] += 1
+        self.assigned += 1
+        return True
+
+
+    def restore(self,
+                n_trials: int,
+                rng_state: Optional[Dict[str, Any]]) -> None:
+        """
+        Restores the allocation after the first n_trials trials of the schedule, e.g. to resume a session from its journal.
+
+        Parameters
+        ----------
+        n_trials : int
+            The number of completed trials, whose rows of the schedule were assigned.
+        rng_state : dict, optional
+            The state of the Generator before the next trial was assigned. Keeps the current state if None.
+        """
+
+        self.counts[:] = 0
+        for i in range(n_trials):
+            self.counts[self.set_sizes.index(int(self.schedule["set_size"][i])), int(self.schedule["target_state"][i])] += 1
+
+        self.assigned = n_trials
+        if rng_state is not None:
+            self.rng.bit_generator.state = rng_state
 
 
 
@@ -893,15 +4480,156 @@ def configure_logging(subject_info,
 
 
 
+class SetupPipeline:
+    """
+    Builds the grid rectangles and the stimuli in small steps while the instructions and the training are shown,
+    instead of all at once before the first screen. Every call of step does one small piece of work and is registered
+    as idle task, so the steps run while the experiment waits for key presses or during timed waits. The readiness of each stage
+    is exposed as threading.Event in ready: "grid" (rectangles), "training" (enough stimuli for the training) and
+    "main" (all stimuli). wait finishes a stage synchronously, if it isn't ready when it is needed.
+
+    Parameters
+    ----------
+    win : visual.Window or HeadlessWindow
+        The window the stimuli are created for. Nothing is built for a HeadlessWindow.
+    positions : list of tuple
+        The grid positions the rectangles are created at.
+    set_size : int
+        The maximal number of smileys per display of the main trials.
+    training_set_size : int
+        The number of smileys per display of the training.
+    """
+
+    def __init__(self,
+                 win: visual.Window,
+                 positions: List[Tuple[float, float]],
+                 set_size: int,
+                 training_set_size: int) -> None:
+
+        self.win = win
+        self.positions = positions
+        self.set_size = set_size
+        self.training_set_size = training_set_size
+
+        self.rectangles = []
+        self.stimuli = None if is_headless(win) else []
+        self.ready = {stage: threading.Event() for stage in ("grid", "training", "main")}
+        self.steps = self.build()
+
+        # Nothing is built for a HeadlessWindow, so every stage is ready right away
+        if is_headless(win):
+            for stage in self.ready.values():
+                stage.set()
+
+
+    def build(self) -> Iterable[None]:
+        """Creates everything, yielding after every small piece of work."""
+
+        if is_headless(self.win):
+            return
+
+        # The grid first, because the training needs it as well
+        if render_mode == "vector":
+            for row in range(0, len(self.positions), cols):
+                self.rectangles.extend(load_rectangles(self.win, 
+                                                       self.positions[row:row + cols]))
+                yield
+        else:
+            self.rectangles = [load_rectangle_array(self.win, 
+                                                    self.positions)]
+            yield
+
+        self.ready["grid"].set()
+
+        if render_mode == "vector":
+            while len(self.stimuli) < self.set_size:
+                self.stimuli.extend(preload_stimuli(self.win, 1))
+
+                if len(self.stimuli) >= self.training_set_size:
+                    self.ready["training"].set()
+                yield
+        else:
+            self.stimuli = preload_display(self.win, 
+                                           self.set_size)
+
+        self.ready["training"].set()
+        self.ready["main"].set()
+
+        get_text_pool(self.win).upload_pages()
+        logging.info("Setup pipeline completed")
+
+
+    def step(self) -> bool:
+        """Runs the next piece of work and returns True as long as work remains."""
+
+        try:
+            next(self.steps)
+            return True
+        except StopIteration:
+            return False
+
+
+    def wait(self,
+             stage: str) -> None:
+        """Finishes the given stage synchronously, unless it is ready already."""
+
+        if self.ready[stage].is_set():
+            return
+
+        logging.warning(f"Waiting for setup stage '{stage}' to finish")
+        while not self.ready[stage].is_set() and self.step():
+            pass
+
+
+
+def create_monitor() -> monitors.Monitor:
+    """
+    Creates the PsychoPy monitor from the monitor settings at the top of the script.
+
+    Returns
+    -------
+    monitors.Monitor
+        The monitor.
+    """
+
+    my_monitor = monitors.Monitor("")
+    my_monitor.setWidth(monitor_width_cm)
+    my_monitor.setSizePix(monitor_size_pix)
+
+    return my_monitor
+
+
+
+def warm_up() -> None:
+    """
+    Imports NumPy and pandas, to be run in a background thread while the supervisor fills in the participant dialog.
+    PsychoPy is left to the main thread, as importing its visual modules loads pyglet, which is not safe
+    while the dialog runs its event loop in the main thread.
+    """
+
+    try:
+        for module in (np, pd):
+            module._lazy_load()
+
+    except Exception as e:
+        logging.error(f"Error warming up: {e}")
+
+
+
 def setup_experiment(info: Dict[str, str],
                      rows: int, 
                      cols: int,
                      set_sizes: List[int],
                      target_states: List[str],
                      trials_per_condition: int,
-                     log_level: int) -> Tuple[Dict[str, str], visual.Window, List[Tuple[float, float]], List[Tuple[int, str]], List[Dict[str, Any]], List[visual.Rect]]:
+                     log_level: int,
+                     participant: Optional[SimulatedParticipant] = None,
+                     pages: Optional[List[str]] = None,
+                     training_set_size: int = training_set_size,
+                     resumed: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, str], visual.Window, List[Tuple[float, float]], Dict[str, np.ndarray], SetupPipeline]:
     """
-    Initializes the experiment by setting up logging, returning preloaded stimuli, participant info, a window, stimulus positions and a randomized list of trial conditions.
+    Initializes the experiment by setting up logging, returning participant info, a window, stimulus positions, a precomputed trial schedule,
+    which is saved next to the results, and the pipeline that builds the stimuli and rectangles while the instructions and training run.
 
     Parameters
     ----------
@@ -919,20 +4647,76 @@ def setup_experiment(info: Dict[str, str],
         The number of trials to run for each combination of set size and target state.
     log_level : int
         The logging level.
+    participant : SimulatedParticipant, optional
+        If given, the experiment is set up headless for this simulated participant: info is used without the dialog,
+        a HeadlessWindow replaces the window and no stimuli or rectangles are loaded.
+    pages : list of str, optional
+        Full-screen texts (instructions, block and end screens) to pre-render in the background while the setup runs.
+    training_set_size : int, optional
+        The number of stimuli per display in the training, which are built first. Defaults to the global training_set_size variable.
+    resumed : dict, optional
+        A crashed session as returned by load_journal, whose participant information and schedule are used instead of the dialog and a new schedule.
 
     Returns
     -------
     tuple
-        Returns a tuple containing the participant information, the window, stimulus positions, trial conditions, preloaded stimuli and rectangles.
+        Returns a tuple containing the participant information, the window, stimulus positions, trial schedule and setup pipeline.
     """
 
-    subject_info = get_participant_info(info)
+    if participant is not None:
+        subject_info = info if resumed is None else resumed["subject_info"]
+
+        configure_logging(subject_info,
+                          log_level)
+
+        win = HeadlessWindow(participant)
+        positions = calculate_positions(win,
+                                        rows,
+                                        cols)
+
+        if resumed is not None:
+            schedule = resumed["schedule"]
+        elif schedule_file is None:
+            schedule = generate_trial_schedule(set_sizes,
+                                               target_states,
+                                               trials_per_condition,
+                                               rows,
+                                               cols,
+                                               seed = schedule_seed)
+        else:
+            schedule = load_trial_schedule(schedule_file,
+                                           rows,
+                                           cols,
+                                           set_sizes)
+
+        # Adaptive schedules are saved once the session ends, see run_main_trials
+        if allocation == "fixed" and resumed is None:
+            save_trial_schedule(subject_info,
+                                schedule)
+
+        pipeline = SetupPipeline(win,
+                                 positions,
+                                 max(set_sizes),
+                                 training_set_size)
+
+        logging.info(f"Headless setup completed for subject_{subject_info['sub_id']}")
+        return subject_info, win, positions, schedule, pipeline
+
+    # Everything touching PsychoPy stays in the main thread, only the pure Python imports are done while the dialog is open
+    warm_up_thread = threading.Thread(target = warm_up,
+                                      daemon = True)
+    warm_up_thread.start()
+
+    subject_info = get_participant_info(info) if resumed is None else resumed["subject_info"]
 
     configure_logging(subject_info,
                       log_level)
     try:
+        warm_up_thread.join()
+        my_monitor = create_monitor()
+
         win = visual.Window(
-            size = my_monitor.getSizePix(),
+            size = monitor_size_pix,
             units = "cm",
             color = "black",
             fullscr = True,
@@ -940,29 +4724,45 @@ def setup_experiment(info: Dict[str, str],
             monitor = my_monitor)
         win.flip()
 
+        if pages:
+            get_text_pool(win).prerender(pages)
+
         positions = calculate_positions(win, 
                                         rows, 
                                         cols)
 
-        trial_conditions = [(set_size, target_state) 
-                            for set_size in set_sizes 
-                            for target_state in target_states 
-                            for _ in range(trials_per_condition)]
-
-        random.shuffle(trial_conditions)
-        logging.info(f"Generated {len(trial_conditions)} trial conditions")
-
-        max_set_size = max(set_sizes)
-        stimuli = preload_stimuli(win, 
-                                  max_set_size)
-        
-        rectangles = load_rectangles(win,
-                                     positions)
+        if resumed is not None:
+            schedule = resumed["schedule"]
+        elif schedule_file is None:
+            schedule = generate_trial_schedule(set_sizes,
+                                               target_states,
+                                               trials_per_condition,
+                                               rows,
+                                               cols,
+                                               seed = schedule_seed)
+        else:
+            schedule = load_trial_schedule(schedule_file,
+                                           rows,
+                                           cols,
+                                           set_sizes)
+
+        # Adaptive schedules are saved once the session ends, see run_main_trials
+        if allocation == "fixed" and resumed is None:
+            save_trial_schedule(subject_info,
+                                schedule)
+        logging.info(f"Generated schedule of {len(schedule['set_size'])} trials with seed {schedule['seed']}")
+
+        # Stimuli and rectangles are built step by step while the participant reads the instructions
+        pipeline = SetupPipeline(win,
+                                 positions,
+                                 max(set_sizes),
+                                 training_set_size)
+        idle_tasks.append(pipeline.step)
 
         logging.info(f"Setup completed for subject_{subject_info['sub_id']}")
 
 
-        return subject_info, win, positions, trial_conditions, stimuli, rectangles
+        return subject_info, win, positions, schedule, pipeline
     
 
     except FileNotFoundError as e:
@@ -971,8 +4771,10 @@ def setup_experiment(info: Dict[str, str],
     except PermissionError as e:
         logging.error(f"PermissionError: {e}")
 
+    # Raised on invalid settings, e.g. a schedule_file that doesn't fit the grid, which the session can't run with
     except ValueError as e:
         logging.error(f"Value error: {e}")
+        raise
 
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
@@ -980,17 +4782,254 @@ def setup_experiment(info: Dict[str, str],
 
 
 
+class SessionProfiler:
+    """
+    Profiles a session, if profiling is enabled, and does nothing otherwise. Every phase (setup, instructions, training and each block)
+    runs under its own cProfile profiler, whose stats are saved as <phase>.prof, to be opened with pstats or snakeviz, and as <phase>.txt
+    with the profile_top functions by cumulative time. The stage timings of every main trial are appended to stage_times.csv.
+    tracemalloc traces the allocations of the session. A snapshot is taken at the start of every block, while the block screen is shown,
+    and at the end, and saved as memory_<label>.snapshot. As comparing snapshots takes seconds, the profile_top lines whose allocations
+    grew the most since the previous snapshot are only written to memory.jsonl when the profiler is closed after the session.
+    Only the main thread is profiled by cProfile, tracemalloc covers all threads.
+    Until the participant is known, the output is kept and then written to results/profile_subject_<sub_id>.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether to profile. Defaults to the global profiling variable.
+    """
+
+    def __init__(self,
+                 enabled: Optional[bool] = None) -> None:
+
+        self.enabled = profiling if enabled is None else enabled
+        self.directory = None
+        self.pending = []
+        self.phase_times = {}
+        self.profile = None
+        self.phase_name = None
+        self.phase_start = 0.0
+        self.snapshots = []
+        self.stage_file = None
+        self.stage_writer = None
+
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def open(self,
+             subject_info: Dict[str, str]) -> None:
+        """Creates the output directory of the participant and writes everything kept until now."""
+
+        if not self.enabled or self.directory is not None:
+            return
+
+        try:
+            self.directory = new_results_path(subject_info, 
+                                              prefix = "profile", 
+                                              extension = "")
+            os.makedirs(self.directory, exist_ok = True)
+
+            for name, write in self.pending:
+                write(os.path.join(self.directory, name))
+            self.pending = []
+
+            logging.info(f"Profiling into {self.directory}")
+
+        except Exception as e:
+            logging.error(f"Error opening the profile directory: {e}")
+
+
+    def output(self,
+               name: str,
+               write: Callable[[str], Any]) -> None:
+        """Calls write with the path of the output file name, as soon as the directory is known."""
+
+        if self.directory is None:
+            self.pending.append((name, write))
+        else:
+            write(os.path.join(self.directory, name))
+
+
+    def start(self,
+              phase: str) -> None:
+        """Starts profiling a phase. A phase still running is stopped first, as cProfile profilers can't be nested."""
+
+        if not self.enabled:
+            return
+
+        self.stop()
+
+        try:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        except ValueError as e:
+            logging.error(f"Error profiling phase {phase}: {e}")
+            self.profile = None
+
+        self.phase_name = phase
+        self.phase_start = time.perf_counter()
+
+
+    def stop(self) -> None:
+        """Stops profiling the running phase and saves its stats."""
+
+        if not self.enabled or self.phase_name is None:
+            return
+
+        self.phase_times[self.phase_name] = time.perf_counter() - self.phase_start
+        profile, phase = self.profile, self.phase_name
+        self.profile = self.phase_name = None
+
+        if profile is None:
+            return
+
+        profile.disable()
+
+
+        def write_summary(path: str) -> None:
+            with open(path, "w", encoding = "utf-8") as file:
+                pstats.Stats(profile, stream = file).sort_stats("cumulative").print_stats(profile_top)
+
+        try:
+            self.output(f"{phase}.prof", profile.dump_stats)
+            self.output(f"{phase}.txt", write_summary)
+        except Exception as e:
+            logging.error(f"Error saving the profile of phase {phase}: {e}")
+
+
+    @contextlib.contextmanager
+    def phase(self,
+              name: str) -> Iterable[None]:
+        """Profiles the code in a with statement as the given phase."""
+
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+
+    def record_trial(self,
+                     trial_num: int,
+                     block: int,
+                     stage_times: Dict[str, float]) -> None:
+        """Appends the stage timings of a trial in milliseconds to stage_times.csv."""
+
+        if not self.enabled or self.directory is None:
+            return
+
+        try:
+            if self.stage_writer is None:
+                self.stage_file = open(os.path.join(self.directory, "stage_times.csv"), "w", newline = "", encoding = "utf-8")
+                self.stage_writer = csv.writer(self.stage_file)
+                self.stage_writer.writerow(["trial", "block"] + list(stage_times))
+
+            self.stage_writer.writerow([trial_num, block] + [f"{seconds * 1000:.3f}" for seconds in stage_times.values()])
+
+        except Exception as e:
+            logging.error(f"Error saving the stage times of trial {trial_num}: {e}")
+
+
+    def snapshot(self,
+                 label: str) -> None:
+        """Takes a tracemalloc snapshot and saves it."""
+
+        if not self.enabled or not tracemalloc.is_tracing():
+            return
+
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+
+            name = f"memory_{label}.snapshot"
+            self.output(name, snapshot.dump)
+            self.snapshots.append({"label": label,
+                                   "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                                   "current": current,
+                                   "peak": peak,
+                                   "file": name})
+
+        except Exception as e:
+            logging.error(f"Error taking memory snapshot {label}: {e}")
+
+
+    def save_memory_growth(self) -> None:
+        """Writes the lines whose allocations grew the most between consecutive snapshots to memory.jsonl, leaving out the profiler's own."""
+
+        excluded = (tracemalloc.__file__, cProfile.__file__, pstats.__file__, "<frozen importlib._bootstrap")
+        previous = {}
+
+        with open(os.path.join(self.directory, "memory.jsonl"), "w", encoding = "utf-8") as file:
+            for entry in self.snapshots:
+                snapshot = tracemalloc.Snapshot.load(os.path.join(self.directory, entry["file"]))
+
+                sizes = {stat.traceback: (stat.size, stat.count) for stat in snapshot.statistics("lineno")
+                         if not stat.traceback[0].filename.startswith(excluded)}
+                growth = sorted(sizes.items(), 
+                                key = lambda item: item[1][0] - previous.get(item[0], (0, 0))[0], 
+                                reverse = True)
+
+                entry["growth"] = [{"location": f"{traceback[0].filename}:{traceback[0].lineno}",
+                                    "size": size,
+                                    "size_diff": size - previous.get(traceback, (0, 0))[0],
+                                    "count": count,
+                                    "count_diff": count - previous.get(traceback, (0, 0))[1]}
+                                   for traceback, (size, count) in growth[:profile_top]]
+
+                file.write(json.dumps(entry) + "\n")
+                previous = sizes
+
+
+
+    def close(self) -> None:
+        """Stops the running phase and tracemalloc and saves the wall time of every phase to phases.json."""
+
+        if not self.enabled:
+            return
+
+        self.stop()
+        phase_times = dict(self.phase_times)
+
+
+        def write_phases(path: str) -> None:
+            with open(path, "w", encoding = "utf-8") as file:
+                json.dump(phase_times, file, indent = 2)
+
+        try:
+            self.output("phases.json", write_phases)
+        except Exception as e:
+            logging.error(f"Error saving the phase times: {e}")
+
+        if self.stage_file is not None:
+            self.stage_file.close()
+            self.stage_file = self.stage_writer = None
+
+        tracemalloc.stop()
+
+        try:
+            if self.directory is not None and self.snapshots:
+                self.save_memory_growth()
+        except Exception as e:
+            logging.error(f"Error saving the memory growth: {e}")
+
+
+
 def run_main_trials(subject_info: Dict[str, str], 
                     win: visual.Window,
                     trials_per_condition: int,
                     positions: List[Tuple[float, float]],
                     rectangles: List[visual.Rect], 
-                    trial_conditions: List[Tuple[int, str]],  
+                    schedule: Dict[str, np.ndarray],  
                     stimuli: List[Dict[str, Any]],
                     continue_key: str,
-                    return_key: str) -> None:
+                    return_key: str,
+                    resumed: Optional[Dict[str, Any]] = None,
+                    profiler: Optional[SessionProfiler] = None) -> None:
     """
-    Presents the main experimental trials structured in blocks and saves the data after every trial.
+    Presents the main experimental trials structured in blocks, saves the data after every trial
+    and keeps the running statistics of the session, which are summarized at the end of every block.
+    With journal_sessions, every completed trial is also recorded in the session's journal.
 
     Parameters
     ----------
@@ -1004,80 +5043,256 @@ def run_main_trials(subject_info: Dict[str, str],
         A list of positions for the stimuli on the screen.
     rectangles : list of visual.Rect
         A list of visual.Rect objects that will be displayed at the positions.
-    trial_conditions : list of tuple
-        A list of tuples representing the trial conditions (set size and target state).
+    schedule : dict
+        The precomputed trial schedule as returned by generate_trial_schedule.
     stimuli : list of dict
         The preloaded stimuli to be used during the trials.
     continue_key : str
         The key the participant presses to continue between trials and blocks.
     return_key : str
         The key to press to exit the experiment at the end.
+    resumed : dict, optional
+        A crashed session as returned by load_journal. The session continues with the next trial and its block,
+        in the same results and journal.
+    profiler : SessionProfiler, optional
+        Profiles every block and records the stage timings of every trial. Nothing is profiled if None.
     """
 
+    profiler = profiler or SessionProfiler(enabled = False)
+    writer = None
+    journal = None
+    sink = None
+    frame_timings = []
+    statistics = online_statistics[subject_info["sub_id"]] = OnlineStatistics(subject_info)
+    prefetch = None
+    prefetched = {}
+    allocator = None
+    trial_num = 1
+    completed = False
+
     try:
-        trial_num = 1
-        total_trials = len(trial_conditions)
+        total_trials = len(schedule["set_size"])
         trials_per_block = trials_per_condition
         num_blocks = total_trials // trials_per_block
 
         output_file = None
+        output_format = results_format
+
+        if resumed is not None:
+            restore_results(resumed)
+            output_file = resumed["output_file"]
+            output_format = resumed["format"]
+            journal = SessionJournal(resumed["journal_path"],
+                                     truncate = resumed["journal_size"])
+
+            # The statistics and frame timing summaries cover the trials before the crash as well
+            for record in resumed["records"]:
+                statistics.update(record)
+                frame_timings.append({key: record[key] for key in frame_timing_columns + ["onset_timing_ok"]})
+
+            trial_num = len(resumed["records"]) + 1
+            journal.append({"type": "resume", 
+                            "time": time.strftime("%Y-%m-%d %H:%M:%S"), 
+                            "next_trial": trial_num})
+            logging.info(f"Resuming the session of subject_{subject_info['sub_id']} at trial {trial_num}")
+
+        elif journal_sessions:
+            output_file = new_results_path(subject_info, 
+                                           extension = results_extension(output_format))
+            journal = SessionJournal(new_results_path(subject_info, 
+                                                      prefix = "journal", 
+                                                      extension = ".jsonl"))
+            journal.append({"type": "session",
+                            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                            "subject_info": subject_info,
+                            "output_file": output_file,
+                            "format": output_format,
+                            "allocation": allocation,
+                            "schedule": {key: value.tolist() for key, value in schedule.items()}})
+            journal.sync()
+
+        if collector_address is not None:
+            sink = NetworkSink(subject_info)
+
+        if result_writer == "async":
+            writer = ResultWriter(subject_info, 
+                                  output_file = output_file,
+                                  format = output_format,
+                                  journal = journal,
+                                  sink = sink)
+
+        # The adaptive allocation assigns every trial one ahead and lowers last_trial when it ends the session
+        last_trial = total_trials
+        if (allocation if resumed is None else resumed["allocation"]) == "adaptive":
+            allocator = AdaptiveAllocator(schedule,
+                                          statistics,
+                                          np.unique(schedule["set_size"]).tolist(),
+                                          len(positions))
+
+            if resumed is not None:
+                allocator.restore(trial_num - 1, 
+                                  resumed["allocator"])
+
+            last_trial = min(allocator.max_trials, total_trials) if allocator.assign(trial_num - 1) else trial_num - 1
+
+        # The block pages show how many blocks there are at most, if the adaptive allocation can end the session early
+        shown_blocks = num_blocks if allocator is None else -(-allocator.max_trials // trials_per_block)
+
+
+        for block in range((trial_num - 1) // trials_per_block, num_blocks):
+            if trial_num > last_trial:
+                break
+
+            refresh_atlas_stimuli(stimuli)
 
-
-        for block in range(num_blocks):
             present_text(win, 
-                        text = (f"Block: {block + 1} von {num_blocks}.\
-                                \n\nWenn Sie bereit sind drücken Sie '{continue_key.upper()}' um den nächsten Block zu starten."),
+                        text = block_start_text(block + 1, 
+                                                shown_blocks, 
+                                                continue_key,
+                                                open_ended = allocator is not None),
                         flip = True)
-            core.wait(skip_prot)
+            profiler.snapshot(f"block_{block + 1}")
+            wait(win, skip_prot)
 
-            event.waitKeys(keyList = continue_key)
+            wait_keys(win, continue_key)
             logging.info(f"Starting block {block + 1}")
 
+            profiler.start(f"block_{block + 1}")
+
 
-            for _ in range(trials_per_block):
-                if not trial_conditions:
-                    logging.warning(f"Trial conditions list is empty before trial {trial_num}. Exiting trial loop.")
+            for _ in range((block + 1) * trials_per_block - trial_num + 1):
+                if trial_num > last_trial:
+                    if allocator is None:
+                        logging.warning(f"Trial schedule is exhausted before trial {trial_num}. Exiting trial loop.")
                     break
 
-                set_size, target_state = trial_conditions.pop(0)
+                i = trial_num - 1
+                set_size = int(schedule["set_size"][i])
+                target_state = str(schedule["target_states"][schedule["target_state"][i]])
                 logging.info(f"Starting trial {trial_num}")
 
+                # A prefetch that did not get to run during the last trial's waits is dropped, the trial is then prepared by run_trial
+                if prefetch in idle_tasks:
+                    idle_tasks.remove(prefetch)
+
+                prefetch = None
+                journal_entry = {"index": i, 
+                                 "block": block + 1}
+
+                if allocator is not None:
+                    journal_entry["row"] = {key: schedule[key][i].tolist() for key in ("set_size", "target_state", "target", "distractors", "target_row", "target_col")}
+                    journal_entry["allocator"] = allocator.rng.bit_generator.state
+
+                if trial_num < last_trial and allocator is not None and not allocator.assign(i + 1):
+                    last_trial = trial_num
+                    logging.info(f"Adaptive allocation ends the session after trial {trial_num}: {statistics.summary()}")
+
+                if trial_num < last_trial:
+                    next_set_size = int(schedule["set_size"][i + 1])
+                    prefetch = prefetch_trial(prefetched,
+                                              i + 1,
+                                              win,
+                                              next_set_size,
+                                              positions,
+                                              str(schedule["target_states"][schedule["target_state"][i + 1]]),
+                                              stimuli,
+                                              continue_key,
+                                              target_index = int(schedule["target"][i + 1]),
+                                              distractor_indices = schedule["distractors"][i + 1, :next_set_size - 1])
+
                 trial_data = run_trial(win, 
                                        set_size, 
                                        positions, 
                                        rectangles,
                                        target_state,
                                        stimuli,
-                                       continue_key)
+                                       continue_key,
+                                       target_index = int(schedule["target"][i]),
+                                       distractor_indices = schedule["distractors"][i, :set_size - 1],
+                                       prepared = prefetched.pop(i, None),
+                                       prefetch = prefetch)
                     
                 trial_data["trial_num"] = trial_num
                 trial_data["block"] = block + 1
+                trial_data["journal"] = journal_entry
+                frame_timings.append({key: trial_data[key] for key in frame_timing_columns + ["onset_timing_ok"]})
+                statistics.update(trial_data)
+                save_start = time.perf_counter()
 
                 try:
-                    output_file = save_experiment_data(subject_info, 
-                                                        trial_data, 
-                                                        output_file = output_file)
+                    if writer is not None:
+                        writer.write(trial_data)
+                    else:
+                        output_file = save_experiment_data(subject_info, 
+                                                            trial_data, 
+                                                            output_file = output_file,
+                                                            output_format = output_format)
+                        if journal is not None:
+                            journal.append({"type": "trial", **journal_entry, "record": trial_record(subject_info, trial_data)})
+                        if sink is not None:
+                            sink.send(trial_record(subject_info, trial_data))
                 except Exception as e:
                         logging.error(f"Error saving data for trial {trial_num}: {e}")
+
+                end_stage(trial_data["stage_times"], "save", save_start)
+                profiler.record_trial(trial_num, 
+                                      block + 1, 
+                                      trial_data["stage_times"])
                    
                 trial_num += 1
 
+            if writer is not None:
+                writer.end_block()
+            else:
+                if journal is not None:
+                    journal.sync()
+                if sink is not None:
+                    sink.flush()
+
+            statistics.save_block_summary(block + 1)
+            profiler.stop()
             logging.info(f"Block {block + 1} completed")
 
+        profiler.snapshot("end")
+        completed = True
+
     except Exception as e:
         logging.error(f"Error running main trials: {e}")
 
+    finally:
+        profiler.stop()
+
+        if prefetch in idle_tasks:
+            idle_tasks.remove(prefetch)
+
+        if writer is not None:
+            writer.close()
+
+        if sink is not None:
+            sink.close()
+
+        # Closing the writer first puts its last trials into the journal before the end
+        if journal is not None:
+            if completed:
+                journal.append({"type": "end", 
+                                "time": time.strftime("%Y-%m-%d %H:%M:%S")})
+            journal.close()
+
+        save_frame_timing_summary(subject_info,
+                                  frame_timings)
+
+        # The adaptive schedule is only known now, and is saved with the trials that were run
+        if allocator is not None:
+            save_trial_schedule(subject_info,
+                                {key: value if key in ("target_states", "seed") else value[:trial_num - 1] 
+                                 for key, value in schedule.items()})
+
 
     present_text(win, 
-                 text = f"Das Experiment ist beendet." 
-                "\n\nVielen Dank für Ihre Teilnahme!"
-                "\n\nIn diesem Experiment mussten Sie Gesichter mit einem positiven oder negativen Ausdruck in Mitten von unterschiedlich vielen neutralen Gesichtern finden."
-                "\n\nZiel des Experiments ist es, durch die Analyse der Reaktionszeiten, in Abhängigkeit \nvom emotionalen Ausdruck der Gesichter und der Anzahl der neutralen Gesichter, zu untersuchen, wie emotionale Gesichtsaudrücke die Aufmerksamkeitslenkung beeinflussen."
-                "\n\nWir möchten herausfinden, ob negative oder positive Gesichtsausdrücke die Aufmerksamkeit unterschiedlich stark auf sich ziehen können."
-                f"\n\nDrücken Sie '{return_key.upper()}' um das Fenster zu schließen.", 
-                flip = True)
+                 text = end_text(return_key), 
+                 flip = True)
     
-    event.waitKeys(keyList = return_key)
+    wait_keys(win, return_key)
 
 
 
@@ -1092,7 +5307,10 @@ def run_experiment(info: Dict[str, str],
                    return_key: str, 
                    training_set_size: int,
                    training_trials: int, 
-                   debug_mode: bool = False) -> None:
+                   debug_mode: bool = False,
+                   participant: Optional[SimulatedParticipant] = None,
+                   resume: Optional[str] = None,
+                   profile: Optional[bool] = None) -> None:
     """
     Runs the entire experiment by initializing the experimental environment, then proceeds to present the instructions, the training trials and main experimental trials to the participant.
 
@@ -1124,40 +5342,83 @@ def run_experiment(info: Dict[str, str],
         The number of correct trials required to complete the training phase.
     debug_mode : bool, optional
         If True, sets the logging level to "logging.DEBUG" for more detailed logging. Defaults to False.
+    participant : SimulatedParticipant, optional
+        If given, the experiment runs headless at machine speed with this simulated participant instead of a window and a human.
+    resume : str, optional
+        The subject ID of a crashed session to resume from its journal (see load_journal). Instructions and training are skipped
+        and the session continues with the next trial in the same results.
+    profile : bool, optional
+        Whether to profile the session with a SessionProfiler. Defaults to the global profiling variable.
     """
 
+    profiler = SessionProfiler(enabled = profile)
     log_level = logging.DEBUG if debug_mode else logging.WARNING
+    resumed = load_journal(resume) if resume is not None else None
+
+    # A completed session is left as it is, resuming it would end it a second time
+    if resumed is not None and resumed["completed"]:
+        print(f"The session of subject {resume} is already completed, there is nothing to resume.")
+        return
+
+    # The same number of blocks as shown by run_main_trials, so its block pages are rendered in advance
+    num_blocks = len(set_sizes) * len(target_states)
+    adaptive = (allocation if resumed is None else resumed["allocation"]) == "adaptive"
+    if adaptive:
+        num_trials = num_blocks * trials_per_condition
+        num_blocks = -(-min(adaptive_max_trials or num_trials, num_trials) // trials_per_condition)
+
+    pages = (list(instructions) 
+             + [training_end_text(continue_key)]
+             + [block_start_text(block + 1, num_blocks, continue_key, open_ended = adaptive) for block in range(num_blocks)] 
+             + [end_text(return_key)])
+
+    with profiler.phase("setup"):
+        subject_info, win, positions, schedule, pipeline = setup_experiment(info,
+                                                                            rows,
+                                                                            cols,
+                                                                            set_sizes,
+                                                                            target_states,
+                                                                            trials_per_condition,
+                                                                            log_level,
+                                                                            participant = participant,
+                                                                            pages = pages,
+                                                                            training_set_size = training_set_size,
+                                                                            resumed = resumed)
+    profiler.open(subject_info)
 
-    subject_info, win, positions, trial_conditions, stimuli, rectangles = setup_experiment(info,
-                                                                                           rows,
-                                                                                           cols,
-                                                                                           set_sizes,
-                                                                                           target_states,
-                                                                                           trials_per_condition,
-                                                                                           log_level)
     try:
-        present_instructions(win, 
-                            instructions, 
-                            continue_key, 
-                            return_key)
-
-        run_training(win, 
-                    positions, 
-                    rectangles,
-                    training_set_size,
-                    stimuli,
-                    training_trials,
-                    continue_key)
+        if resumed is None:
+            with profiler.phase("instructions"):
+                present_instructions(win, 
+                                    instructions, 
+                                    continue_key, 
+                                    return_key)
+
+            with profiler.phase("training"):
+                pipeline.wait("grid")
+                pipeline.wait("training")
+
+                run_training(win, 
+                            positions, 
+                            pipeline.rectangles,
+                            training_set_size,
+                            pipeline.stimuli,
+                            training_trials,
+                            continue_key)
+
+        pipeline.wait("main")
                                                                             
         run_main_trials(subject_info, 
                         win,
                         trials_per_condition,
                         positions, 
-                        rectangles,
-                        trial_conditions,
-                        stimuli,
+                        pipeline.rectangles,
+                        schedule,
+                        pipeline.stimuli,
                         continue_key,
-                        return_key)
+                        return_key,
+                        resumed = resumed,
+                        profiler = profiler)
         
         logging.info("Experiment completed")
 
@@ -1166,19 +5427,106 @@ def run_experiment(info: Dict[str, str],
 
 
     finally:
+        profiler.close()
+
+        if pipeline.step in idle_tasks:
+            idle_tasks.remove(pipeline.step)
+
+        text_pool = text_pools.pop(id(win), None)
+        if text_pool is not None:
+            logging.info(f"Text pool: {text_pool.hits} reused and {text_pool.misses} laid out texts")
+
         win.close()
 
 
 
-run_experiment(info = info,
-               cols = cols,
-               rows = rows,
-               set_sizes = set_sizes,
-               target_states = target_states,
-               trials_per_condition = trials_per_condition,
-               instructions = instruction,
-               continue_key = continue_key,
-               return_key = return_key,
-               training_set_size = training_set_size,
-               training_trials = training_trials,
-               debug_mode = True)
\ No newline at end of file
+def run_simulated_session(sub_id: str,
+                          seed: Optional[int] = None,
+                          resume: bool = False,
+                          profile: Optional[bool] = None,
+                          **participant_settings) -> None:
+    """
+    Runs a complete session with the settings at the top of the script headless, with a simulated participant instead of a human.
+    Waits take no real time, so a session runs at machine speed, while the schedule and results are saved like in a real session.
+
+    Parameters
+    ----------
+    sub_id : str
+        The subject ID the results are saved under.
+    seed : int, optional
+        The seed of the simulated participant.
+    resume : bool, optional
+        If True, the crashed session of sub_id is resumed from its journal. Defaults to False.
+    profile : bool, optional
+        Whether to profile the session, see SessionProfiler. Defaults to the global profiling variable.
+    **participant_settings
+        Further settings of the SimulatedParticipant, e.g. slopes or error_rate.
+    """
+
+    simulated_info = {
+        "age": "0",
+        "sex": "simulated",
+        "sub_id": sub_id,
+        "vision": "simulated",
+        "handedness": "simulated"
+    }
+
+    run_experiment(info = simulated_info,
+                   cols = cols,
+                   rows = rows,
+                   set_sizes = set_sizes,
+                   target_states = target_states,
+                   trials_per_condition = trials_per_condition,
+                   instructions = instruction,
+                   continue_key = continue_key,
+                   return_key = return_key,
+                   training_set_size = training_set_size,
+                   training_trials = training_trials,
+                   participant = SimulatedParticipant(seed = seed, 
+                                                      **participant_settings),
+                   resume = sub_id if resume else None,
+                   profile = profile)
+
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Runs the experiment with the settings at the top of the script, or a simulated session if requested on the command line.
+    """
+
+    parser = argparse.ArgumentParser(description = "Differential attentional guidance experiment.")
+    parser.add_argument("--simulate", action = "store_true", help = "Run a headless session with a simulated participant.")
+    parser.add_argument("--sub-id", default = "simulated", help = "Subject ID of the simulated session.")
+    parser.add_argument("--seed", type = int, help = "Seed of the simulated participant.")
+    parser.add_argument("--resume", metavar = "SUB_ID", help = "Resume the crashed session of this subject ID from its journal.")
+    parser.add_argument("--profile", action = "store_true", default = None, help = "Profile the session (see SessionProfiler). Also enabled by DAG_PROFILE=1.")
+    args = parser.parse_args(argv)
+
+    if args.simulate:
+        start = time.perf_counter()
+        run_simulated_session(args.resume or args.sub_id, 
+                              seed = args.seed,
+                              resume = args.resume is not None,
+                              profile = args.profile)
+        print(f"Simulated session finished in {time.perf_counter() - start:.3f} s")
+        return
+
+    run_experiment(info = info,
+                   cols = cols,
+                   rows = rows,
+                   set_sizes = set_sizes,
+                   target_states = target_states,
+                   trials_per_condition = trials_per_condition,
+                   instructions = instruction,
+                   continue_key = continue_key,
+                   return_key = return_key,
+                   training_set_size = training_set_size,
+                   training_trials = training_trials,
+                   debug_mode = True,
+                   resume = args.resume,
+                   profile = args.profile)
+
+
+
+if __name__ == "__main__":
+    main()
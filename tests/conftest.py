@@ -0,0 +1,58 @@
+# Shared fixtures of the tests. Sessions run on a copy of the scripts in a temporary directory,
+# so their results, journals and logs stay out of the tree.
+
+import os
+import sys
+import shutil
+import subprocess
+import importlib.util
+
+import pytest
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+scripts = ["differential_attentional_guidance.py", "collector.py"]
+
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """A temporary directory holding a copy of the experiment script and the collector."""
+
+    for script in scripts:
+        shutil.copy(os.path.join(root, script), tmp_path / script)
+
+    return tmp_path
+
+
+
+@pytest.fixture
+def run_script(workspace):
+    """Runs the experiment script of the workspace with the given command line arguments and returns the completed process."""
+
+    def run(*args, timeout = 120):
+        return subprocess.run([sys.executable, "differential_attentional_guidance.py", *args],
+                              cwd = workspace,
+                              capture_output = True,
+                              text = True,
+                              timeout = timeout,
+                              check = True)
+
+    return run
+
+
+
+@pytest.fixture
+def load_copy(workspace):
+    """Imports the experiment script of the workspace as a separate module, whose results directory is the workspace's."""
+
+    def load():
+        spec = importlib.util.spec_from_file_location(f"differential_attentional_guidance_{workspace.name}", 
+                                                      workspace / "differential_attentional_guidance.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
@@ -0,0 +1,140 @@
+import re
+import sys
+import json
+import subprocess
+
+import pytest
+import pandas as pd
+
+
+
+def total_trials(experiment):
+    return len(experiment.set_sizes) * len(experiment.target_states) * experiment.trials_per_condition
+
+
+
+def test_simulated_session(workspace, run_script, load_copy):
+    run_script("--simulate", "--sub-id", "s1", "--seed", "1")
+
+    experiment = load_copy()
+    n_trials = total_trials(experiment)
+
+    results = pd.read_csv(workspace / "results" / "results_subject_s1.csv")
+    assert results.columns.tolist() == experiment.result_columns
+    assert results["trial"].tolist() == list(range(1, n_trials + 1))
+    assert sorted(results.groupby(["set_size", "target_state"]).size().unique()) == [experiment.trials_per_condition]
+
+    assert experiment.load_journal("s1")["completed"]
+
+    # A clean simulated session logs no warnings
+    log = next((workspace / "logs").glob("log-subject_s1_*.log")).read_text(encoding = "utf-8")
+    assert "WARNING" not in log and "ERROR" not in log
+
+
+
+def test_resume_after_torn_journal_tail(workspace, run_script, load_copy):
+    run_script("--simulate", "--sub-id", "j1", "--seed", "1")
+
+    # Cuts the journal in the middle of trial 101, behind the session entry and 100 trials
+    journal = workspace / "results" / "journal_subject_j1.jsonl"
+    lines = journal.read_bytes().splitlines(keepends = True)
+    journal.write_bytes(b"".join(lines[:101]) + lines[101][:len(lines[101]) // 2])
+
+    experiment = load_copy()
+    assert len(experiment.load_journal("j1")["records"]) == 100
+
+    run_script("--simulate", "--resume", "j1", "--seed", "1")
+
+    resumed = experiment.load_journal("j1")
+    n_trials = total_trials(experiment)
+
+    assert resumed["completed"]
+    assert [record["trial"] for record in resumed["records"]] == list(range(1, n_trials + 1))
+
+    results = pd.read_csv(workspace / "results" / "results_subject_j1.csv")
+    assert results["trial"].tolist() == list(range(1, n_trials + 1))
+
+
+
+def test_resume_keeps_journaled_allocation(workspace, load_copy):
+    # The adaptive session may run at most 100 trials, the resuming process keeps the default fixed allocation
+    def run(allocation, resume):
+        code = ("import differential_attentional_guidance as experiment\n"
+                f"experiment.allocation = {allocation!r}\n"
+                "experiment.adaptive_max_trials = 100\n"
+                f"experiment.run_simulated_session('r1', seed = 1, resume = {resume})\n")
+        subprocess.run([sys.executable, "-c", code],
+                       cwd = workspace,
+                       capture_output = True,
+                       timeout = 120,
+                       check = True)
+
+    run("adaptive", False)
+
+    # Cuts the journal behind the session entry and 50 trials
+    journal = workspace / "results" / "journal_subject_r1.jsonl"
+    journal.write_bytes(b"".join(journal.read_bytes().splitlines(keepends = True)[:51]))
+
+    run("fixed", True)
+
+    resumed = load_copy().load_journal("r1")
+    assert resumed["completed"] and resumed["allocation"] == "adaptive"
+    assert 50 < len(resumed["records"]) <= 100
+
+
+
+def test_resume_leaves_completed_session_alone(workspace, run_script):
+    run_script("--simulate", "--sub-id", "c1", "--seed", "1")
+
+    before = {path: path.read_bytes() for path in workspace.rglob("*") if path.is_file()}
+    result = run_script("--simulate", "--resume", "c1", "--seed", "1")
+    after = {path: path.read_bytes() for path in workspace.rglob("*") if path.is_file()}
+
+    assert "already completed" in result.stdout
+    assert after == before
+
+
+
+def test_adaptive_block_pages_show_most_blocks(workspace):
+    # Records the block pages of an adaptive session that may run at most 100 trials, i.e. 4 blocks of 30
+    code = ("import json, differential_attentional_guidance as experiment\n"
+            "experiment.allocation = 'adaptive'\n"
+            "experiment.adaptive_max_trials = 100\n"
+            "pages = []\n"
+            "block_start_text = experiment.block_start_text\n"
+            "def record(*args, **kwargs):\n"
+            "    pages.append(block_start_text(*args, **kwargs))\n"
+            "    return pages[-1]\n"
+            "experiment.block_start_text = record\n"
+            "experiment.run_simulated_session('a1', seed = 1)\n"
+            "print(json.dumps(pages))\n")
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd = workspace,
+                            capture_output = True,
+                            text = True,
+                            timeout = 120,
+                            check = True)
+
+    pages = json.loads(result.stdout.splitlines()[-1])
+    prerendered, shown = pages[:4], pages[4:]
+
+    assert [page.split(".")[0] for page in prerendered] == [f"Block: {block} von höchstens 4" for block in range(1, 5)]
+    assert shown and set(shown) <= set(prerendered)
+
+
+
+@pytest.mark.parametrize("grid, expected", [((6, 6), ["'1' bis '6'"]),
+                                            ((15, 15), ["der Zeile und der Spalte", "'RETURN'", "'BACKSPACE'"]),
+                                            ((6, 12), ["Zeile geben Sie mit den Tasten '1' bis '6'", "Nummer der Spalte", "'RETURN'"])])
+def test_grid_instruction_matches_answer_keys(workspace, load_copy, grid, expected):
+    script = workspace / "differential_attentional_guidance.py"
+    source = script.read_bytes()
+    source = re.sub(rb"^rows = \d+", f"rows = {grid[0]}".encode(), source, flags = re.M)
+    source = re.sub(rb"^cols = \d+", f"cols = {grid[1]}".encode(), source, flags = re.M)
+    script.write_bytes(source)
+
+    text = load_copy().instruction[1]
+
+    for part in expected:
+        assert part in text
+    assert "'1' bis '15'" not in text
@@ -0,0 +1,80 @@
+import pytest
+
+
+
+@pytest.fixture
+def experiment(load_copy):
+    return load_copy()
+
+
+
+@pytest.fixture
+def win(experiment):
+    return experiment.HeadlessWindow(experiment.SimulatedParticipant(seed = 1))
+
+
+
+def test_reaction_time_is_measured_from_the_onset_flip(experiment, win):
+    keyboard = experiment.SimulatedKeyboard([("b", 0.35), ("b", 0.8)])
+
+    for delay in (0.35, 0.8):
+        win.clock.advance(0.01)
+        rt, flip_latency, flip_time = experiment.capture_reaction_time(win, keyboard, ["b"])
+
+        assert rt == pytest.approx(delay)
+        assert flip_latency == 0
+        assert flip_time == win.last_flip
+        assert keyboard.win is win
+
+
+
+def test_trial_records_scripted_reaction_time(experiment, win):
+    positions = experiment.calculate_positions(win, experiment.rows, experiment.cols)
+    keyboard = experiment.SimulatedKeyboard([("b", 0.6)])
+
+    trial_data = experiment.run_trial(win,
+                                      7,
+                                      positions,
+                                      [],
+                                      "positive",
+                                      None,
+                                      "b",
+                                      target_index = 0,
+                                      distractor_indices = list(range(1, 7)),
+                                      keyboard = keyboard)
+
+    assert trial_data["reaction_time"] == pytest.approx(0.6)
+    assert trial_data["flip_latency"] == 0
+    assert trial_data["target_position"] == (1, 1)
+
+
+
+@pytest.mark.parametrize("late_frames", [0, 2])
+def test_trial_counts_dropped_onset_frames_on_flip_timestamps(experiment, win, late_frames):
+    positions = experiment.calculate_positions(win, experiment.rows, experiment.cols)
+    flip = win.flip
+    flips = []
+
+    # The second flip of the trial is the onset, which is held back for late_frames frames
+    def late_flip(*args, **kwargs):
+        flips.append(None)
+        if len(flips) == 2:
+            win.clock.advance(late_frames * win.frame_period)
+        return flip(*args, **kwargs)
+
+    win.flip = late_flip
+
+    trial_data = experiment.run_trial(win,
+                                      7,
+                                      positions,
+                                      [],
+                                      "positive",
+                                      None,
+                                      "b",
+                                      target_index = 0,
+                                      distractor_indices = list(range(1, 7)))
+
+    assert trial_data["onset_dropped_frames"] == late_frames
+    assert trial_data["onset_timing_ok"] == (late_frames == 0)
+    assert trial_data["row_grid_flip_interval"] == pytest.approx(trial_data["row_grid_flip_time"] - trial_data["onset_flip_time"])
+    assert trial_data["col_grid_flip_interval"] == pytest.approx(trial_data["col_grid_flip_time"] - trial_data["row_grid_flip_time"])
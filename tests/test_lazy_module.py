@@ -0,0 +1,30 @@
+import sys
+import json
+import subprocess
+
+
+
+def test_import_defers_heavy_modules(workspace):
+    # A fresh interpreter, as the other tests may have imported pandas and NumPy already
+    code = ("import sys, json, differential_attentional_guidance; "
+            "print(json.dumps([name for name in ('psychopy', 'pandas', 'numpy') if name in sys.modules]))")
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd = workspace,
+                            capture_output = True,
+                            text = True,
+                            check = True)
+
+    assert json.loads(result.stdout) == []
+
+
+
+def test_lazy_module_caches_attributes_without_shadowing(load_copy):
+    experiment = load_copy()
+
+    # json has a load function of its own, which a stand-in method of the same name would hide
+    lazy_json = experiment.LazyModule("json")
+
+    assert lazy_json.load is json.load
+    assert lazy_json.__dict__["load"] is json.load
+    assert lazy_json.dumps([1]) == "[1]"
+    assert "dumps" in lazy_json.__dict__ and "loads" not in lazy_json.__dict__
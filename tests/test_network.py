@@ -0,0 +1,93 @@
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import subprocess
+
+import pandas as pd
+
+
+
+def test_sink_resends_batch_unchanged_after_lost_ack(load_copy):
+    experiment = load_copy()
+
+    server = socket.create_server(("127.0.0.1", 0))
+    received = []
+
+    def serve():
+        # The first connection reads a batch and closes without confirming it, as if the confirmation got lost
+        for attempt in range(2):
+            connection, _ = server.accept()
+            with connection, connection.makefile("r", encoding = "utf-8") as reader:
+                for line in reader:
+                    message = json.loads(line)
+                    received.append(message)
+                    if attempt == 0:
+                        break
+                    connection.sendall((json.dumps({"ack": message["sequence"]}) + "\n").encode())
+
+    thread = threading.Thread(target = serve, daemon = True)
+    thread.start()
+
+    sink = experiment.NetworkSink({"sub_id": "n1"},
+                                  address = f"127.0.0.1:{server.getsockname()[1]}",
+                                  batch_size = 3,
+                                  retry_interval = 0.2)
+
+    for trial in range(2):
+        sink.send({"trial": trial})
+    sink.flush()
+
+    # These arrive while the short batch 0 waits for its retry and must not be added to it
+    for trial in range(2, 7):
+        sink.send({"trial": trial})
+
+    sink.close()
+    server.close()
+
+    batches = {}
+    for message in received:
+        batches.setdefault(message["sequence"], []).append([record["trial"] for record in message["records"]])
+
+    assert batches[0] == [[0, 1], [0, 1]]
+    assert [trial for sequence in sorted(batches) for trial in batches[sequence][0]] == list(range(7))
+    assert sink.sent == 7 and sink.unsent() == 0
+
+
+
+def test_session_round_trip_through_collector(workspace, load_copy):
+    experiment = load_copy()
+    address = workspace / "collector.sock"
+    collected = workspace / "collected.csv"
+
+    collector = subprocess.Popen([sys.executable, "collector.py", "--unix", str(address), "--output", str(collected), "--no-fsync"],
+                                 cwd = workspace,
+                                 stderr = subprocess.PIPE,
+                                 text = True)
+    try:
+        deadline = time.monotonic() + 30
+        while not address.exists():
+            assert collector.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+
+        code = ("import differential_attentional_guidance as experiment; "
+                f"experiment.collector_address = {f'unix:{address}'!r}; "
+                "experiment.run_simulated_session('c1', seed = 1)")
+        subprocess.run([sys.executable, "-c", code],
+                       cwd = workspace,
+                       capture_output = True,
+                       timeout = 120,
+                       check = True)
+
+    finally:
+        collector.send_signal(signal.SIGINT)
+        collector.communicate(timeout = 30)
+
+    results = pd.read_csv(workspace / "results" / "results_subject_c1.csv")
+    records = pd.read_csv(collected)
+
+    assert records["source"].nunique() == 1
+    assert records["batch"].is_monotonic_increasing
+    pd.testing.assert_frame_equal(records[experiment.result_columns], results)
@@ -0,0 +1,37 @@
+import logging
+
+import pytest
+
+
+
+def test_missing_page_font_falls_back_once(load_copy, caplog):
+    experiment = load_copy()
+    experiment.page_font = "no-such-font.ttf"
+
+    with caplog.at_level(logging.WARNING):
+        first = experiment.render_text_page("Block: 1 von 8.")
+        second = experiment.render_text_page("Block: 2 von 8.")
+
+    assert first.size[0] > 0 and second.size == first.size
+    assert [record.getMessage() for record in caplog.records] == [
+        "Page font no-such-font.ttf not found, pages are pre-rendered with Pillow's default font"]
+
+
+
+def test_old_pillow_without_page_font_skips_pre_rendering(load_copy, monkeypatch, caplog):
+    from PIL import ImageFont
+
+    experiment = load_copy()
+    experiment.page_font = "no-such-font.ttf"
+
+    # Before Pillow 10.1, load_default took no size
+    load_default = ImageFont.load_default
+    monkeypatch.setattr(ImageFont, "load_default", lambda: load_default())
+
+    with caplog.at_level(logging.WARNING):
+        assert experiment.load_page_font(20) is None
+
+    assert "10.1 or newer is needed" in caplog.text
+
+    with pytest.raises(OSError):
+        experiment.render_text_page("Block: 1 von 8.")
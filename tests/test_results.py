@@ -0,0 +1,94 @@
+import time
+import threading
+import contextlib
+
+import pytest
+
+
+
+class FlakyResults:
+    """Results that fail like an unreachable network share while failing is set, shared by every reopened instance."""
+
+    failing = threading.Event()
+    rows = []
+    opened = 0
+
+    def __init__(self):
+        if self.failing.is_set():
+            raise OSError("share unreachable")
+        FlakyResults.opened += 1
+        self.buffer = []
+
+    def append(self, record):
+        if self.failing.is_set():
+            raise OSError("share unreachable")
+        self.buffer.append(record["trial"])
+
+    def flush(self, fsync = False):
+        if self.failing.is_set():
+            self.buffer = []
+            raise OSError("share unreachable")
+        self.rows.extend(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        pass
+
+
+
+def wait_for(condition, timeout = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+
+@pytest.mark.parametrize("fail_at", ["append", "flush"])
+def test_writer_keeps_trials_while_saving_fails(load_copy, tmp_path, fail_at):
+    experiment = load_copy()
+    experiment.open_results = lambda path, format: FlakyResults()
+    experiment.trial_record = lambda subject_info, trial_data: {"trial": trial_data["trial_num"]}
+
+    FlakyResults.failing.clear()
+    FlakyResults.rows.clear()
+    FlakyResults.opened = 0
+
+    journal = experiment.SessionJournal(str(tmp_path / "journal.jsonl"))
+    writer = experiment.ResultWriter({"sub_id": "w1"},
+                                     output_file = str(tmp_path / "results.csv"),
+                                     policy = "trial",
+                                     journal = journal,
+                                     retry_interval = 0.05)
+
+    writer.write({"trial_num": 1})
+    wait_for(lambda: FlakyResults.rows == [1])
+
+    # A failing flush loses the buffered rows, a failing append keeps them from the file
+    if fail_at == "flush":
+        original_append = FlakyResults.append
+        FlakyResults.append = lambda self, record: (original_append(self, record), FlakyResults.failing.set())
+    else:
+        FlakyResults.failing.set()
+
+    writer.write({"trial_num": 2})
+    wait_for(lambda: writer.error is not None)
+
+    with pytest.raises(OSError, match = "trials are kept to retry"):
+        writer.write({"trial_num": 3})
+
+    if fail_at == "flush":
+        FlakyResults.append = original_append
+    FlakyResults.failing.clear()
+
+    with contextlib.suppress(OSError):
+        writer.write({"trial_num": 4})
+    writer.close()
+    journal.close()
+
+    assert FlakyResults.rows == [1, 2, 3, 4]
+    assert FlakyResults.opened >= 2
+    assert writer.unsaved == [] and writer.error is None
+
+    entries, _ = experiment.read_journal(str(tmp_path / "journal.jsonl"))
+    assert [entry["record"]["trial"] for entry in entries] == [1, 2, 3, 4]
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+import differential_attentional_guidance as experiment
+
+
+
+@pytest.fixture(params = [1, 2, 3])
+def schedule(request):
+    return experiment.generate_trial_schedule(experiment.set_sizes,
+                                              experiment.target_states,
+                                              experiment.trials_per_condition,
+                                              experiment.rows,
+                                              experiment.cols,
+                                              seed = request.param)
+
+
+
+def conditions(schedule):
+    set_size_index = np.searchsorted(experiment.set_sizes, schedule["set_size"])
+    return set_size_index * len(experiment.target_states) + schedule["target_state"]
+
+
+
+def test_runs_are_limited(schedule):
+    assert experiment.run_lengths(conditions(schedule)).max() <= experiment.max_condition_run
+
+
+
+def test_blocks_are_balanced(schedule):
+    n_conditions = len(experiment.set_sizes) * len(experiment.target_states)
+    blocks = conditions(schedule).reshape(-1, experiment.trials_per_condition)
+
+    for block in blocks:
+        counts = np.bincount(block, minlength = n_conditions)
+        assert counts.max() - counts.min() <= 1
+
+    assert np.bincount(blocks.ravel()).tolist() == [experiment.trials_per_condition] * n_conditions
+
+
+
+def test_targets_are_balanced(schedule):
+    rows, cols = experiment.rows, experiment.cols
+    quadrants = (2 * (schedule["target_row"] - 1) // rows) * 2 + 2 * (schedule["target_col"] - 1) // cols
+    condition_of_trial = conditions(schedule)
+
+    for condition in np.unique(condition_of_trial):
+        trials = condition_of_trial == condition
+
+        cell_counts = np.bincount(schedule["target"][trials], minlength = rows * cols)
+        quadrant_counts = np.bincount(quadrants[trials], minlength = 4)
+
+        assert cell_counts.max() - cell_counts.min() <= 1
+        assert quadrant_counts.max() - quadrant_counts.min() <= 1
+
+
+
+def test_distractors_fill_the_display(schedule):
+    for set_size, target, distractors in zip(schedule["set_size"], schedule["target"], schedule["distractors"]):
+        used = distractors[distractors >= 0]
+
+        assert len(used) == set_size - 1
+        assert len(set(used.tolist()) | {target}) == set_size
+
+
+
+def test_loaded_schedule_must_fit_the_grid(tmp_path, schedule):
+    path = tmp_path / "schedule.npz"
+    np.savez(path, **schedule)
+
+    loaded = experiment.load_trial_schedule(str(path), experiment.rows, experiment.cols, experiment.set_sizes)
+    assert loaded["target"].tolist() == schedule["target"].tolist()
+
+    with pytest.raises(ValueError, match = "another grid"):
+        experiment.load_trial_schedule(str(path), experiment.rows + 1, experiment.cols + 1, experiment.set_sizes)
+
+    with pytest.raises(ValueError, match = "another grid"):
+        experiment.load_trial_schedule(str(path), experiment.rows - 1, experiment.cols - 1, experiment.set_sizes)
+
+    with pytest.raises(ValueError, match = "set sizes"):
+        experiment.load_trial_schedule(str(path), experiment.rows, experiment.cols, experiment.set_sizes[1:])
+
+
+
+def test_headless_setup_loads_schedule_file(load_copy, tmp_path):
+    copy = load_copy()
+    schedule = copy.generate_trial_schedule(copy.set_sizes,
+                                            copy.target_states,
+                                            copy.trials_per_condition,
+                                            copy.rows,
+                                            copy.cols,
+                                            seed = 7)
+    np.savez(tmp_path / "schedule.npz", **schedule)
+    copy.schedule_file = str(tmp_path / "schedule.npz")
+
+    _, _, _, loaded, _ = copy.setup_experiment({"age": "0", "sex": "simulated", "sub_id": "f1", "vision": "simulated", "handedness": "simulated"},
+                                               copy.rows,
+                                               copy.cols,
+                                               copy.set_sizes,
+                                               copy.target_states,
+                                               copy.trials_per_condition,
+                                               copy.logging.WARNING,
+                                               participant = copy.SimulatedParticipant(seed = 1))
+
+    assert loaded["target"].tolist() == schedule["target"].tolist()
+    assert loaded["distractors"].tolist() == schedule["distractors"].tolist()